@@ -0,0 +1,259 @@
+"""
+Offline benchmarks for the departure processing hot paths.
+
+Replays departure payloads for each RTPI source through the source parsers,
+then times aging (fast_update), filtering and each of the departure board
+renderers, reporting throughput and memory allocated per operation.
+
+Usage: python benchmarks/bench_sensor.py [--sizes suburban,hub] [--filter TEXT]
+       [--save results.json] [--compare results.json] [--threshold 20]
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+from common import load_sensor_module, source_config
+from fixtures import FIXTURE_SIZES, SOURCES, gtfs_static_timetable, payload
+
+sensor = load_sensor_module()
+
+MIN_RUN_TIME = 0.2
+REPEAT = 5
+
+
+def make_data(source, route_list=None, direction=None):
+    """Return a data object for a single source, without a coordinator."""
+    rtpi_sources = {
+        source: source_config(
+            sensor,
+            "768",
+            source,
+            route_list=route_list or [],
+            direction=direction,
+        )
+    }
+    coordinator = sensor.RtpiCoordinator(sensor.RtpiSessionPool(), fetch_jitter=0)
+    return sensor.PublicTransportData(
+        "768",
+        rtpi_sources,
+        sensor.DEFAULT_LIMIT_TIME_HORIZON,
+        0,
+        sensor.DEFAULT_REFRESH_INTERVAL,
+        sensor.DEFAULT_NO_DATA_REFRESH_INTERVAL,
+        0,
+        sensor.FETCH_STRATEGY_SEQUENTIAL,
+        sensor.DEFAULT_HEDGE_DELAY,
+        sensor.SOURCE_ORDER_PRECEDENCE,
+        False,
+        coordinator,
+    )
+
+
+def make_sensor(data, departures):
+    """Return a sensor showing departures with all show options enabled."""
+    entity = sensor.DublinPublicTransportSensor(
+        "bench", data, "768", list(sensor.SHOW_OPTIONS)
+    )
+    entity._departures = departures
+    entity._current_source = departures[0].source if departures else None
+    entity._departures_version = 1
+    return entity
+
+
+def parser(source, data):
+    """Return a function that parses a raw payload for source."""
+    if source == sensor.RTPI_SOURCE_TFI_EFA:
+        return lambda content: data._parse_tfi_efa(json.loads(content))
+    if source == sensor.RTPI_SOURCE_TFI_EFA_XML:
+
+        def parse_xml(content):
+            ## Feed in chunks as received from the streamed response
+            xml_parser = sensor.EfaXmlDepartureParser(sensor.TimestampDecoder().efa_xml)
+            for i in range(0, len(content), sensor.RTPI_CHUNK_SIZE):
+                xml_parser.feed(content[i : i + sensor.RTPI_CHUNK_SIZE])
+            return xml_parser.close()
+
+        return parse_xml
+    if source == sensor.RTPI_SOURCE_DUBLIN_BUS:
+        return lambda content: data._parse_dublin_bus(json.loads(content))
+    if source == sensor.RTPI_SOURCE_IRISH_RAIL:
+
+        def parse_irish_rail(content):
+            ## Feed in chunks as received from the streamed response
+            ir_parser = sensor.IrishRailStationDataParser(
+                sensor.TimestampDecoder().time
+            )
+            for i in range(0, len(content), sensor.RTPI_CHUNK_SIZE):
+                ir_parser.feed(content[i : i + sensor.RTPI_CHUNK_SIZE])
+            return ir_parser.close()
+
+        return parse_irish_rail
+    if source == sensor.RTPI_SOURCE_GTFS_RT:
+        ## Decode departures for the stop from a feed covering other stops
+        return lambda content: data._parse_gtfs_rt(content, {"8220DB000768"})
+    raise Exception(f"Unknown source {source}")
+
+
+def measure(func, *args):
+    """Return the best time per call in seconds and peak bytes allocated."""
+    func(*args)
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_RUN_TIME or number >= 1 << 20:
+            break
+        number *= 2
+    best = elapsed / number
+    for _ in range(REPEAT - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        best = min(best, (time.perf_counter() - start) / number)
+
+    gc.collect()
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def benchmarks(sizes, temp_dir):
+    """Yield (name, label, departure count, func, args) for each benchmark."""
+    now = sensor.dt_util.now()
+    for label in sizes:
+        count = FIXTURE_SIZES[label]
+        for source in SOURCES:
+            data = make_data(source)
+            content = payload(source, count, now=now)
+            yield f"parse_{source}", label, count, parser(source, data), (content,)
+
+        gtfs_path = os.path.join(temp_dir, label)
+        gtfs_static_timetable(gtfs_path, count, now=now)
+        index = sensor.get_gtfs_static_index(gtfs_path)
+        yield "lookup_gtfs_static", label, count, index.departures, (
+            "8220DB000768",
+            now,
+            sensor.GTFS_STATIC_LOOKAHEAD,
+        )
+
+        source = sensor.RTPI_SOURCE_TFI_EFA
+        data = make_data(source)
+        departures = parser(source, data)(payload(source, count, now=now))
+        yield "fast_update", label, count, data.fast_update, (departures,)
+
+        ## Scheduled departures overlaid with the same departures in real time
+        scheduled = [dep._replace(is_realtime=False) for dep in departures]
+        yield "merge_sources", label, count, sensor.Departure.merge, (
+            (scheduled, departures),
+        )
+
+        data._current_source = source
+        data._all_departures = departures
+        yield "filter_all", label, count, data._filter_departures, ()
+
+        data = make_data(
+            source, route_list=["46A", "145", "39A"], direction=["Inbound"]
+        )
+        data._current_source = source
+        data._all_departures = departures
+        yield "filter_route_direction", label, count, data._filter_departures, ()
+
+        indexed = make_data(
+            source, route_list=["46A", "145", "39A"], direction=["Inbound"]
+        )
+        indexed._current_source = source
+        indexed._all_departures = departures
+        indexed._index = sensor.DepartureIndex(departures)
+        yield "filter_indexed", label, count, indexed._filter_departures, ()
+
+        entity = make_sensor(data, departures)
+
+        def render_rows(entity=entity):
+            entity._rows = {}
+            return entity._render_rows()
+
+        def render_attributes(entity=entity):
+            entity._rows = {}
+            entity._attrs = None
+            return entity.extra_state_attributes
+
+        rows = render_rows()
+        yield "render_rows", label, count, render_rows, ()
+        yield "render_text", label, count, entity._render_departures_text, (rows,)
+        yield "render_html", label, count, entity._render_departures_html, (rows,)
+        yield "render_md", label, count, entity._render_departures_md, (rows,)
+        yield "render_json", label, count, entity._render_departures_json, (rows,)
+        yield "render_attributes", label, count, render_attributes, ()
+
+
+def main():
+    parser_ = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser_.add_argument("--sizes", default=",".join(FIXTURE_SIZES))
+    parser_.add_argument("--filter", default="", help="only run matching benchmarks")
+    parser_.add_argument("--save", help="save results to a JSON file")
+    parser_.add_argument("--compare", help="compare with results saved earlier")
+    parser_.add_argument(
+        "--threshold",
+        type=float,
+        default=20,
+        help="slowdown reported as a regression (in percent)",
+    )
+    args = parser_.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print(
+        f"{'benchmark':<24} {'size':<9} {'deps':>5} {'us/op':>10} "
+        f"{'ops/s':>10} {'deps/s':>11} {'peak KiB':>9} {'change':>8}"
+    )
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, label, count, func, func_args in benchmarks(
+            args.sizes.split(","), temp_dir
+        ):
+            key = f"{name}[{label}]"
+            if args.filter not in key:
+                continue
+            seconds, peak = measure(func, *func_args)
+            results[key] = {
+                "seconds": seconds,
+                "peak_bytes": peak,
+                "departures": count,
+            }
+            change = ""
+            if key in baseline:
+                pct = (seconds / baseline[key]["seconds"] - 1) * 100
+                change = f"{pct:+.0f}%"
+                if pct > args.threshold:
+                    regressions.append(key)
+            print(
+                f"{name:<24} {label:<9} {count:>5} {seconds * 1e6:>10.1f} "
+                f"{1 / seconds:>10.0f} {count / seconds:>11.0f} "
+                f"{peak / 1024:>9.1f} {change:>8}"
+            )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print(f"Regressions over {args.threshold:.0f}%: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
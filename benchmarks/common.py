@@ -0,0 +1,34 @@
+"""Helpers shared by the benchmark and load testing scripts."""
+import importlib.util
+import os
+import sys
+
+SENSOR_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "sensor.py")
+
+
+def load_sensor_module():
+    """Load the sensor platform module without installing the integration."""
+    if "tfi_transport_sensor" in sys.modules:
+        return sys.modules["tfi_transport_sensor"]
+    spec = importlib.util.spec_from_file_location("tfi_transport_sensor", SENSOR_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def source_config(sensor, stop_id, source=None, **options):
+    """Return an RTPI source configuration as validated by the schema."""
+    config = {sensor.CONF_STOP_ID: stop_id, **options}
+    if source is None:
+        return sensor.CONF_RTPI_SOURCE_SCHEMA(config)
+    return sensor.CONF_RTPI_SCHEMA({source: config})[source]
+
+
+def percentile(values, pct):
+    """Return the pct percentile of values, by nearest rank."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(pct / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
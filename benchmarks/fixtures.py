@@ -0,0 +1,474 @@
+"""
+Departure payload fixtures for the RTPI data sources.
+
+Payloads reproduce the structure of responses recorded from the TFI EFA
+departure monitor (JSON and XML), the smartdublin realtimebusinformation
+endpoint, the Irish Rail getStationDataByCodeXML and getAllStationsXML
+endpoints and the NTA
+GTFS-Realtime TripUpdates feed, and a static GTFS timetable. Departures are
+generated relative to the time the fixture is built, so that countdowns and
+due times are consistent with the current time when replayed.
+"""
+import csv
+import json
+import os
+import random
+from datetime import datetime, timedelta
+from xml.sax.saxutils import quoteattr, escape
+
+from google.transit import gtfs_realtime_pb2
+
+## Fixture sizes, from a quiet suburban stop up to a busy city hub
+FIXTURE_SIZES = {
+    "suburban": 5,
+    "town": 30,
+    "city": 100,
+    "hub": 300,
+}
+
+SOURCES = ["tfi_efa", "tfi_efa_xml", "dublin_bus", "irish_rail", "gtfs_rt"]
+
+## Stops called at by each GTFS-RT trip, most of which are not monitored
+GTFS_RT_STOPS_PER_TRIP = 10
+
+## Hours covered by the static GTFS timetable, and hours looked up ahead
+GTFS_STATIC_SERVICE_HOURS = 20
+GTFS_STATIC_LOOKAHEAD_HOURS = 3
+
+ROUTES = ["1", "4", "7", "9", "11", "13", "15", "16", "39A", "46A", "123", "145"]
+PLACES = [
+    "Ballymun",
+    "Blackrock",
+    "Bray",
+    "Dalkey",
+    "Dun Laoghaire",
+    "Howth",
+    "Malahide",
+    "Maynooth",
+    "Ongar",
+    "Sandyford",
+    "Tallaght",
+    "UCD Belfield",
+]
+TRAIN_TYPES = ["DART", "Train", "Commuter"]
+TRAIN_DIRECTIONS = ["Northbound", "Southbound"]
+
+
+def _departures(count, now, seed):
+    """Return generic departure records spread over the next few hours."""
+    rnd = random.Random(seed)
+    now = now.replace(second=0, microsecond=0)
+    horizon = max(count * 2, 60)
+    deps = []
+    for i in range(count):
+        countdown = int(i * horizon / count) + rnd.randint(0, 1)
+        late = rnd.choice([0, 0, 0, 1, 2, 5])
+        due_at = now + timedelta(minutes=countdown)
+        deps.append(
+            {
+                "route": rnd.choice(ROUTES),
+                "destination": rnd.choice(PLACES),
+                "origin": rnd.choice(PLACES),
+                "outbound": rnd.random() < 0.5,
+                "scheduled_at": due_at - timedelta(minutes=late),
+                "due_at": due_at,
+                "countdown": countdown,
+                "is_realtime": rnd.random() < 0.8,
+                "index": i,
+            }
+        )
+    return deps
+
+
+def _efa_datetime(dt):
+    return {
+        "year": str(dt.year),
+        "month": str(dt.month),
+        "day": str(dt.day),
+        "weekday": str(dt.isoweekday() % 7 + 1),
+        "hour": str(dt.hour),
+        "minute": str(dt.minute),
+    }
+
+
+def tfi_efa_json(count, now=None, seed=0, stop_id="8220DB000768", stop_ids=None):
+    """
+    Return a TFI EFA JSON departure monitor response.
+
+    Departures are spread across stop_ids if provided, as for a query for a
+    parent stop or area.
+    """
+    now = now or datetime.now()
+    stop_ids = stop_ids or [stop_id]
+    departure_list = []
+    for dep in _departures(count, now, seed):
+        entry = {
+            "stopID": stop_ids[dep["index"] % len(stop_ids)],
+            "x": "-6.26031",
+            "y": "53.34981",
+            "mapName": "WGS84[dd.ddddd]",
+            "area": "1",
+            "platform": "",
+            "platformName": "",
+            "stopName": "Westmoreland Street",
+            "nameWO": "Westmoreland Street",
+            "pointType": "Bus stop",
+            "countdown": str(dep["countdown"]),
+            "dateTime": _efa_datetime(dep["scheduled_at"]),
+            "servingLine": {
+                "key": str(1000 + dep["index"]),
+                "code": "5",
+                "number": dep["route"],
+                "symbol": dep["route"],
+                "motType": "5",
+                "mtSubcode": "0",
+                "realtime": "1" if dep["is_realtime"] else "0",
+                "direction": dep["destination"],
+                "directionFrom": dep["origin"],
+                "name": "Bus",
+                "delay": "0",
+                "liErgRiProj": {
+                    "line": dep["route"],
+                    "project": "y08",
+                    "direction": "R" if dep["outbound"] else "H",
+                    "supplement": " ",
+                    "network": "dub",
+                    "gid": "",
+                },
+                "destID": "8220DB00" + str(4000 + dep["index"]),
+                "stateless": "dub:" + dep["route"] + ": :H:y08",
+            },
+            "operator": {"code": "978", "name": "Dublin Bus", "publicCode": ""},
+            "attrs": [{"name": "tripCode", "value": str(dep["index"])}],
+        }
+        if dep["is_realtime"]:
+            entry["realDateTime"] = _efa_datetime(dep["due_at"])
+        departure_list.append(entry)
+    return json.dumps(
+        {
+            "parameters": [{"name": "serverID", "value": "EFA10_04"}],
+            "dm": {"input": {"input": stop_id}, "points": {"point": {}}},
+            "arr": None,
+            "dateTime": _efa_datetime(now),
+            "departureList": departure_list,
+        }
+    ).encode()
+
+
+def _xml_datetime(tag, dt):
+    return (
+        f"<{tag}>"
+        f'<itdDate year="{dt.year}" month="{dt.month}" day="{dt.day}" '
+        f'weekday="{dt.isoweekday() % 7 + 1}"/>'
+        f'<itdTime hour="{dt.hour}" minute="{dt.minute}" ap="" sec="0"/>'
+        f"</{tag}>"
+    )
+
+
+def tfi_efa_xml(count, now=None, seed=0, stop_id="8220DB000768", stop_ids=None):
+    """
+    Return a TFI EFA XML departure monitor response.
+
+    Departures are spread across stop_ids if provided, as for a query for a
+    parent stop or area.
+    """
+    now = now or datetime.now()
+    stop_ids = stop_ids or [stop_id]
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<itdRequest version="10.4.18.18" language="en" serverID="EFA10_04">',
+        '<itdDepartureMonitorRequest requestID="0">',
+        f'<itdOdv type="stop" usage="dm"><itdOdvName state="identified">'
+        f'<odvNameElem stopID="{stop_id}">Westmoreland Street</odvNameElem>'
+        f"</itdOdvName></itdOdv>",
+        _xml_datetime("itdDateTime", now),
+        "<itdDepartureList>",
+    ]
+    for dep in _departures(count, now, seed):
+        parts.append(
+            f'<itdDeparture stopID="{stop_ids[dep["index"] % len(stop_ids)]}" '
+            f'x="-6.26031" y="53.34981" '
+            f'mapName="WGS84[dd.ddddd]" area="1" platform="" platformName="" '
+            f'stopName="Westmoreland Street" nameWO="Westmoreland Street" '
+            f'countdown="{dep["countdown"]}">'
+        )
+        parts.append(_xml_datetime("itdDateTime", dep["scheduled_at"]))
+        if dep["is_realtime"]:
+            parts.append(_xml_datetime("itdRTDateTime", dep["due_at"]))
+        parts.append(
+            f'<itdServingLine key="{1000 + dep["index"]}" code="5" '
+            f'number={quoteattr(dep["route"])} symbol={quoteattr(dep["route"])} '
+            f'motType="5" realtime="{1 if dep["is_realtime"] else 0}" '
+            f'direction={quoteattr(dep["destination"])} '
+            f'directionFrom={quoteattr(dep["origin"])} '
+            f'trainName="" delay="0">'
+            f'<itdNoTrain name="Bus"/>'
+            f'<motDivaParams line={quoteattr(dep["route"])} project="y08" '
+            f'direction="{"R" if dep["outbound"] else "H"}" supplement=" " '
+            f'network="dub"/>'
+            f"</itdServingLine>"
+            f"<itdOperator><code>978</code><name>Dublin Bus</name></itdOperator>"
+            f"</itdDeparture>"
+        )
+    parts.append("</itdDepartureList></itdDepartureMonitorRequest></itdRequest>")
+    return "".join(parts).encode()
+
+
+def dublin_bus_json(count, now=None, seed=0, stop_id="768"):
+    """Return a smartdublin realtimebusinformation response."""
+    now = now or datetime.now()
+    results = []
+    for dep in _departures(count, now, seed):
+        due = str(dep["countdown"]) if dep["countdown"] else "Due"
+        due_at = dep["due_at"].strftime("%d/%m/%Y %H:%M:%S")
+        scheduled_at = dep["scheduled_at"].strftime("%d/%m/%Y %H:%M:%S")
+        results.append(
+            {
+                "arrivaldatetime": due_at,
+                "duetime": due,
+                "departuredatetime": due_at,
+                "departureduetime": due,
+                "scheduledarrivaldatetime": scheduled_at,
+                "scheduleddeparturedatetime": scheduled_at,
+                "destination": dep["destination"],
+                "destinationlocalized": dep["destination"],
+                "origin": dep["origin"],
+                "originlocalized": dep["origin"],
+                "direction": "Outbound" if dep["outbound"] else "Inbound",
+                "operator": "bac",
+                "operatortype": "1",
+                "additionalinformation": "",
+                "lowfloorstatus": "no",
+                "route": dep["route"],
+                "sourcetimestamp": now.strftime("%d/%m/%Y %H:%M:%S"),
+                "monitored": "true" if dep["is_realtime"] else "false",
+            }
+        )
+    return json.dumps(
+        {
+            "errorcode": "0" if results else "1",
+            "errormessage": "" if results else "No Results",
+            "numberofresults": len(results),
+            "stopid": stop_id,
+            "timestamp": now.strftime("%d/%m/%Y %H:%M:%S"),
+            "results": results,
+        }
+    ).encode()
+
+
+def irish_rail_xml(count, now=None, seed=0, station="Tara Street"):
+    """Return an Irish Rail getStationDataByCodeXML response."""
+    now = now or datetime.now()
+    parts = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<ArrayOfObjStationData xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        'xmlns:xsd="http://www.w3.org/2001/XMLSchema" '
+        'xmlns="http://api.irishrail.ie/realtime/">',
+    ]
+    rnd = random.Random(seed)
+    for dep in _departures(count, now, seed):
+        late = int((dep["due_at"] - dep["scheduled_at"]).total_seconds() // 60)
+        parts.append(
+            "<objStationData>"
+            f"<Servertime>{now.isoformat(timespec='milliseconds')}</Servertime>"
+            f"<Traincode>E{100 + dep['index']}</Traincode>"
+            f"<Stationfullname>{escape(station)}</Stationfullname>"
+            "<Stationcode>TARA</Stationcode>"
+            f"<Querytime>{now.strftime('%H:%M:%S')}</Querytime>"
+            f"<Traindate>{now.strftime('%d %b %Y')}</Traindate>"
+            f"<Origin>{escape(dep['origin'])}</Origin>"
+            f"<Destination>{escape(dep['destination'])}</Destination>"
+            f"<Origintime>{(now - timedelta(minutes=30)).strftime('%H:%M')}</Origintime>"
+            f"<Destinationtime>{(dep['due_at'] + timedelta(minutes=30)).strftime('%H:%M')}</Destinationtime>"
+            "<Status>En Route</Status>"
+            "<Lastlocation>Departed Pearse</Lastlocation>"
+            f"<Duein>{dep['countdown']}</Duein>"
+            f"<Late>{late}</Late>"
+            f"<Exparrival>{dep['due_at'].strftime('%H:%M')}</Exparrival>"
+            f"<Expdepart>{dep['due_at'].strftime('%H:%M')}</Expdepart>"
+            f"<Scharrival>{dep['scheduled_at'].strftime('%H:%M')}</Scharrival>"
+            f"<Schdepart>{dep['scheduled_at'].strftime('%H:%M')}</Schdepart>"
+            f"<Direction>{rnd.choice(TRAIN_DIRECTIONS)}</Direction>"
+            f"<Traintype>{rnd.choice(TRAIN_TYPES)}</Traintype>"
+            "<Locationtype>S</Locationtype>"
+            "</objStationData>"
+        )
+    parts.append("</ArrayOfObjStationData>")
+    return "".join(parts).encode()
+
+
+def irish_rail_stations_xml(stations):
+    """Return an Irish Rail getAllStationsXML response for (name, code) pairs."""
+    parts = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<ArrayOfObjStation xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        'xmlns:xsd="http://www.w3.org/2001/XMLSchema" '
+        'xmlns="http://api.irishrail.ie/realtime/">',
+    ]
+    for i, (name, code) in enumerate(stations):
+        parts.append(
+            "<objStation>"
+            f"<StationDesc>{escape(name)}</StationDesc>"
+            "<StationAlias />"
+            "<StationLatitude>53.3471</StationLatitude>"
+            "<StationLongitude>-6.25464</StationLongitude>"
+            f"<StationCode>{escape(code)}</StationCode>"
+            f"<StationId>{i + 1}</StationId>"
+            "</objStation>"
+        )
+    parts.append("</ArrayOfObjStation>")
+    return "".join(parts).encode()
+
+
+def gtfs_rt_feed(count, now=None, seed=0, stop_id="8220DB000768", stop_ids=None):
+    """
+    Return a GTFS-RT TripUpdates feed message.
+
+    Each stop in stop_ids has count departures. Each trip also calls at other
+    stops, as in a feed covering the whole network.
+    """
+    now = now or datetime.now()
+    stop_ids = stop_ids or [stop_id]
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.incrementality = gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+    feed.header.timestamp = int(now.timestamp())
+    for k, stop in enumerate(stop_ids):
+        for dep in _departures(count, now, seed + k):
+            trip_id = f"{k}_{dep['index']}"
+            entity = feed.entity.add(id=trip_id)
+            trip_update = entity.trip_update
+            trip_update.trip.trip_id = trip_id
+            trip_update.trip.route_id = dep["route"]
+            trip_update.trip.direction_id = 1 if dep["outbound"] else 0
+            trip_update.trip.start_date = now.strftime("%Y%m%d")
+            trip_update.trip_properties.trip_headsign = dep["destination"]
+            delay = int((dep["due_at"] - dep["scheduled_at"]).total_seconds())
+            ## The monitored stop is called at part way through the trip
+            for sequence in range(GTFS_RT_STOPS_PER_TRIP):
+                offset = sequence - GTFS_RT_STOPS_PER_TRIP // 2
+                stop_time = trip_update.stop_time_update.add()
+                stop_time.stop_sequence = sequence + 1
+                stop_time.stop_id = stop if offset == 0 else f"8220X{k}{sequence:02}"
+                due_at = dep["due_at"] + timedelta(minutes=2 * offset)
+                stop_time.departure.time = int(due_at.timestamp())
+                stop_time.departure.delay = delay
+    return feed.SerializeToString()
+
+
+def _write_csv(path, name, header, rows):
+    with open(os.path.join(path, name), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def gtfs_static_timetable(
+    path, count, now=None, seed=0, stop_id="8220DB000768", stop_ids=None
+):
+    """
+    Write a static GTFS timetable to the directory path.
+
+    Each stop in stop_ids has about count departures in the hours looked up
+    ahead of now, spread across the service day as in a full timetable. Each
+    trip also calls at other stops, and half of the trips run on a service
+    that is not active today.
+    """
+    now = now or datetime.now()
+    stop_ids = stop_ids or [stop_id]
+    rnd = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    today = now.strftime("%Y%m%d")
+    next_year = (now + timedelta(days=365)).strftime("%Y%m%d")
+    _write_csv(
+        path,
+        "calendar.txt",
+        [
+            "service_id",
+            "monday",
+            "tuesday",
+            "wednesday",
+            "thursday",
+            "friday",
+            "saturday",
+            "sunday",
+            "start_date",
+            "end_date",
+        ],
+        [
+            ["daily"] + ["1"] * 7 + [today, next_year],
+            ["removed"] + ["1"] * 7 + [today, next_year],
+        ],
+    )
+    _write_csv(
+        path,
+        "calendar_dates.txt",
+        ["service_id", "date", "exception_type"],
+        [["removed", today, "2"]],
+    )
+    _write_csv(
+        path,
+        "routes.txt",
+        ["route_id", "agency_id", "route_short_name", "route_type"],
+        [[f"r{route}", "978", route, "3"] for route in ROUTES],
+    )
+    trips = []
+    stop_times = []
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    start = max(int((now - midnight).total_seconds()) - 3600, 0)
+    trips_per_stop = (
+        2 * count * GTFS_STATIC_SERVICE_HOURS // GTFS_STATIC_LOOKAHEAD_HOURS
+    )
+    interval = GTFS_STATIC_SERVICE_HOURS * 3600 / max(trips_per_stop, 1)
+    for k, stop in enumerate(stop_ids):
+        for i in range(trips_per_stop):
+            trip_id = f"{k}_{i}"
+            trips.append(
+                [
+                    f"r{rnd.choice(ROUTES)}",
+                    "daily" if i % 2 else "removed",
+                    trip_id,
+                    rnd.choice(PLACES),
+                    rnd.randint(0, 1),
+                ]
+            )
+            seconds = start + int(i * interval)
+            for sequence in range(GTFS_RT_STOPS_PER_TRIP):
+                offset = sequence - GTFS_RT_STOPS_PER_TRIP // 2
+                t = max(seconds + offset * 120, 0)
+                time_str = f"{t // 3600}:{t // 60 % 60:02}:{t % 60:02}"
+                stop_times.append(
+                    [
+                        trip_id,
+                        time_str,
+                        time_str,
+                        stop if offset == 0 else f"8220X{k}{sequence:02}",
+                        sequence + 1,
+                    ]
+                )
+    _write_csv(
+        path,
+        "trips.txt",
+        ["route_id", "service_id", "trip_id", "trip_headsign", "direction_id"],
+        trips,
+    )
+    _write_csv(
+        path,
+        "stop_times.txt",
+        ["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"],
+        stop_times,
+    )
+
+
+PAYLOADS = {
+    "tfi_efa": tfi_efa_json,
+    "tfi_efa_xml": tfi_efa_xml,
+    "dublin_bus": dublin_bus_json,
+    "irish_rail": irish_rail_xml,
+    "gtfs_rt": gtfs_rt_feed,
+}
+
+
+def payload(source, count, now=None, seed=0, **kwargs):
+    """Return the response payload for a source with count departures."""
+    return PAYLOADS[source](count, now=now, seed=seed, **kwargs)
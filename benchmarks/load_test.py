@@ -0,0 +1,205 @@
+"""
+Load test the sensor against the local stand-in RTPI server.
+
+Runs many PublicTransportData instances sharing one coordinator, as they are
+in Home Assistant, through a number of refresh cycles against a local fake
+server, and reports sensor update latency percentiles and the requests made
+to each endpoint per cycle.
+
+Usage: python benchmarks/load_test.py [--sensors 500] [--stops 250]
+       [--sources tfi_efa_xml,tfi_efa] [--cycles 3] [--latency 50]
+       [--error-rate 0.05] [--timeout-rate 0.01] [--departures 30]
+       [--batch-size 10]
+"""
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+from common import load_sensor_module, percentile, source_config
+from rtpi_server import (
+    BATCH_PREFIX,
+    DUBLIN_BUS_PATH,
+    EFA_PATH,
+    GTFS_RT_PATH,
+    IRISH_RAIL_PATH,
+    add_server_arguments,
+    server_from_arguments,
+)
+
+sensor = load_sensor_module()
+
+
+def make_sensors(args, url, coordinator):
+    """Return data objects for the configured number of sensors and stops."""
+    sources = args.sources.split(",")
+    sensors = []
+    for i in range(args.sensors):
+        stop_id = str(i % args.stops)
+        rtpi_sources = {}
+        batch_stop_id = ""
+        if args.batch_size > 1:
+            batch_stop_id = f"{BATCH_PREFIX}{int(stop_id) // args.batch_size}"
+        for source in sources:
+            if source == sensor.RTPI_SOURCE_GTFS_RT:
+                source_data = source_config(
+                    sensor, stop_id, source, url=url + GTFS_RT_PATH
+                )
+            else:
+                source_data = source_config(
+                    sensor, stop_id, batch_stop_id=batch_stop_id
+                )
+            rtpi_sources[source] = source_data
+        sensors.append(
+            sensor.PublicTransportData(
+                stop_id,
+                rtpi_sources,
+                sensor.DEFAULT_LIMIT_TIME_HORIZON,
+                0,
+                sensor.DEFAULT_REFRESH_INTERVAL,
+                sensor.DEFAULT_NO_DATA_REFRESH_INTERVAL,
+                0,
+                args.fetch_strategy,
+                args.hedge_delay,
+                args.source_order,
+                args.merge_sources,
+                coordinator,
+            )
+        )
+    return sensors
+
+
+async def timed_update(data, delay):
+    """Update a sensor after delay, returning latency and whether it succeeded."""
+    await asyncio.sleep(delay)
+    last_fetch_at = data._last_fetch_at
+    start = time.perf_counter()
+    await data.async_update()
+    latency = time.perf_counter() - start
+    fetched = data._last_fetch_at != last_fetch_at and not data._source_warning
+    return latency, fetched
+
+
+async def run(args):
+    server = server_from_arguments(args)
+    ## The GTFS-RT feed covers all monitored stops, and possibly others
+    server.feed_stops = max(args.feed_stops, args.stops)
+    url = await server.start()
+    sensor.TFI_EFA_RESOURCE = url + EFA_PATH
+    sensor.DUBLIN_BUS_RESOURCE = url + DUBLIN_BUS_PATH
+    sensor.IRISH_RAIL_RESOURCE = url + IRISH_RAIL_PATH
+    coordinator = sensor.RtpiCoordinator(
+        sensor.RtpiSessionPool(
+            min(
+                args.connections_per_host or args.max_concurrent_requests,
+                args.max_concurrent_requests,
+            )
+        ),
+        max_concurrent_requests=args.max_concurrent_requests,
+        rate_limit=args.rate_limit,
+        fetch_jitter=0,
+    )
+    sensors = make_sensors(args, url, coordinator)
+    print(
+        f"{args.sensors} sensors, {args.stops} stops, sources {args.sources}, "
+        f"server {url}"
+    )
+    try:
+        for cycle in range(1, args.cycles + 1):
+            ## Start each cycle with an empty shared cache, as after a refresh
+            ## interval has elapsed
+            sensor.DEPARTURE_CACHE = sensor.DepartureCache()
+            now = sensor.dt_util.utcnow()
+            for data in sensors:
+                data._next_fetch_at = now
+            server.reset_counts()
+            start = time.perf_counter()
+            results = await asyncio.gather(
+                *[
+                    timed_update(data, random.uniform(0, args.spread))
+                    for data in sensors
+                ]
+            )
+            elapsed = time.perf_counter() - start
+            latencies = [latency * 1000 for latency, _ in results]
+            fetched = sum(1 for _, ok in results if ok)
+            print(
+                f"cycle {cycle}: {elapsed:.2f}s, "
+                f"updated {fetched}/{len(sensors)}, latency ms "
+                f"p50 {percentile(latencies, 50):.1f} "
+                f"p90 {percentile(latencies, 90):.1f} "
+                f"p99 {percentile(latencies, 99):.1f} "
+                f"max {max(latencies):.1f}"
+            )
+            requests = server.reset_counts()
+            for (endpoint, outcome), count in sorted(requests.items()):
+                print(f"  {endpoint:<12} {outcome:<8} {count:>6}")
+            print(f"  {'total':<21} {sum(requests.values()):>6}")
+            if cycle < args.cycles:
+                await asyncio.sleep(args.interval)
+    finally:
+        await coordinator.async_close()
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sensors", type=int, default=500)
+    parser.add_argument(
+        "--stops", type=int, default=0, help="distinct stops (default: one per sensor)"
+    )
+    parser.add_argument(
+        "--sources",
+        default=sensor.RTPI_SOURCE_TFI_EFA_XML,
+        help="comma separated RTPI sources, in order of precedence",
+    )
+    parser.add_argument(
+        "--fetch-strategy",
+        default=sensor.FETCH_STRATEGY_SEQUENTIAL,
+        choices=sensor.FETCH_STRATEGIES,
+    )
+    parser.add_argument("--hedge-delay", type=float, default=sensor.DEFAULT_HEDGE_DELAY)
+    parser.add_argument(
+        "--source-order",
+        default=sensor.SOURCE_ORDER_PRECEDENCE,
+        choices=sensor.SOURCE_ORDERS,
+    )
+    parser.add_argument(
+        "--merge-sources",
+        action="store_true",
+        help="merge departures from all sources",
+    )
+    parser.add_argument(
+        "--max-concurrent-requests",
+        type=int,
+        default=sensor.DEFAULT_MAX_CONCURRENT_REQUESTS,
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=1000,
+        help="requests per second per host",
+    )
+    parser.add_argument(
+        "--connections-per-host",
+        type=int,
+        help="connections per host, at most max concurrent requests (default: max concurrent requests)",
+    )
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument(
+        "--interval", type=float, default=0, help="delay between cycles (s)"
+    )
+    parser.add_argument(
+        "--spread", type=float, default=0, help="spread sensor updates over (s)"
+    )
+    parser.add_argument("--verbose", action="store_true", help="show sensor logs")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    args.stops = args.stops or args.sensors
+    logging.basicConfig(level=logging.WARNING if args.verbose else logging.CRITICAL)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+Local stand-in for the RTPI services used by the sensor.
+
+Serves the TFI EFA departure monitor (XSLT_DM_REQUEST, JSON and XML output),
+the smartdublin realtimebusinformation endpoint, the Irish Rail
+getStationDataByCodeXML and getAllStationsXML endpoints and the NTA
+GTFS-Realtime TripUpdates feed
+with generated departures. Latency, error
+and timeout rates and payload sizes are configurable to simulate degraded
+services.
+
+Usage: python benchmarks/rtpi_server.py [--port 8080] [--latency 50]
+       [--latency-jitter 20] [--error-rate 0.01] [--timeout-rate 0.01]
+       [--departures 30] [--down dublin_bus] [--feed-stops 250]
+"""
+import argparse
+import asyncio
+import random
+import zlib
+from collections import Counter
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+from fixtures import irish_rail_stations_xml, payload
+
+EFA_PATH = "/nta/XSLT_DM_REQUEST"
+DUBLIN_BUS_PATH = "/cgi-bin/rtpi/realtimebusinformation"
+IRISH_RAIL_PATH = "/realtime/realtime.asmx"
+GTFS_RT_PATH = "/gtfsr/v2/TripUpdates"
+
+EFA_SOURCES = ["tfi_efa", "tfi_efa_xml"]
+
+## EFA stop names queried for a batch of stops
+BATCH_PREFIX = "batch"
+
+## Delay for simulated timeouts, longer than the sensor request timeout
+TIMEOUT_DELAY = 10
+
+
+class FakeRtpiServer:
+    """aiohttp application serving generated RTPI responses."""
+
+    def __init__(
+        self,
+        latency=0.05,
+        latency_jitter=0.02,
+        error_rate=0.0,
+        timeout_rate=0.0,
+        departures=30,
+        down=(),
+        batch_size=1,
+        feed_stops=250,
+        seed=None,
+    ):
+        """Initialize the server."""
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.departures = departures
+        self.down = set(down)
+        self.batch_size = batch_size
+        self.feed_stops = feed_stops
+        self.requests = Counter()
+        self._random = random.Random(seed)
+        self._payloads = {}
+        self._runner = None
+        self.url = None
+
+    def make_app(self):
+        """Return the aiohttp application."""
+        app = web.Application()
+        app.router.add_get(EFA_PATH, self._handle_efa)
+        app.router.add_get(DUBLIN_BUS_PATH, self._handle_dublin_bus)
+        app.router.add_get(
+            IRISH_RAIL_PATH + "/getStationDataByCodeXML", self._handle_irish_rail
+        )
+        app.router.add_get(
+            IRISH_RAIL_PATH + "/getAllStationsXML", self._handle_irish_rail_stations
+        )
+        app.router.add_get(GTFS_RT_PATH, self._handle_gtfs_rt)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Start serving, and return the base URL of the server."""
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        """Stop serving."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def reset_counts(self):
+        """Return and reset request counts by endpoint and outcome."""
+        requests = self.requests
+        self.requests = Counter()
+        return requests
+
+    def _payload(self, source, stop_id):
+        ## Departures for a stop are regenerated once a minute. Times are in
+        ## UTC, the sensor's time zone when run outside Home Assistant
+        now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        key = (source, stop_id)
+        cached = self._payloads.get(key)
+        if cached is None or cached[0] != now:
+            seed = zlib.crc32(stop_id.encode())
+            if source in EFA_SOURCES and stop_id.startswith(BATCH_PREFIX):
+                ## Batch k covers stops k * batch_size to (k + 1) * batch_size - 1
+                first = int(stop_id[len(BATCH_PREFIX) :]) * self.batch_size
+                stop_ids = [str(first + i) for i in range(self.batch_size)]
+                content = payload(
+                    source,
+                    self.departures * self.batch_size,
+                    now=now,
+                    seed=seed,
+                    stop_ids=stop_ids,
+                )
+            elif source == "gtfs_rt":
+                ## The feed covers stops 0 to feed_stops - 1
+                stop_ids = [str(i) for i in range(self.feed_stops)]
+                content = payload(
+                    source, self.departures, now=now, seed=seed, stop_ids=stop_ids
+                )
+            elif source == "irish_rail_stations":
+                ## Station i is named after stop i, with station code Si
+                content = irish_rail_stations_xml(
+                    (str(i), f"S{i}") for i in range(self.feed_stops)
+                )
+            elif source in EFA_SOURCES:
+                content = payload(
+                    source, self.departures, now=now, seed=seed, stop_ids=[stop_id]
+                )
+            else:
+                content = payload(source, self.departures, now=now, seed=seed)
+            cached = (now, content)
+            self._payloads[key] = cached
+        return cached[1]
+
+    async def _respond(self, name, source, stop_id, content_type):
+        delay = max(self._random.gauss(self.latency, self.latency_jitter), 0)
+        outcome = self._random.random()
+        if name in self.down or outcome < self.timeout_rate:
+            self.requests[(name, "timeout")] += 1
+            await asyncio.sleep(TIMEOUT_DELAY)
+            raise web.HTTPGatewayTimeout()
+        await asyncio.sleep(delay)
+        if outcome < self.timeout_rate + self.error_rate:
+            self.requests[(name, "error")] += 1
+            raise web.HTTPInternalServerError()
+        self.requests[(name, "ok")] += 1
+        return web.Response(
+            body=self._payload(source, stop_id),
+            content_type=content_type,
+            charset="utf-8",
+        )
+
+    async def _handle_efa(self, request):
+        stop_id = request.query.get("name_dm", "")
+        if request.query.get("outputFormat") == "XML":
+            return await self._respond(
+                "tfi_efa_xml", "tfi_efa_xml", stop_id, "text/xml"
+            )
+        return await self._respond("tfi_efa", "tfi_efa", stop_id, "application/json")
+
+    async def _handle_dublin_bus(self, request):
+        stop_id = request.query.get("stopid", "")
+        return await self._respond(
+            "dublin_bus", "dublin_bus", stop_id, "application/json"
+        )
+
+    async def _handle_irish_rail(self, request):
+        stop_id = request.query.get("StationCode", "")
+        return await self._respond("irish_rail", "irish_rail", stop_id, "text/xml")
+
+    async def _handle_irish_rail_stations(self, request):
+        return await self._respond(
+            "irish_rail_stations", "irish_rail_stations", "", "text/xml"
+        )
+
+    async def _handle_gtfs_rt(self, request):
+        return await self._respond("gtfs_rt", "gtfs_rt", "", "application/x-protobuf")
+
+
+def add_server_arguments(parser):
+    """Add the fake server options to an argument parser."""
+    parser.add_argument(
+        "--latency", type=float, default=50, help="mean response latency (ms)"
+    )
+    parser.add_argument(
+        "--latency-jitter",
+        type=float,
+        default=20,
+        help="standard deviation of response latency (ms)",
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="fraction of HTTP 500 responses"
+    )
+    parser.add_argument(
+        "--timeout-rate",
+        type=float,
+        default=0,
+        help="fraction of requests that time out",
+    )
+    parser.add_argument(
+        "--departures", type=int, default=30, help="departures per response"
+    )
+    parser.add_argument(
+        "--down",
+        default="",
+        help="comma separated sources for which all requests time out",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="stops covered by each batched EFA query",
+    )
+    parser.add_argument(
+        "--feed-stops",
+        type=int,
+        default=250,
+        help="stops covered by the GTFS-RT feed and Irish Rail station list",
+    )
+
+
+def server_from_arguments(args):
+    """Return a fake server configured from parsed arguments."""
+    return FakeRtpiServer(
+        latency=args.latency / 1000,
+        latency_jitter=args.latency_jitter / 1000,
+        error_rate=args.error_rate,
+        timeout_rate=args.timeout_rate,
+        departures=args.departures,
+        down=[source for source in args.down.split(",") if source],
+        batch_size=args.batch_size,
+        feed_stops=args.feed_stops,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    server = server_from_arguments(args)
+    web.run_app(server.make_app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,28 +7,83 @@ https://www.transportforireland.ie/transitData/PT_Data.html
 https://code.google.com/archive/p/openefa/wikis
 https://github.com/opendata-stuttgart/metaEFA
 """
+import asyncio
+import bisect
+import collections
+import csv
+import hashlib
+import heapq
+import io
+import json
 import logging
-from datetime import timedelta, datetime
+import math
+import mmap
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from array import array
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+from datetime import time as dt_time, timedelta, datetime
+from typing import NamedTuple
+from urllib.parse import urlsplit
 from abc import ABCMeta
-from pyirishrail.pyirishrail import IrishRailRTPI
+from google.transit import gtfs_realtime_pb2
 
-from xml.dom import minidom
-import requests
+from xml.etree import ElementTree
+import aiohttp
 import voluptuous as vol
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 import homeassistant.helpers.config_validation as cv
 import homeassistant.util.dt as dt_util
+import homeassistant.util.ssl as ssl_util
 from homeassistant.components.sensor import PLATFORM_SCHEMA
-from homeassistant.const import CONF_NAME, ATTR_ATTRIBUTION
+from homeassistant.const import (
+    CONF_API_KEY,
+    CONF_NAME,
+    CONF_URL,
+    ATTR_ATTRIBUTION,
+    EVENT_HOMEASSISTANT_CLOSE,
+    EntityCategory,
+)
+from homeassistant.core import callback
 from homeassistant.helpers.entity import Entity
-
-# REQUIREMENTS = ['pyirishrail==0.0.2']
+from homeassistant.helpers.event import async_call_later
+from homeassistant.helpers.storage import Store
 
 _LOGGER = logging.getLogger(__name__)
+DOMAIN = "tfi_transport"
 DUBLIN_BUS_RESOURCE = "https://data.smartdublin.ie/cgi-bin/rtpi/realtimebusinformation"
 TFI_EFA_RESOURCE = "https://journeyplanner.transportforireland.ie/nta/XSLT_DM_REQUEST"
+GTFS_RT_RESOURCE = "https://api.nationaltransport.ie/gtfsr/v2/TripUpdates"
+IRISH_RAIL_RESOURCE = "https://api.irishrail.ie/realtime/realtime.asmx"
+
+STORAGE_KEY = f"{DOMAIN}.departures"
+STORAGE_VERSION = 1
+STORAGE_SAVE_DELAY = 60
 
 RTPI_TIMEOUT = 4
+## Connect and read timeouts, which exclude time queued for a connection
+RTPI_CLIENT_TIMEOUT = aiohttp.ClientTimeout(
+    total=None, sock_connect=RTPI_TIMEOUT, sock_read=RTPI_TIMEOUT
+)
+RTPI_CHUNK_SIZE = 16384
+
+## Irish Rail station codes are refreshed once a day (in seconds)
+IRISH_RAIL_STATIONS_TTL = 86400
+
+## Upper bounds of request latency histogram buckets (in seconds)
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2, 4, math.inf]
 
 ATTR_STOP_ID = "stop_id"
 ATTR_ROUTE = "route"
@@ -63,9 +118,21 @@ CONF_SKIP_NO_RESULTS = "skip_no_results"  ## skip source if no results
 CONF_LIMIT_TIME_HORIZON = "limit_time_horizon"
 CONF_LIMIT_DEPARTURES = "limit_departures"
 CONF_SSL_VERIFY = "ssl_verify"
+CONF_BATCH_STOP_ID = "batch_stop_id"
+CONF_GTFS_PATH = "gtfs_path"
 CONF_REFRESH_INTERVAL = "refresh_interval"
 CONF_NO_DATA_REFRESH_INTERVAL = "no_data_refresh_interval"
 CONF_FAST_REFRESH_THRESHOLD = "fast_refresh_threshold"
+CONF_FETCH_STRATEGY = "fetch_strategy"
+CONF_HEDGE_DELAY = "hedge_delay"
+CONF_DEPARTURES_JSON_FORMAT = "departures_json_format"
+CONF_MAX_CONCURRENT_REQUESTS = "max_concurrent_requests"
+CONF_RATE_LIMIT = "rate_limit"
+CONF_FETCH_JITTER = "fetch_jitter"
+CONF_DIAGNOSTICS_SENSOR = "diagnostics_sensor"
+CONF_SOURCE_ORDER = "source_order"
+CONF_RECORD_DEPARTURES = "record_departures"
+CONF_MERGE_SOURCES = "merge_sources"
 
 CONF_SHOW_ROUTE = "show_route"
 CONF_SHOW_REALTIME = "show_realtime"
@@ -74,10 +141,19 @@ DEFAULT_NAME = "Transport for Ireland Departures"
 DEFAULT_REFRESH_INTERVAL = 1
 DEFAULT_NO_DATA_REFRESH_INTERVAL = 60
 DEFAULT_LIMIT_TIME_HORIZON = 90
+DEFAULT_HEDGE_DELAY = 1.0
+DEFAULT_MAX_CONCURRENT_REQUESTS = 8
+DEFAULT_RATE_LIMIT = 2.0
+DEFAULT_RATE_LIMIT_BURST = 5
+DEFAULT_FETCH_JITTER = 15
 
 ICON = "mdi:bus"
 
 SCAN_INTERVAL = timedelta(seconds=30)
+FAST_REFRESH_INTERVAL = timedelta(minutes=1)
+UPDATE_TOLERANCE = timedelta(seconds=1)
+DEPARTED_AGE = timedelta(seconds=60)
+MIN_UPDATE_DELAY = 1
 TIME_STR_FORMAT = "%H:%M"
 
 SHOW_OPTIONS = [
@@ -97,6 +173,8 @@ RTPI_SOURCE_TFI_EFA_XML = "tfi_efa_xml"
 RTPI_SOURCE_TFI_EFA = "tfi_efa"
 RTPI_SOURCE_DUBLIN_BUS = "dublin_bus"
 RTPI_SOURCE_IRISH_RAIL = "irish_rail"
+RTPI_SOURCE_GTFS_RT = "gtfs_rt"
+RTPI_SOURCE_GTFS_STATIC = "gtfs_static"
 
 # Sources are evaluated in specified order of precedence: data from later
 # sources overrides data from earlier sources
@@ -105,8 +183,81 @@ RTPI_SOURCES = [
     RTPI_SOURCE_TFI_EFA,
     RTPI_SOURCE_DUBLIN_BUS,
     RTPI_SOURCE_IRISH_RAIL,
+    RTPI_SOURCE_GTFS_RT,
+    RTPI_SOURCE_GTFS_STATIC,
+]
+
+# Sources that support batched queries for several stops
+RTPI_BATCH_SOURCES = [
+    RTPI_SOURCE_TFI_EFA_XML,
+    RTPI_SOURCE_TFI_EFA,
+]
+
+# departures_json attribute formats: a JSON encoded string, or the list of
+# departures for consumers that do not need to parse the attribute again
+DEPARTURES_JSON_FORMAT_STRING = "string"
+DEPARTURES_JSON_FORMAT_LIST = "list"
+
+DEPARTURES_JSON_FORMATS = [
+    DEPARTURES_JSON_FORMAT_STRING,
+    DEPARTURES_JSON_FORMAT_LIST,
+]
+
+# Source fetch strategies: query sources one at a time, start the next
+# source if a source has not responded within the hedge delay, or query all
+# sources at once. Results are always used in the order sources are tried.
+FETCH_STRATEGY_SEQUENTIAL = "sequential"
+FETCH_STRATEGY_HEDGED = "hedged"
+FETCH_STRATEGY_CONCURRENT = "concurrent"
+
+FETCH_STRATEGIES = [
+    FETCH_STRATEGY_SEQUENTIAL,
+    FETCH_STRATEGY_HEDGED,
+    FETCH_STRATEGY_CONCURRENT,
 ]
 
+# Source orders: use sources in order of precedence, or try the healthiest
+# sources first
+SOURCE_ORDER_PRECEDENCE = "precedence"
+SOURCE_ORDER_HEALTH = "health"
+
+SOURCE_ORDERS = [
+    SOURCE_ORDER_PRECEDENCE,
+    SOURCE_ORDER_HEALTH,
+]
+
+# Source health: success rate over the last HEALTH_WINDOW requests, and
+# circuit breaker opened after CIRCUIT_FAILURE_THRESHOLD consecutive failures
+# for an exponentially increasing backoff (in seconds)
+HEALTH_WINDOW = 20
+HEALTH_LATENCY_WEIGHT = 0.3
+HEALTH_LATENCY_STEP = 0.5
+CIRCUIT_FAILURE_THRESHOLD = 3
+CIRCUIT_BACKOFF_MIN = 30
+CIRCUIT_BACKOFF_MAX = 1800
+
+# Static GTFS timetable index: departures up to GTFS_STATIC_LOOKAHEAD ahead
+# are looked up in an index compiled next to the timetable and memory mapped.
+# Timetables are checked for updates every GTFS_STATIC_CHECK_INTERVAL seconds,
+# and departures are sorted in runs of GTFS_STATIC_COMPILE_CHUNK when compiled
+NOON = dt_time(12)
+GTFS_STATIC_LOOKAHEAD = timedelta(hours=3)
+GTFS_STATIC_CHECK_INTERVAL = 600
+GTFS_STATIC_COMPILE_CHUNK = 1 << 19
+GTFS_STATIC_COMPILE_BLOCK = 1 << 14
+GTFS_STATIC_INDEX_SUFFIX = ".tfi_transport.idx"
+GTFS_STATIC_INDEX_MAGIC = b"TFIGTFS5"
+GTFS_STATIC_HEADER = struct.Struct("<8sII")  ## magic, metadata size, count
+GTFS_STATIC_RECORD = struct.Struct("<IIIb")  ## route, headsign, service, dir
+GTFS_STATIC_RUN_RECORD = struct.Struct("<qI")  ## departure key, stop sequence
+GTFS_STATIC_TRIP_BITS = 21
+GTFS_STATIC_TIME_BITS = 19
+GTFS_STATIC_STOP_BITS = 23
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
 # CONF_RTPI_SCHEMA = vol.Schema({cv.slug: cv.string})
 
 CONF_RTPI_SOURCE_SCHEMA = vol.Schema(
@@ -121,6 +272,21 @@ CONF_RTPI_SOURCE_SCHEMA = vol.Schema(
         vol.Optional(CONF_REALTIME_ONLY, default=False): cv.boolean,
         vol.Optional(CONF_SKIP_NO_RESULTS, default=False): cv.boolean,
         vol.Optional(CONF_SSL_VERIFY, default=True): cv.boolean,
+        vol.Optional(CONF_BATCH_STOP_ID, default=""): cv.string,
+    }
+)
+
+CONF_GTFS_RT_SOURCE_SCHEMA = CONF_RTPI_SOURCE_SCHEMA.extend(
+    {
+        vol.Optional(CONF_URL, default=GTFS_RT_RESOURCE): cv.string,
+        vol.Optional(CONF_API_KEY, default=""): cv.string,
+        vol.Optional(CONF_GTFS_PATH, default=""): cv.string,
+    }
+)
+
+CONF_GTFS_STATIC_SOURCE_SCHEMA = CONF_RTPI_SOURCE_SCHEMA.extend(
+    {
+        vol.Required(CONF_GTFS_PATH): cv.string,
     }
 )
 
@@ -130,6 +296,8 @@ CONF_RTPI_SCHEMA = vol.Schema(
         vol.Optional(RTPI_SOURCE_TFI_EFA): CONF_RTPI_SOURCE_SCHEMA,
         vol.Optional(RTPI_SOURCE_DUBLIN_BUS): CONF_RTPI_SOURCE_SCHEMA,
         vol.Optional(RTPI_SOURCE_IRISH_RAIL): CONF_RTPI_SOURCE_SCHEMA,
+        vol.Optional(RTPI_SOURCE_GTFS_RT): CONF_GTFS_RT_SOURCE_SCHEMA,
+        vol.Optional(RTPI_SOURCE_GTFS_STATIC): CONF_GTFS_STATIC_SOURCE_SCHEMA,
     }
 )
 
@@ -154,11 +322,1811 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
         ): cv.positive_int,
         vol.Optional(CONF_LIMIT_DEPARTURES, default=0): cv.positive_int,
         vol.Optional(CONF_FAST_REFRESH_THRESHOLD, default=0): cv.positive_int,
+        vol.Optional(CONF_FETCH_STRATEGY, default=FETCH_STRATEGY_SEQUENTIAL): vol.In(
+            FETCH_STRATEGIES
+        ),
+        vol.Optional(CONF_HEDGE_DELAY, default=DEFAULT_HEDGE_DELAY): cv.positive_float,
+        vol.Optional(
+            CONF_DEPARTURES_JSON_FORMAT, default=DEPARTURES_JSON_FORMAT_STRING
+        ): vol.In(DEPARTURES_JSON_FORMATS),
+        vol.Optional(
+            CONF_MAX_CONCURRENT_REQUESTS, default=DEFAULT_MAX_CONCURRENT_REQUESTS
+        ): vol.All(vol.Coerce(int), vol.Range(min=1)),
+        vol.Optional(CONF_RATE_LIMIT, default=DEFAULT_RATE_LIMIT): vol.All(
+            vol.Coerce(float), vol.Range(min=0, min_included=False)
+        ),
+        vol.Optional(CONF_FETCH_JITTER, default=DEFAULT_FETCH_JITTER): cv.positive_int,
+        vol.Optional(CONF_DIAGNOSTICS_SENSOR, default=False): cv.boolean,
+        vol.Optional(CONF_SOURCE_ORDER, default=SOURCE_ORDER_PRECEDENCE): vol.In(
+            SOURCE_ORDERS
+        ),
+        vol.Optional(CONF_RECORD_DEPARTURES, default=True): cv.boolean,
+        vol.Optional(CONF_MERGE_SOURCES, default=False): cv.boolean,
     }
 )
 
 
-def setup_platform(hass, config, add_entities, discovery_info=None):
+class Departure(NamedTuple):
+    """A departure from a transit stop.
+
+    Departures are immutable; aging a departure creates a new record with an
+    updated countdown. Repeated strings are interned so that departures for
+    the same route share a single copy.
+    """
+
+    source: str
+    route: str
+    destination: str
+    origin: str
+    direction: str
+    scheduled_at: datetime
+    due_at: datetime
+    countdown: int
+    is_realtime: bool
+
+    @classmethod
+    def create(
+        cls,
+        source,
+        route,
+        destination,
+        origin,
+        direction,
+        scheduled_at,
+        due_at,
+        countdown,
+        is_realtime,
+    ):
+        """Create a departure with interned strings."""
+        return cls(
+            sys.intern(source),
+            sys.intern(str(route)),
+            sys.intern(str(destination)),
+            sys.intern(str(origin)),
+            sys.intern(str(direction)),
+            scheduled_at,
+            due_at,
+            countdown,
+            is_realtime,
+        )
+
+    def countdown_at(self, now):
+        """Return the countdown in minutes at now, or None if departed."""
+        seconds = (self.due_at - now).total_seconds()
+        if seconds >= 60:
+            return int(round(seconds / 60))
+        if seconds >= -DEPARTED_AGE.total_seconds():
+            return 0
+        return None
+
+    @staticmethod
+    def group_by_stop(stop_departures):
+        """Group (stop_id, departure) pairs by stop ID, sorted by due time."""
+        departures = {}
+        for stop_id, dep in sorted(stop_departures, key=lambda a: a[1].due_at):
+            departures.setdefault(stop_id, []).append(dep)
+        return departures
+
+    @staticmethod
+    def merge(source_departures):
+        """
+        Merge departures from several sources, in order of precedence.
+
+        Departures are joined on route, scheduled time and destination with
+        a hash table in a single pass over the departures of all sources. The
+        first departure for each key is kept, overlaid with the due time of
+        the first real-time departure for the key if it is not real-time.
+        """
+        merged = []
+        positions = {}
+        for departures in source_departures:
+            for dep in departures:
+                key = (
+                    dep.route,
+                    dep.scheduled_at.replace(second=0, microsecond=0),
+                    dep.destination,
+                )
+                position = positions.get(key)
+                if position is None:
+                    positions[key] = len(merged)
+                    merged.append(dep)
+                    continue
+                first = merged[position]
+                if dep.is_realtime and not first.is_realtime:
+                    merged[position] = first._replace(
+                        source=dep.source,
+                        origin=first.origin or dep.origin,
+                        due_at=dep.due_at,
+                        countdown=dep.countdown,
+                        is_realtime=True,
+                    )
+        ## Departures from each source are already sorted by due time
+        merged.sort(key=lambda a: a.due_at)
+        return merged
+
+    @classmethod
+    def from_compact(cls, source, dep):
+        """Create a departure from its compact storage representation."""
+        (
+            route,
+            destination,
+            origin,
+            direction,
+            scheduled_at,
+            due_at,
+            countdown,
+            is_realtime,
+        ) = dep
+        return cls.create(
+            source,
+            route,
+            destination,
+            origin,
+            direction,
+            dt_util.as_local(dt_util.utc_from_timestamp(scheduled_at)),
+            dt_util.as_local(dt_util.utc_from_timestamp(due_at)),
+            countdown,
+            is_realtime,
+        )
+
+    def to_compact(self):
+        """Return a compact representation of the departure for storage."""
+        return [
+            self.route,
+            self.destination,
+            self.origin,
+            self.direction,
+            self.scheduled_at.timestamp(),
+            self.due_at.timestamp(),
+            self.countdown,
+            self.is_realtime,
+        ]
+
+    def as_dict(self):
+        """Return departure as a dict keyed by departure attribute names."""
+        return {
+            ATTR_SOURCE: self.source,
+            ATTR_ROUTE: self.route,
+            ATTR_DESTINATION: self.destination,
+            ATTR_ORIGIN: self.origin,
+            ATTR_DIRECTION: self.direction,
+            ATTR_SCHEDULED_AT: self.scheduled_at,
+            ATTR_DUE_AT: self.due_at,
+            ATTR_COUNTDOWN: self.countdown,
+            ATTR_IS_REALTIME: self.is_realtime,
+        }
+
+
+def encode_json(obj):
+    """Encode obj as compact JSON, using orjson if it is available."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def gtfs_rt_feed_path(url):
+    """Return the path of a local GTFS-RT feed file, or None for a feed URL."""
+    parts = urlsplit(url)
+    if parts.scheme in ("http", "https"):
+        return None
+    if parts.scheme == "file":
+        return parts.path
+    return url
+
+
+def gtfs_rt_due_time(stop_time_updates, stop_id, sequence, scheduled):
+    """
+    Return the predicted POSIX time of a call of a trip at a stop, or None.
+
+    scheduled is the scheduled time of the call, at stop sequence sequence of
+    the trip. An update for the stop predicts its time, or its delay. Otherwise
+    the delay of the nearest earlier stop updated carries forward, as stop time
+    updates must be sorted by stop sequence. Updates for other stops without a
+    stop sequence cannot be placed in the trip, so are not carried forward.
+    """
+    skipped = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SKIPPED
+    stop_scheduled = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SCHEDULED
+    earlier = None
+    for stop_time in stop_time_updates:
+        if stop_time.HasField("stop_sequence"):
+            if stop_time.stop_sequence > sequence:
+                break
+            if stop_time.stop_sequence < sequence:
+                if stop_time.schedule_relationship != skipped:
+                    earlier = stop_time
+                continue
+        elif stop_time.stop_id != stop_id:
+            continue
+        ## Update for the stop itself
+        if stop_time.schedule_relationship != stop_scheduled:
+            return None
+        event = stop_time.departure
+        if not stop_time.HasField("departure"):
+            event = stop_time.arrival
+        if event.time:
+            return event.time
+        if event.HasField("delay"):
+            return scheduled + event.delay
+        return None
+    if earlier is None or earlier.schedule_relationship != stop_scheduled:
+        return None
+    event = earlier.departure
+    if not event.HasField("delay"):
+        event = earlier.arrival
+    if not event.HasField("delay"):
+        return None
+    return scheduled + event.delay
+
+
+class TimestampDecoder:
+    """
+    Decoder for the timestamps in a source response.
+
+    Sources report local times in the Home Assistant time zone. Times are
+    decoded relative to a single reference time taken when the response is
+    retrieved, and times repeated within a response are only decoded once.
+    Decoded times are timezone aware, so countdowns remain correct across
+    daylight saving time changes.
+    """
+
+    def __init__(self, now=None):
+        """Initialize the decoder."""
+        self._now = dt_util.as_local(now or dt_util.utcnow()).replace(
+            second=0, microsecond=0
+        )
+        self._tz = self._now.tzinfo
+        self._decoded = {}
+
+    @property
+    def now(self):
+        """Return the reference time, truncated to the minute."""
+        return self._now
+
+    def _local(self, year, month, day, hour, minute, second=0):
+        ## Round trip through UTC to resolve times skipped by a DST change
+        return dt_util.as_utc(
+            datetime(year, month, day, hour, minute, second, tzinfo=self._tz)
+        ).astimezone(self._tz)
+
+    def time(self, t):
+        """Decode a HH:MM time to the matching time nearest to now."""
+        decoded = self._decoded.get(t)
+        if decoded is None:
+            now = self._now
+            hour, _, minute = t.partition(":")
+            decoded = datetime(
+                now.year, now.month, now.day, int(hour), int(minute), tzinfo=self._tz
+            )
+            if decoded < now - timedelta(hours=12):  # time refers to next day
+                decoded += timedelta(days=1)
+            elif decoded > now + timedelta(hours=12):  # adjust for clock skew
+                decoded -= timedelta(days=1)
+            decoded = self._local(
+                decoded.year,
+                decoded.month,
+                decoded.day,
+                decoded.hour,
+                decoded.minute,
+            )
+            self._decoded[t] = decoded
+        return decoded
+
+    def datestamp(self, t):
+        """Decode a dd/mm/YYYY HH:MM:SS timestamp."""
+        decoded = self._decoded.get(t)
+        if decoded is None:
+            decoded = self._local(
+                int(t[6:10]),
+                int(t[3:5]),
+                int(t[0:2]),
+                int(t[11:13]),
+                int(t[14:16]),
+                int(t[17:19]),
+            )
+            self._decoded[t] = decoded
+        return decoded
+
+    def efa_json(self, dt_json):
+        """Decode a TFI EFA JSON dateTime object."""
+        key = (
+            dt_json["year"],
+            dt_json["month"],
+            dt_json["day"],
+            dt_json["hour"],
+            dt_json["minute"],
+        )
+        decoded = self._decoded.get(key)
+        if decoded is None:
+            decoded = self._local(*map(int, key))
+            self._decoded[key] = decoded
+        return decoded
+
+    def efa_xml(self, dt_xml):
+        """Decode a TFI EFA XML itdDateTime element."""
+        date = time = None
+        for child in dt_xml:
+            if child.tag == "itdDate":
+                date = child.attrib
+            elif child.tag == "itdTime":
+                time = child.attrib
+        key = (date["year"], date["month"], date["day"], time["hour"], time["minute"])
+        decoded = self._decoded.get(key)
+        if decoded is None:
+            decoded = self._local(*map(int, key))
+            self._decoded[key] = decoded
+        return decoded
+
+    def epoch(self, seconds):
+        """Decode a POSIX timestamp."""
+        decoded = self._decoded.get(seconds)
+        if decoded is None:
+            decoded = datetime.fromtimestamp(seconds, self._tz)
+            self._decoded[seconds] = decoded
+        return decoded
+
+    def countdown(self, minutes):
+        """Return the time a countdown in minutes from now expires."""
+        decoded = self._decoded.get(minutes)
+        if decoded is None:
+            decoded = (
+                dt_util.as_utc(self._now) + timedelta(minutes=minutes)
+            ).astimezone(self._tz)
+            self._decoded[minutes] = decoded
+        return decoded
+
+
+class DepartureIndex:
+    """
+    Index of the departures for a stop by route and direction.
+
+    The index is built once for each set of departures retrieved for a stop,
+    so that sensors for the stop that filter on routes or directions select
+    their departures without scanning all departures for the stop. Selections
+    are kept for the lifetime of the index, as sensors filter the same
+    departures again each time their countdowns change.
+    """
+
+    def __init__(self, departures):
+        """Initialize the index."""
+        self._departures = tuple(departures)
+        self._positions = {}
+        self._selections = {}
+        for position, dep in enumerate(self._departures):
+            self._positions.setdefault((dep.route, dep.direction), []).append(position)
+
+    def select(self, routes, directions):
+        """
+        Return an iterator over the departures on routes and in directions,
+        in their original order.
+
+        routes and directions are frozensets, or None to select all values.
+        """
+        selection = self._selections.get((routes, directions))
+        if selection is None:
+            positions = [
+                self._positions[key]
+                for key in self._positions
+                if (routes is None or key[0] in routes)
+                and (directions is None or key[1] in directions)
+            ]
+            departures = self._departures
+            selection = tuple(
+                departures[position] for position in heapq.merge(*positions)
+            )
+            self._selections[(routes, directions)] = selection
+        return iter(selection)
+
+
+class DepartureFilter:
+    """Departure filter compiled from the configuration of a source."""
+
+    def __init__(self, source_data, limit_time_horizon, limit_departures):
+        """Initialize the filter."""
+        route_list = source_data[CONF_ROUTE_LIST]
+        route = source_data[CONF_ROUTE]
+        if route_list == [] and route != "":
+            route_list = [route]
+        direction = source_data[CONF_DIRECTION]
+        self._routes = frozenset(route_list) if route_list else None
+        self._directions = frozenset(direction) if direction else None
+        self._direction_inverse = source_data[CONF_DIRECTION_INVERSE]
+        self._realtime_only = source_data[CONF_REALTIME_ONLY]
+        self._limit_time_horizon = limit_time_horizon
+        self._limit_departures = limit_departures
+
+    def __str__(self):
+        """Return a description of the filter."""
+        return (
+            f"realtime_only: {self._realtime_only}, "
+            f"route_list: {sorted(self._routes or [])}, "
+            f"direction: {sorted(self._directions or [])} "
+            f"(inverse: {self._direction_inverse}), "
+            f"limit_time_horizon: {self._limit_time_horizon}, "
+            f"limit_departures: {self._limit_departures}"
+        )
+
+    def select(self, index):
+        """
+        Return the departures in an index that may pass the filter.
+
+        Returns None if the index cannot narrow down the departures.
+        """
+        directions = None if self._direction_inverse else self._directions
+        if self._routes is None and directions is None:
+            return None
+        return index.select(self._routes, directions)
+
+    def apply(self, departures, now):
+        """
+        Return departures that pass the filter, up to the departure limit.
+
+        Departures must be sorted by due time. Countdowns are calculated at
+        now only for departures that pass the other filters.
+        """
+        routes = self._routes
+        directions = self._directions
+        direction_inverse = self._direction_inverse
+        realtime_only = self._realtime_only
+        limit_time_horizon = self._limit_time_horizon
+        limit_departures = self._limit_departures
+        filtered = []
+        for dep in departures:
+            if realtime_only and not dep.is_realtime:
+                continue
+            if routes is not None and dep.route not in routes:
+                continue
+            if directions is not None and (
+                (dep.direction in directions) == direction_inverse
+            ):
+                continue
+            countdown = dep.countdown_at(now)
+            if countdown is None:
+                continue
+            if limit_time_horizon and countdown > limit_time_horizon:
+                ## Later departures are all outside the time horizon
+                break
+            if countdown != dep.countdown:
+                dep = dep._replace(countdown=countdown)
+            filtered.append(dep)
+            if len(filtered) == limit_departures:
+                break
+        return filtered
+
+
+class DepartureCache:
+    """Process-wide cache of unfiltered departures keyed by (source, stop_id).
+
+    Sensors that share a stop but filter on different routes or directions
+    reuse the departures downloaded by whichever sensor refreshed first.
+    Sensors acquire the stops they use, and departures for a stop are
+    dropped when the last sensor using it is removed.
+    """
+
+    def __init__(self):
+        """Initialize the cache."""
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._users = collections.Counter()
+        self._listeners = []
+
+    def acquire(self, source, stop_id):
+        """Add a user of the departures for a stop."""
+        with self._lock:
+            self._users[(source, stop_id)] += 1
+
+    def release(self, source, stop_id):
+        """Remove a user of the departures for a stop."""
+        with self._lock:
+            self._users[(source, stop_id)] -= 1
+            if self._users[(source, stop_id)] > 0:
+                return
+            del self._users[(source, stop_id)]
+            self._entries.pop((source, stop_id), None)
+
+    def is_used(self, source, stop_id):
+        """Return True if a sensor uses the departures for a stop."""
+        with self._lock:
+            return self._users[(source, stop_id)] > 0
+
+    def add_listener(self, listener):
+        """Add a listener called whenever departures are stored."""
+        self._listeners.append(listener)
+
+    def get(self, source, stop_id, max_age):
+        """Return cached departures if younger than max_age seconds."""
+        with self._lock:
+            entry = self._entries.get((source, stop_id))
+        if entry is None:
+            return None
+        fetched_at, departures, _ = entry
+        if time.monotonic() - fetched_at >= max_age:
+            return None
+        return list(departures)
+
+    def get_index(self, source, stop_id):
+        """Return the index of the cached departures for a stop."""
+        with self._lock:
+            entry = self._entries.get((source, stop_id))
+        return entry[2] if entry is not None else None
+
+    def set(self, source, stop_id, departures, fetched_at):
+        """Store departures fetched at monotonic time fetched_at."""
+        entry = (fetched_at, list(departures), DepartureIndex(departures))
+        with self._lock:
+            current = self._entries.get((source, stop_id))
+            if current is None or current[0] <= fetched_at:
+                self._entries[(source, stop_id)] = entry
+        for listener in self._listeners:
+            listener()
+
+    def items(self):
+        """Return cached departures keyed by (source, stop_id)."""
+        with self._lock:
+            return {key: entry[1] for key, entry in self._entries.items()}
+
+
+DEPARTURE_CACHE = DepartureCache()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into a single call.
+
+    Callers that arrive while a call for their key is outstanding wait for it
+    and share its result, or its exception.
+    """
+
+    def __init__(self):
+        """Initialize the call registry."""
+        self._async_calls = {}
+
+    async def async_do(self, key, func, *args, admit=None):
+        """
+        Await func(*args), or wait for the outstanding call for key.
+
+        admit is called before a new call is made, and raises to refuse it.
+        Callers waiting for an outstanding call are not admitted again.
+        """
+        task = self._async_calls.get(key)
+        if task is None:
+            if admit is not None:
+                admit()
+            task = asyncio.ensure_future(func(*args))
+            self._async_calls[key] = task
+            task.add_done_callback(lambda task: self._async_call_done(key, task))
+        ## A cancelled caller does not cancel the call for other callers
+        return await asyncio.shield(task)
+
+    def _async_call_done(self, key, task):
+        if self._async_calls.get(key) is task:
+            del self._async_calls[key]
+        if not task.cancelled():
+            task.exception()  # retrieve exception if all callers were cancelled
+
+
+SOURCE_REQUESTS = SingleFlight()
+
+## Stops sharing each batched request, keyed by (source, batch_stop_id), with
+## the number of sensors using each stop
+BATCH_STOPS = collections.defaultdict(collections.Counter)
+
+
+class HttpStatusError(Exception):
+    """Error for a source response with an unsuccessful HTTP status."""
+
+    def __init__(self, status):
+        """Initialize the error for status."""
+        super().__init__(f"HTTP status: {status}")
+        self.status = status
+
+
+class FetchSample:
+    """Measurements taken while retrieving departures from a source."""
+
+    __slots__ = ("bytes", "parse_time")
+
+    def __init__(self):
+        """Initialize the sample."""
+        self.bytes = None
+        self.parse_time = 0.0
+
+    def add_bytes(self, count):
+        """Add to the number of bytes downloaded."""
+        self.bytes = (self.bytes or 0) + count
+
+    @contextmanager
+    def parsing(self):
+        """Add the time spent in the block to the parse time."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.parse_time += time.perf_counter() - start
+
+
+class SourceMetrics:
+    """
+    Request metrics for each source and stop.
+
+    Metrics are recorded for requests made to sources, so requests shared by
+    several sensors for the same stop are only counted once.
+    """
+
+    def __init__(self):
+        """Initialize the metrics."""
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    @staticmethod
+    def error_type(e):
+        """Return the category of an error retrieving a source."""
+        if isinstance(e, asyncio.TimeoutError):
+            return "timeout"
+        if isinstance(e, aiohttp.ClientError):
+            return "connection"
+        if isinstance(e, (ValueError, KeyError, TypeError, ElementTree.ParseError)):
+            return "parse"
+        if isinstance(e, HttpStatusError):
+            return "http"
+        return "other"
+
+    def _entry(self, source, stop_id):
+        entry = self._metrics.get((source, stop_id))
+        if entry is None:
+            entry = {
+                "requests": 0,
+                "errors": {},
+                "latency_buckets": {str(le): 0 for le in LATENCY_BUCKETS},
+                "latency_sum": 0.0,
+                "latency_last": None,
+                "bytes_total": 0,
+                "bytes_last": None,
+                "parse_time_sum": 0.0,
+                "parse_time_last": None,
+                "departures_last": None,
+                "cache_hits": 0,
+                "chosen": 0,
+            }
+            self._metrics[(source, stop_id)] = entry
+        return entry
+
+    def record_request(self, source, stop_id, latency, sample, departures=None, e=None):
+        """Record a completed request, and the error if it failed."""
+        with self._lock:
+            entry = self._entry(source, stop_id)
+            entry["requests"] += 1
+            for le in LATENCY_BUCKETS:
+                if latency <= le:
+                    entry["latency_buckets"][str(le)] += 1
+                    break
+            entry["latency_sum"] += latency
+            entry["latency_last"] = latency
+            if sample.bytes is not None:
+                entry["bytes_total"] += sample.bytes
+                entry["bytes_last"] = sample.bytes
+            if e is not None:
+                error_type = self.error_type(e)
+                entry["errors"][error_type] = entry["errors"].get(error_type, 0) + 1
+                return
+            entry["parse_time_sum"] += sample.parse_time
+            entry["parse_time_last"] = sample.parse_time
+            if isinstance(departures, dict):
+                ## Batched requests return departures keyed by stop
+                entry["departures_last"] = sum(map(len, departures.values()))
+            elif departures is not None:
+                entry["departures_last"] = len(departures)
+
+    def record_cache_hit(self, source, stop_id):
+        """Record departures for a stop taken from the shared cache."""
+        with self._lock:
+            self._entry(source, stop_id)["cache_hits"] += 1
+
+    def record_chosen(self, source, stop_id):
+        """Record a source being chosen for a sensor."""
+        with self._lock:
+            self._entry(source, stop_id)["chosen"] += 1
+
+    def get(self, source, stop_id):
+        """Return a copy of the metrics for a source and stop."""
+        with self._lock:
+            entry = self._entry(source, stop_id)
+            return {
+                **entry,
+                "errors": dict(entry["errors"]),
+                "latency_buckets": dict(entry["latency_buckets"]),
+            }
+
+
+SOURCE_METRICS = SourceMetrics()
+
+
+class SourceHealth:
+    """
+    Health of a source host, with a circuit breaker for failing services.
+
+    After CIRCUIT_FAILURE_THRESHOLD consecutive failures the circuit is
+    opened and requests to the source are refused until the backoff has
+    elapsed. A single probe request is then allowed (half open): the circuit
+    closes if it succeeds, otherwise it opens again with double the backoff.
+    Only errors of the service count as failures, so that a misconfigured
+    stop does not open the circuit for all stops.
+    """
+
+    def __init__(self, source):
+        """Initialize the source health."""
+        self._source = source
+        self._lock = threading.Lock()
+        self._results = collections.deque(maxlen=HEALTH_WINDOW)
+        self._latency = None
+        self._failures = 0
+        self._state = CIRCUIT_CLOSED
+        self._backoff = 0
+        self._open_until = 0
+        self._probe_at = None
+
+    def allow_request(self):
+        """Return True if a request may be made to the source."""
+        with self._lock:
+            if self._state == CIRCUIT_CLOSED:
+                return True
+            now = time.monotonic()
+            if self._state == CIRCUIT_OPEN and now >= self._open_until:
+                self._state = CIRCUIT_HALF_OPEN
+                self._probe_at = None
+            if self._state == CIRCUIT_HALF_OPEN and (
+                ## Allow another probe if a probe was never completed
+                self._probe_at is None
+                or now >= self._probe_at + CIRCUIT_BACKOFF_MIN
+            ):
+                self._probe_at = now
+                return True
+            return False
+
+    @staticmethod
+    def is_failure(e):
+        """Return True if an error retrieving a source is a service failure."""
+        if isinstance(e, HttpStatusError):
+            ## HTTP errors other than 5xx are caused by the request
+            return e.status >= 500
+        return SourceMetrics.error_type(e) in ("timeout", "connection")
+
+    def record(self, success, latency):
+        """Record the result of a request to the source."""
+        with self._lock:
+            self._results.append(success)
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency += HEALTH_LATENCY_WEIGHT * (latency - self._latency)
+            if success:
+                if self._state != CIRCUIT_CLOSED:
+                    _LOGGER.info(f"Source {self._source} recovered")
+                self._failures = 0
+                self._state = CIRCUIT_CLOSED
+                self._backoff = 0
+                return
+            self._failures += 1
+            if (
+                self._state == CIRCUIT_HALF_OPEN
+                or self._failures >= CIRCUIT_FAILURE_THRESHOLD
+            ):
+                if self._backoff:
+                    self._backoff = min(self._backoff * 2, CIRCUIT_BACKOFF_MAX)
+                else:
+                    self._backoff = CIRCUIT_BACKOFF_MIN
+                self._open_until = time.monotonic() + self._backoff
+                if self._state != CIRCUIT_OPEN:
+                    _LOGGER.warning(
+                        f"Source {self._source} failing, not retrying for "
+                        f"{self._backoff} seconds"
+                    )
+                self._state = CIRCUIT_OPEN
+
+    def success_rate(self):
+        """Return the fraction of recent requests that succeeded."""
+        with self._lock:
+            if not self._results:
+                return 1.0
+            return sum(self._results) / len(self._results)
+
+    def sort_key(self):
+        """Return a key that sorts healthier sources first."""
+        success_rate = self.success_rate()
+        with self._lock:
+            latency = self._latency or 0
+            return (
+                self._state == CIRCUIT_OPEN,
+                -round(success_rate, 1),
+                math.ceil(latency / HEALTH_LATENCY_STEP),
+            )
+
+    def as_dict(self):
+        """Return the source health for diagnostics."""
+        success_rate = self.success_rate()
+        with self._lock:
+            return {
+                "success_rate": success_rate,
+                "latency": self._latency,
+                "circuit": self._state,
+                "consecutive_failures": self._failures,
+                "backoff": self._backoff,
+            }
+
+
+## Health of each source, keyed by (source, host)
+SOURCE_HEALTH = {}
+
+
+def get_source_health(source, host):
+    """Return the health of a source host, creating it on first use."""
+    health = SOURCE_HEALTH.get((source, host))
+    if health is None:
+        health = SourceHealth(f"{source} ({host})" if host else source)
+        SOURCE_HEALTH[(source, host)] = health
+    return health
+
+
+class RtpiSessionPool:
+    """Pooled keep-alive HTTP sessions shared by all RTPI sources.
+
+    One session is kept per ssl_verify setting so that connections
+    established with certificate verification disabled are never reused
+    for sources that require it. Each session has its own connector, which
+    limits connections to each host to connections_per_host. Within Home
+    Assistant, sessions use Home Assistant's SSL contexts and are closed
+    when Home Assistant shuts down.
+    """
+
+    def __init__(self, connections_per_host=DEFAULT_MAX_CONCURRENT_REQUESTS, hass=None):
+        """Initialize the session pool."""
+        self._connections_per_host = connections_per_host
+        self._hass = hass
+        self._async_sessions = {}
+        if hass is not None:
+
+            async def async_close_pool(event):
+                await self.async_close()
+
+            hass.bus.async_listen_once(EVENT_HOMEASSISTANT_CLOSE, async_close_pool)
+
+    def async_get_session(self, ssl_verify):
+        """Return the shared aiohttp session for the ssl_verify setting."""
+        session = self._async_sessions.get(ssl_verify)
+        if session is None or session.closed:
+            if self._hass is None:
+                ssl = None if ssl_verify else False
+            elif ssl_verify:
+                ssl = ssl_util.get_default_context()
+            else:
+                ssl = ssl_util.get_default_no_verify_context()
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self._connections_per_host,
+                ssl=ssl,
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=RTPI_CLIENT_TIMEOUT,
+            )
+            self._async_sessions[ssl_verify] = session
+        return session
+
+    def async_get(self, url, params, ssl_verify, headers=None):
+        """Perform a GET request on a pooled aiohttp session.
+
+        Returns an async context manager for the response.
+        """
+        return self.async_get_session(ssl_verify).get(
+            url, params=params, headers=headers
+        )
+
+    async def async_close(self):
+        """Close all pooled sessions."""
+        async_sessions = list(self._async_sessions.values())
+        self._async_sessions = {}
+        for session in async_sessions:
+            await session.close()
+
+
+class EfaXmlDepartureParser:
+    """
+    Incremental parser for TFI EFA XML departure monitor responses.
+
+    Each itdDeparture element is converted to a departure as soon as it has
+    been parsed and is then discarded, so the full document tree is never
+    held in memory.
+    """
+
+    def __init__(self, convert_datetime):
+        """Initialize the parser."""
+        self._convert_datetime = convert_datetime
+        self._parser = ElementTree.XMLPullParser(events=("start", "end"))
+        self._departure_list = None
+        self._departures = []
+
+    def feed(self, data):
+        """Parse a chunk of the response."""
+        self._parser.feed(data)
+        self._process_events()
+
+    def close(self, by_stop=False):
+        """
+        Finish parsing and return departures sorted by due time.
+
+        If by_stop is set, departures are returned keyed by stop ID.
+        """
+        self._parser.close()
+        self._process_events()
+        if by_stop:
+            return Departure.group_by_stop(self._departures)
+        self._departures.sort(key=lambda a: a[1].due_at)
+        return [dep for _, dep in self._departures]
+
+    def _process_events(self):
+        for event, elem in self._parser.read_events():
+            if event == "start":
+                if elem.tag == "itdDepartureList":
+                    self._departure_list = elem
+            elif elem.tag == "itdDeparture":
+                self._departures.append(
+                    (elem.get("stopID"), self._parse_departure(elem))
+                )
+                elem.clear()
+                if self._departure_list is not None:
+                    self._departure_list.remove(elem)
+
+    def _parse_departure(self, dep):
+        itdServingLine = dep.find("itdServingLine")
+        line_attrs = itdServingLine.attrib
+        line_divaparams = itdServingLine.find("motDivaParams").attrib
+        route = line_attrs["number"]
+        destination = line_attrs["direction"]
+        origin = line_attrs["directionFrom"]
+        countdown = int(dep.attrib["countdown"])
+        is_realtime = line_attrs["realtime"] == "1"
+        direction = line_divaparams["direction"]
+        scheduled_at = self._convert_datetime(dep.find("itdDateTime"))
+        due_at = scheduled_at
+        if is_realtime:
+            itdRTDateTime = dep.find("itdRTDateTime")
+            # itRTDateTime does not always seem to be present for
+            # departures flagged realtime
+            if itdRTDateTime is not None:
+                due_at = self._convert_datetime(itdRTDateTime)
+            else:
+                is_realtime = False
+
+        return Departure.create(
+            "tfi_efa_xml",
+            route,
+            destination,
+            origin,
+            direction,
+            scheduled_at,
+            due_at,
+            countdown,
+            is_realtime,
+        )
+
+
+class IrishRailStations:
+    """
+    Cache of Irish Rail station codes shared by all sensors.
+
+    Station data is requested by station code. The list of stations rarely
+    changes, so it is retrieved at most once per IRISH_RAIL_STATIONS_TTL and
+    station names configured as stop IDs are looked up in the cached list.
+    """
+
+    def __init__(self):
+        """Initialize the station cache."""
+        self._codes = {}
+        self._fetched_at = None
+
+    def is_loaded(self):
+        """Return True if the station list has been retrieved."""
+        return self._fetched_at is not None
+
+    def is_fresh(self):
+        """Return True if the station list was retrieved recently."""
+        return (
+            self._fetched_at is not None
+            and time.monotonic() - self._fetched_at < IRISH_RAIL_STATIONS_TTL
+        )
+
+    def update(self, content):
+        """Replace the cached stations with a getAllStationsXML response."""
+        codes = {}
+        for station in ElementTree.fromstring(content):
+            fields = {child.tag.rpartition("}")[2]: child.text for child in station}
+            code = (fields.get("StationCode") or "").strip()
+            if not code:
+                continue
+            codes[code.casefold()] = code
+            for name in (fields.get("StationDesc"), fields.get("StationAlias")):
+                if name:
+                    codes[name.strip().casefold()] = code
+        self._codes = codes
+        self._fetched_at = time.monotonic()
+
+    def get_code(self, name):
+        """Return the station code for a station name, alias or code."""
+        code = self._codes.get(name.strip().casefold())
+        if code is None:
+            raise Exception(f"unknown Irish Rail station {name}")
+        return code
+
+
+IRISH_RAIL_STATIONS = IrishRailStations()
+
+
+class IrishRailStationDataParser:
+    """
+    Incremental parser for Irish Rail station data responses.
+
+    Each objStationData element is converted to a departure as soon as it
+    has been parsed and is then discarded. Trains that are not heading in
+    the requested directions are skipped without being converted.
+    """
+
+    def __init__(self, convert_time, directions=None, direction_inverse=False):
+        """Initialize the parser."""
+        self._convert_time = convert_time
+        self._directions = frozenset(directions) if directions else None
+        self._direction_inverse = direction_inverse
+        self._parser = ElementTree.XMLPullParser(events=("start", "end"))
+        self._station_list = None
+        self._departures = []
+
+    def feed(self, data):
+        """Parse a chunk of the response."""
+        self._parser.feed(data)
+        self._process_events()
+
+    def close(self):
+        """Finish parsing and return departures sorted by due time."""
+        self._parser.close()
+        self._process_events()
+        self._departures.sort(key=lambda a: a.due_at)
+        return self._departures
+
+    def _process_events(self):
+        for event, elem in self._parser.read_events():
+            if event == "start":
+                if self._station_list is None:
+                    self._station_list = elem
+            elif elem.tag.rpartition("}")[2] == "objStationData":
+                train = {
+                    child.tag.rpartition("}")[2]: child.text or "" for child in elem
+                }
+                direction = train.get("Direction", "")
+                if (
+                    self._directions is None
+                    or (direction in self._directions) != self._direction_inverse
+                ):
+                    self._departures.append(self._parse_train(train, direction))
+                elem.clear()
+                self._station_list.remove(elem)
+
+    def _parse_train(self, train, direction):
+        ## Departure times are 00:00 for trains terminating at the station
+        scheduled_at = train["Schdepart"]
+        if scheduled_at == "00:00":
+            scheduled_at = train["Scharrival"]
+        due_at = train["Expdepart"]
+        if due_at == "00:00":
+            due_at = train["Exparrival"]
+        return Departure.create(
+            "irish_rail",
+            train["Traintype"],
+            train["Destination"],
+            train["Origin"],
+            direction,
+            self._convert_time(scheduled_at),
+            self._convert_time(due_at),
+            int(train["Duein"]),
+            True,
+        )
+
+
+@contextmanager
+def open_gtfs_table(gtfs_path, name):
+    """
+    Open a table of a GTFS timetable directory or zip file.
+
+    Yields column numbers keyed by column name and a CSV reader for the rows,
+    or no columns and no rows if the table is not present.
+    """
+    with ExitStack() as stack:
+        if os.path.isdir(gtfs_path):
+            path = os.path.join(gtfs_path, name)
+            if not os.path.exists(path):
+                yield {}, iter(())
+                return
+            f = stack.enter_context(open(path, encoding="utf-8-sig", newline=""))
+        else:
+            archive = stack.enter_context(zipfile.ZipFile(gtfs_path))
+            if name not in archive.namelist():
+                yield {}, iter(())
+                return
+            f = stack.enter_context(
+                io.TextIOWrapper(archive.open(name), encoding="utf-8-sig", newline="")
+            )
+        reader = csv.reader(f)
+        header = next(reader, [])
+        yield {column.strip(): i for i, column in enumerate(header)}, reader
+
+
+def gtfs_seconds(t):
+    """Convert a GTFS H:MM:SS time, which may be after 24:00:00, to seconds."""
+    return int(t[:-6]) * 3600 + int(t[-5:-3]) * 60 + int(t[-2:])
+
+
+class GtfsStaticIndex:
+    """
+    Memory mapped index of the departures in a static GTFS timetable.
+
+    The timetable is compiled once into an index file holding the departure
+    times of all stops, sorted by stop and time, followed by a fixed size
+    record of the route, headsign, service and direction of each departure.
+    Departures for a stop are found by a binary search on the memory mapped
+    departure times, without loading the timetable into memory. The records
+    of all trips follow, sorted by a hash of their trip ID, so that trips in
+    real-time feeds are found by a binary search in the same way, followed by
+    the trip number and stop sequence of each departure.
+    """
+
+    def __init__(self, index_path):
+        """Open and memory map a compiled index."""
+        with open(index_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, metadata_size, count = GTFS_STATIC_HEADER.unpack_from(self._mmap)
+        if magic != GTFS_STATIC_INDEX_MAGIC:
+            raise Exception(f"{index_path}: not a GTFS timetable index")
+        offset = GTFS_STATIC_HEADER.size
+        metadata = json.loads(self._mmap[offset : offset + metadata_size])
+        self.source_mtime = metadata["source_mtime"]
+        self._strings = metadata["strings"]
+        self._routes = metadata["routes"]
+        self._stops = metadata["stops"]
+        self._services = metadata["services"]
+        self._exceptions = {
+            int(service): dates for service, dates in metadata["exceptions"].items()
+        }
+        self._active_services = {}
+        offset = (offset + metadata_size + 3) & ~3
+        self._times = memoryview(self._mmap)[offset : offset + count * 4].cast("i")
+        self._records_offset = offset + count * 4
+        trip_count = metadata["trips"]
+        offset = (self._records_offset + count * GTFS_STATIC_RECORD.size + 7) & ~7
+        self._trip_hashes = memoryview(self._mmap)[
+            offset : offset + trip_count * 8
+        ].cast("q")
+        self._trip_records_offset = offset + trip_count * 8
+        offset = self._trip_records_offset + trip_count * GTFS_STATIC_RECORD.size
+        offset = (offset + 3) & ~3
+        self._departure_trips = memoryview(self._mmap)[
+            offset : offset + count * 4
+        ].cast("I")
+        offset += count * 4
+        self._sequences = memoryview(self._mmap)[offset : offset + count * 4].cast("I")
+        self._stop_trips = {}
+
+    @staticmethod
+    def trip_hash(trip_id):
+        """Return the 64-bit hash that trips are sorted by in the index."""
+        return int.from_bytes(
+            hashlib.blake2b(trip_id.encode(), digest_size=8).digest(),
+            "little",
+            signed=True,
+        )
+
+    @staticmethod
+    def compile(gtfs_path, index_path, source_mtime):
+        """
+        Compile the timetable at gtfs_path into an index file.
+
+        source_mtime is the modification time of the timetable, which is
+        recorded in the index to detect when the timetable is updated.
+        """
+        strings = {}
+
+        def string_index(s):
+            return strings.setdefault(s, len(strings))
+
+        routes = {}
+        with open_gtfs_table(gtfs_path, "routes.txt") as (columns, rows):
+            for row in rows:
+                route_id = row[columns["route_id"]]
+                name = ""
+                if "route_short_name" in columns:
+                    name = row[columns["route_short_name"]]
+                routes[route_id] = name or route_id
+
+        ## Service weekday mask (Monday is bit 0), date range and exceptions
+        services = {}
+        exceptions = {}
+        weekdays = [
+            "monday",
+            "tuesday",
+            "wednesday",
+            "thursday",
+            "friday",
+            "saturday",
+            "sunday",
+        ]
+        with open_gtfs_table(gtfs_path, "calendar.txt") as (columns, rows):
+            for row in rows:
+                mask = 0
+                for bit, weekday in enumerate(weekdays):
+                    if row[columns[weekday]] == "1":
+                        mask |= 1 << bit
+                service_id = row[columns["service_id"]]
+                services[service_id] = [
+                    mask,
+                    int(row[columns["start_date"]]),
+                    int(row[columns["end_date"]]),
+                ]
+        with open_gtfs_table(gtfs_path, "calendar_dates.txt") as (columns, rows):
+            for row in rows:
+                service_id = row[columns["service_id"]]
+                services.setdefault(service_id, [0, 0, 0])
+                dates = exceptions.setdefault(service_id, {})
+                dates[row[columns["date"]]] = row[columns["exception_type"]] == "1"
+        service_ids = {service_id: i for i, service_id in enumerate(services)}
+
+        ## Departure record for each trip, packed once
+        trips = {}
+        trip_records = []
+        trip_hashes = []
+        with open_gtfs_table(gtfs_path, "trips.txt") as (columns, rows):
+            for row in rows:
+                route_id = row[columns["route_id"]]
+                service_id = row[columns["service_id"]]
+                if service_id not in service_ids:
+                    continue
+                headsign = ""
+                if "trip_headsign" in columns:
+                    headsign = row[columns["trip_headsign"]]
+                direction = -1
+                if "direction_id" in columns and row[columns["direction_id"]]:
+                    direction = int(row[columns["direction_id"]])
+                trip_id = row[columns["trip_id"]]
+                trips[trip_id] = len(trip_records)
+                trip_hashes.append(GtfsStaticIndex.trip_hash(trip_id))
+                trip_records.append(
+                    GTFS_STATIC_RECORD.pack(
+                        string_index(routes.get(route_id, route_id)),
+                        string_index(headsign),
+                        service_ids[service_id],
+                        direction,
+                    )
+                )
+        if len(trip_records) >= 1 << GTFS_STATIC_TRIP_BITS:
+            raise Exception(f"{gtfs_path}: too many trips")
+
+        trip_order = sorted(range(len(trip_hashes)), key=trip_hashes.__getitem__)
+        trip_numbers = array("I", bytes(4 * len(trip_order)))
+        for number, trip in enumerate(trip_order):
+            trip_numbers[trip] = number
+
+        ## Departures are sorted by a key packing the stop, time and trip. Keys
+        ## are sorted in runs written to temporary files, and the runs merged
+        ## as each section of the index is written, so that the departures of
+        ## a large timetable are never all held in memory
+        stops = {}
+        time_shift = GTFS_STATIC_TRIP_BITS
+        stop_shift = GTFS_STATIC_TRIP_BITS + GTFS_STATIC_TIME_BITS
+        time_mask = (1 << GTFS_STATIC_TIME_BITS) - 1
+        trip_mask = (1 << GTFS_STATIC_TRIP_BITS) - 1
+        temp_dir = os.path.dirname(os.path.abspath(index_path))
+        with ExitStack() as stack:
+
+            def temp_file():
+                return stack.enter_context(tempfile.TemporaryFile(dir=temp_dir))
+
+            runs = []
+            chunk = []
+
+            def write_run():
+                chunk.sort()
+                run = temp_file()
+                for i in range(0, len(chunk), GTFS_STATIC_COMPILE_BLOCK):
+                    run.write(
+                        b"".join(
+                            GTFS_STATIC_RUN_RECORD.pack(key >> 32, key & 0xFFFFFFFF)
+                            for key in chunk[i : i + GTFS_STATIC_COMPILE_BLOCK]
+                        )
+                    )
+                run.seek(0)
+                runs.append(run)
+                chunk.clear()
+
+            def read_run(run):
+                size = GTFS_STATIC_RUN_RECORD.size * GTFS_STATIC_COMPILE_BLOCK
+                while block := run.read(size):
+                    yield from GTFS_STATIC_RUN_RECORD.iter_unpack(block)
+
+            with open_gtfs_table(gtfs_path, "stop_times.txt") as (columns, rows):
+                trip_column = columns["trip_id"]
+                time_column = columns["departure_time"]
+                stop_column = columns["stop_id"]
+                sequence_column = columns["stop_sequence"]
+                pickup_column = columns.get("pickup_type")
+                for row in rows:
+                    trip = trips.get(row[trip_column])
+                    departure_time = row[time_column]
+                    if trip is None or not departure_time:
+                        continue
+                    if pickup_column is not None and row[pickup_column] == "1":
+                        continue  ## no pickup, such as at the last stop of a trip
+                    stop = stops.setdefault(row[stop_column], len(stops))
+                    key = (
+                        (stop << stop_shift)
+                        | (gtfs_seconds(departure_time) << time_shift)
+                        | trip
+                    )
+                    chunk.append((key << 32) | int(row[sequence_column]))
+                    if len(chunk) == GTFS_STATIC_COMPILE_CHUNK:
+                        write_run()
+            if len(stops) >= 1 << GTFS_STATIC_STOP_BITS:
+                raise Exception(f"{gtfs_path}: too many stops")
+            write_run()
+
+            ## Departure times, records, trip numbers and stop sequences are
+            ## written to separate sections in a single pass over the runs
+            sections = [temp_file() for _ in range(4)]
+            times = array("i")
+            records = []
+            departure_trips = array("I")
+            sequences = array("I")
+
+            def write_sections():
+                sections[0].write(times.tobytes())
+                sections[1].write(b"".join(records))
+                sections[2].write(departure_trips.tobytes())
+                sections[3].write(sequences.tobytes())
+                del times[:], records[:], departure_trips[:], sequences[:]
+
+            stop_ids = list(stops)
+            stop_ranges = {}
+            count = 0
+            current_stop = None
+            for key, sequence in heapq.merge(*map(read_run, runs)):
+                stop = key >> stop_shift
+                if stop != current_stop:
+                    current_stop = stop
+                    stop_range = stop_ranges[stop_ids[stop]] = [count, count]
+                trip = key & trip_mask
+                times.append((key >> time_shift) & time_mask)
+                records.append(trip_records[trip])
+                departure_trips.append(trip_numbers[trip])
+                sequences.append(sequence)
+                count += 1
+                stop_range[1] = count
+                if len(times) == GTFS_STATIC_COMPILE_BLOCK:
+                    write_sections()
+            write_sections()
+
+            ## Route names are added to the strings before the strings are listed
+            routes = {route_id: string_index(name) for route_id, name in routes.items()}
+            metadata = json.dumps(
+                {
+                    "source_mtime": source_mtime,
+                    "strings": list(strings),
+                    "routes": routes,
+                    "stops": stop_ranges,
+                    "trips": len(trip_order),
+                    "services": list(services.values()),
+                    "exceptions": {
+                        service_ids[service_id]: dates
+                        for service_id, dates in exceptions.items()
+                    },
+                }
+            ).encode()
+
+            ## Write to a temporary file first so that the index is never partial
+            temp_path = index_path + ".tmp"
+            with open(temp_path, "wb") as f:
+                f.write(
+                    GTFS_STATIC_HEADER.pack(
+                        GTFS_STATIC_INDEX_MAGIC, len(metadata), count
+                    )
+                )
+                f.write(metadata)
+                f.write(b"\0" * (-f.tell() % 4))
+                for section in sections[:2]:
+                    section.seek(0)
+                    shutil.copyfileobj(section, f)
+                f.write(b"\0" * (-f.tell() % 8))
+                f.write(
+                    array("q", [trip_hashes[trip] for trip in trip_order]).tobytes()
+                )
+                f.write(b"".join(trip_records[trip] for trip in trip_order))
+                f.write(b"\0" * (-f.tell() % 4))
+                for section in sections[2:]:
+                    section.seek(0)
+                    shutil.copyfileobj(section, f)
+        os.replace(temp_path, index_path)
+        _LOGGER.info(f"{gtfs_path}: compiled {count} departures for {len(stops)} stops")
+
+    def _services_active_on(self, date):
+        """Return the indexes of services active on date."""
+        active = self._active_services.get(date)
+        if active is None:
+            day = date.strftime("%Y%m%d")
+            day_number = int(day)
+            weekday = 1 << date.weekday()
+            active = set()
+            for i, (mask, start, end) in enumerate(self._services):
+                if mask & weekday and start <= day_number <= end:
+                    active.add(i)
+            for i, dates in self._exceptions.items():
+                if day in dates:
+                    if dates[day]:
+                        active.add(i)
+                    else:
+                        active.discard(i)
+            if len(self._active_services) > 4:
+                self._active_services.clear()
+            self._active_services[date] = active
+        return active
+
+    def route_name(self, route_id):
+        """Return the short name of a route, or route_id if not known."""
+        route = self._routes.get(route_id)
+        return route_id if route is None else self._strings[route]
+
+    def trip_number(self, trip_id):
+        """Return the number of a trip in the index, or None if not known."""
+        key = self.trip_hash(trip_id)
+        i = bisect.bisect_left(self._trip_hashes, key)
+        if i == len(self._trip_hashes) or self._trip_hashes[i] != key:
+            return None
+        return i
+
+    def trip(self, trip_number):
+        """Return the route name and headsign of a trip."""
+        route, headsign, _, _ = GTFS_STATIC_RECORD.unpack_from(
+            self._mmap,
+            self._trip_records_offset + trip_number * GTFS_STATIC_RECORD.size,
+        )
+        return self._strings[route], self._strings[headsign]
+
+    def trip_calls(self, trip_number, stop_id):
+        """
+        Return the (stop sequence, departure time) of each call of a trip at a
+        stop, with times in seconds from the start of the service day.
+
+        The trips departing each stop are looked up once, so only stops that
+        calls are requested for are held in memory.
+        """
+        trips = self._stop_trips.get(stop_id)
+        if trips is None:
+            trips = {}
+            start, end = self._stops.get(stop_id, (0, 0))
+            for i in range(start, end):
+                trips.setdefault(self._departure_trips[i], []).append(
+                    (self._sequences[i], self._times[i])
+                )
+            self._stop_trips[stop_id] = trips
+        return trips.get(trip_number, ())
+
+    @staticmethod
+    def service_day(service_date, tz):
+        """
+        Return the time GTFS times of a service day are measured from.
+
+        GTFS times are measured from noon minus 12h of the service day, which
+        is midnight except on days with a daylight saving time change.
+        """
+        noon = datetime.combine(service_date, NOON, tzinfo=tz)
+        return dt_util.as_utc(noon) - timedelta(hours=12)
+
+    def departures(self, stop_id, now, lookahead):
+        """Return scheduled departures for a stop, sorted by due time."""
+        if stop_id not in self._stops:
+            raise Exception(f"stop {stop_id} not in GTFS timetable")
+        start, end = self._stops[stop_id]
+        departed = int(DEPARTED_AGE.total_seconds())
+        now = dt_util.as_local(now)
+        tz = now.tzinfo
+        departures = []
+        ## Trips of the previous service day may depart after midnight
+        for days in (1, 0):
+            service_date = now.date() - timedelta(days=days)
+            service_day = self.service_day(service_date, tz)
+            active = self._services_active_on(service_date)
+            seconds = int((now - service_day).total_seconds())
+            lo = bisect.bisect_left(self._times, seconds - departed, start, end)
+            hi = bisect.bisect_right(
+                self._times, seconds + int(lookahead.total_seconds()), lo, end
+            )
+            for i in range(lo, hi):
+                route, headsign, service, direction = GTFS_STATIC_RECORD.unpack_from(
+                    self._mmap, self._records_offset + i * GTFS_STATIC_RECORD.size
+                )
+                if service not in active:
+                    continue
+                countdown = self._times[i] - seconds
+                due_at = (service_day + timedelta(seconds=self._times[i])).astimezone(
+                    tz
+                )
+                departures.append(
+                    Departure.create(
+                        "gtfs_static",
+                        self._strings[route],
+                        self._strings[headsign],
+                        "",
+                        direction if direction >= 0 else "",
+                        due_at,
+                        due_at,
+                        int(round(countdown / 60)) if countdown >= 60 else 0,
+                        False,
+                    )
+                )
+        departures.sort(key=lambda a: a.due_at)
+        return departures
+
+
+GTFS_STATIC_INDEXES = {}
+GTFS_STATIC_INDEXES_LOCK = threading.Lock()
+GTFS_STATIC_INDEX_LOCKS = {}
+
+
+def gtfs_static_mtime(gtfs_path):
+    """Return the last modification time of a GTFS timetable."""
+    if os.path.isdir(gtfs_path):
+        return max(
+            (
+                os.path.getmtime(os.path.join(gtfs_path, name))
+                for name in os.listdir(gtfs_path)
+                if name.endswith(".txt")
+            ),
+            default=0,
+        )
+    return os.path.getmtime(gtfs_path)
+
+
+def open_gtfs_static_index(index_path, source_mtime):
+    """Open an index compiled from the timetable as of source_mtime, if any."""
+    if not os.path.exists(index_path):
+        return None
+    try:
+        index = GtfsStaticIndex(index_path)
+    except Exception:
+        ## Indexes compiled by earlier versions are compiled again
+        return None
+    return index if index.source_mtime == source_mtime else None
+
+
+def get_gtfs_static_index(gtfs_path):
+    """
+    Return the index for a GTFS timetable, compiling it if needed.
+
+    The index is compiled again if the timetable has been updated since it
+    was compiled. This may take some time for large timetables, so must not
+    be called from the event loop. Only callers for the same timetable wait
+    while it is compiled.
+    """
+    with GTFS_STATIC_INDEXES_LOCK:
+        lock = GTFS_STATIC_INDEX_LOCKS.setdefault(gtfs_path, threading.Lock())
+    with lock:
+        source_mtime = gtfs_static_mtime(gtfs_path)
+        entry = GTFS_STATIC_INDEXES.get(gtfs_path)
+        if entry is not None and entry[0].source_mtime == source_mtime:
+            index = entry[0]
+        else:
+            index_path = gtfs_path.rstrip("/") + GTFS_STATIC_INDEX_SUFFIX
+            index = open_gtfs_static_index(index_path, source_mtime)
+            if index is None:
+                _LOGGER.info(f"{gtfs_path}: compiling GTFS timetable index")
+                GtfsStaticIndex.compile(gtfs_path, index_path, source_mtime)
+                index = GtfsStaticIndex(index_path)
+        GTFS_STATIC_INDEXES[gtfs_path] = (index, time.monotonic())
+    return index
+
+
+async def async_get_gtfs_static_index(gtfs_path):
+    """
+    Return the index for a GTFS timetable from the event loop.
+
+    The timetable is checked for updates, and the index compiled, outside the
+    event loop at most every GTFS_STATIC_CHECK_INTERVAL seconds.
+    """
+    entry = GTFS_STATIC_INDEXES.get(gtfs_path)
+    if entry is not None:
+        index, checked_at = entry
+        if time.monotonic() - checked_at < GTFS_STATIC_CHECK_INTERVAL:
+            return index
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, get_gtfs_static_index, gtfs_path)
+
+
+class TokenBucket:
+    """Token bucket rate limiter."""
+
+    def __init__(self, rate, burst):
+        """Initialize the token bucket with a full complement of tokens."""
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return the delay in seconds until it is valid."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self._burst, self._tokens + (now - self._updated) * self._rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self._rate
+
+
+class RtpiCoordinator:
+    """
+    Coordinates RTPI source requests for all sensors.
+
+    Requests to each upstream host are rate limited by a shared token bucket,
+    the number of requests in flight to each host is bounded, so that a slow
+    host does not hold up requests to other hosts, and full refreshes are
+    spread across the refresh interval with a random jitter.
+    """
+
+    def __init__(
+        self,
+        session_pool,
+        max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS,
+        rate_limit=DEFAULT_RATE_LIMIT,
+        fetch_jitter=DEFAULT_FETCH_JITTER,
+    ):
+        """Initialize the coordinator."""
+        self._session_pool = session_pool
+        self._max_concurrent_requests = max_concurrent_requests
+        self._rate_limit = rate_limit
+        self._fetch_jitter = fetch_jitter
+        self._async_semaphores = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, host):
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                burst = max(DEFAULT_RATE_LIMIT_BURST, self._rate_limit)
+                bucket = TokenBucket(self._rate_limit, burst)
+                self._buckets[host] = bucket
+        return bucket
+
+    def _async_semaphore(self, host):
+        semaphore = self._async_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self._max_concurrent_requests)
+            self._async_semaphores[host] = semaphore
+        return semaphore
+
+    def fetch_jitter(self):
+        """Return a random delay to spread refreshes across the interval."""
+        return timedelta(seconds=random.uniform(0, self._fetch_jitter))
+
+    @asynccontextmanager
+    async def async_get(self, url, params, ssl_verify, headers=None):
+        """Perform a rate limited GET request, yielding the response."""
+        host = urlsplit(url).netloc
+        delay = self._bucket(host).reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        async with self._async_semaphore(host):
+            async with self._session_pool.async_get(
+                url, params, ssl_verify, headers
+            ) as response:
+                yield response
+
+    async def async_close(self):
+        """Close pooled sessions."""
+        await self._session_pool.async_close()
+
+
+class DepartureStore:
+    """
+    Persists the shared departure cache for warm startup.
+
+    The last departures retrieved for each stop are saved in the background
+    after they change, and are restored into sensors when they are set up so
+    that sensors have departures before their first refresh.
+    """
+
+    def __init__(self, hass):
+        """Initialize the departure store."""
+        self._hass = hass
+        self._store = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+        self._saved = None
+        DEPARTURE_CACHE.add_listener(self.schedule_save)
+
+    async def async_load(self):
+        """Return departures saved before restart keyed by (source, stop_id)."""
+        if self._saved is None:
+            self._saved = {}
+            try:
+                data = await self._store.async_load()
+                for entry in (data or {}).get("stops", []):
+                    source = entry["source"]
+                    self._saved[(source, entry["stop_id"])] = [
+                        Departure.from_compact(source, dep)
+                        for dep in entry["departures"]
+                    ]
+            except Exception as e:
+                _LOGGER.warning(f"Unable to restore saved departures: {str(e)}")
+        return self._saved
+
+    def schedule_save(self):
+        """Schedule a background save of the departure cache."""
+        self._hass.loop.call_soon_threadsafe(self._async_schedule_save)
+
+    @callback
+    def _async_schedule_save(self):
+        self._store.async_delay_save(self._data_to_save, STORAGE_SAVE_DELAY)
+
+    @staticmethod
+    def _keep(source, stop_id, departures, now):
+        """Return True if departures for a stop are worth restoring."""
+        if not DEPARTURE_CACHE.is_used(source, stop_id):
+            ## The stop is no longer used by any sensor
+            return False
+        ## Departures are sorted by due time, so all have aged out if the last has
+        return bool(departures) and departures[-1].due_at >= now - DEPARTED_AGE
+
+    @callback
+    def _data_to_save(self):
+        ## Keep saved departures for stops not refreshed since restart
+        entries = dict(self._saved or {})
+        entries.update(DEPARTURE_CACHE.items())
+        now = dt_util.utcnow()
+        return {
+            "stops": [
+                {
+                    "source": source,
+                    "stop_id": stop_id,
+                    "departures": [dep.to_compact() for dep in departures],
+                }
+                for (source, stop_id), departures in entries.items()
+                if self._keep(source, stop_id, departures, now)
+            ]
+        }
+
+
+def get_departure_store(hass):
+    """Return the departure store for hass, creating it on first use."""
+    domain_data = hass.data.setdefault(DOMAIN, {})
+    if "departure_store" not in domain_data:
+        domain_data["departure_store"] = DepartureStore(hass)
+    return domain_data["departure_store"]
+
+
+def get_coordinator(hass, config):
+    """Return the RTPI coordinator for hass, creating it on first use.
+
+    The coordinator is shared by all sensors, so its settings are taken from
+    the first sensor configured.
+    """
+    domain_data = hass.data.setdefault(DOMAIN, {})
+    if "coordinator" not in domain_data:
+        ## Requests in flight to each host each have a connection
+        max_concurrent_requests = config.get(CONF_MAX_CONCURRENT_REQUESTS)
+        domain_data["coordinator"] = RtpiCoordinator(
+            RtpiSessionPool(max_concurrent_requests, hass),
+            max_concurrent_requests,
+            config.get(CONF_RATE_LIMIT),
+            config.get(CONF_FETCH_JITTER),
+        )
+    return domain_data["coordinator"]
+
+
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """Set up the Dublin public transport sensor."""
     name = config.get(CONF_NAME)
     stop_id = config.get(CONF_STOP_ID)
@@ -170,6 +2138,13 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
     refresh_interval = config.get(CONF_REFRESH_INTERVAL)
     no_data_refresh_interval = config.get(CONF_NO_DATA_REFRESH_INTERVAL)
     fast_refresh_threshold = config.get(CONF_FAST_REFRESH_THRESHOLD)
+    fetch_strategy = config.get(CONF_FETCH_STRATEGY)
+    hedge_delay = config.get(CONF_HEDGE_DELAY)
+    source_order = config.get(CONF_SOURCE_ORDER)
+    merge_sources = config.get(CONF_MERGE_SOURCES)
+    departures_json_format = config.get(CONF_DEPARTURES_JSON_FORMAT)
+    diagnostics_sensor = config.get(CONF_DIAGNOSTICS_SENSOR)
+    record_departures = config.get(CONF_RECORD_DEPARTURES)
 
     for source in rtpi_sources:
         source_data = rtpi_sources[source]
@@ -185,8 +2160,14 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
         )
         if source_data[CONF_STOP_ID] == "":
             source_data[CONF_STOP_ID] = stop_id
-        if source == RTPI_SOURCE_IRISH_RAIL:
-            source_data[RTPI_SOURCE_IRISH_RAIL] = IrishRailRTPI()
+    if (
+        RTPI_SOURCE_GTFS_RT in rtpi_sources
+        and RTPI_SOURCE_GTFS_STATIC in rtpi_sources
+        and not rtpi_sources[RTPI_SOURCE_GTFS_RT][CONF_GTFS_PATH]
+    ):
+        rtpi_sources[RTPI_SOURCE_GTFS_RT][CONF_GTFS_PATH] = rtpi_sources[
+            RTPI_SOURCE_GTFS_STATIC
+        ][CONF_GTFS_PATH]
 
     data = PublicTransportData(
         stop_id,
@@ -196,198 +2177,124 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
         refresh_interval,
         no_data_refresh_interval,
         fast_refresh_threshold,
+        fetch_strategy,
+        hedge_delay,
+        source_order,
+        merge_sources,
+        get_coordinator(hass, config),
     )
+    data.restore_departures(await get_departure_store(hass).async_load())
 
-    add_entities([DublinPublicTransportSensor(name, data, stop_id, show_options)], True)
+    if record_departures:
+        sensor_class = DublinPublicTransportSensor
+    else:
+        sensor_class = UnrecordedDublinPublicTransportSensor
+    entities = [sensor_class(name, data, stop_id, show_options, departures_json_format)]
+    if diagnostics_sensor:
+        entities.append(RtpiDiagnosticsSensor(f"{name} diagnostics", data))
+    async_add_entities(entities)
 
 
 class DublinPublicTransportSensor(Entity):
     """Implementation of an Dublin public transport sensor."""
 
-    def __init__(self, name, data, stop_id, show_options):
+    def __init__(
+        self,
+        name,
+        data,
+        stop_id,
+        show_options,
+        departures_json_format=DEPARTURES_JSON_FORMAT_STRING,
+    ):
         """Initialize the sensor."""
         self._name = name
         self._data = data
         self._stop_id = stop_id
         self._show_options = show_options
+        self._departures_json_format = departures_json_format
         self._departures = None
         self._current_source = None
         self._next_refresh = 0
         self._state = None
+        self._departures_version = 0
+        self._fingerprint = None
+        self._rows = {}
+        self._attrs = None
+        self._attrs_key = None
+        self._unsub_update = None
+        self._scheduled = False
+
+    def _render_row(self, dep):
+        """Return rendered row for a departure, reusing previous renderings."""
+        key = dep._replace(countdown=0)
+        row = self._rows.get(key)
+        if row is None:
+            row = RenderedDeparture(dep, self._show_options)
+        row.set_countdown(dep.countdown)
+        return key, row
+
+    def _render_rows(self):
+        """Render rows for current departures and discard stale rows."""
+        rows = {}
+        for dep in self._departures:
+            key, row = self._render_row(dep)
+            rows[key] = row
+        self._rows = rows
+        return [self._rows[dep._replace(countdown=0)] for dep in self._departures]
 
-    def _render_departure_text(self, dep):
-        route = dep[ATTR_ROUTE]
-        destination = dep[ATTR_DESTINATION]
-        is_realtime = dep[ATTR_IS_REALTIME]
-        scheduled_at = dep[ATTR_SCHEDULED_AT]
-        due_at = dep[ATTR_DUE_AT]
-        countdown = dep[ATTR_COUNTDOWN]
-
-        text = ""
-        if CONF_SHOW_ROUTE in self._show_options:
-            text += route + " "
-        text += destination
-        if CONF_SHOW_REALTIME in self._show_options and is_realtime:
-            text += " (R)"
-        if ATTR_SCHEDULED_AT in self._show_options:
-            text += " " + scheduled_at.strftime("%H:%M")
-        if ATTR_DUE_AT in self._show_options:
-            text += " " + due_at.strftime("%H:%M")
-        text += " %d min" % countdown if countdown > 0 else " Due"
-        return text
-
-    def _render_departures_text(self):
-        if not self._departures:
+    def _render_departures_text(self, rows):
+        if not rows:
             return None
-
-        firstItem = True
-        text = ""
-        for dep in self._departures:
-            if not firstItem:
-                text += "\n"
-            text += self._render_departure_text(dep)
-            firstItem = False
-        return text
-
-    def _render_departure_html(self, dep):
-        route = dep[ATTR_ROUTE]
-        destination = dep[ATTR_DESTINATION]
-        is_realtime = dep[ATTR_IS_REALTIME]
-        scheduled_at = dep[ATTR_SCHEDULED_AT]
-        due_at = dep[ATTR_DUE_AT]
-        countdown = dep[ATTR_COUNTDOWN]
-
-        html = "<tr>"
-        if CONF_SHOW_ROUTE in self._show_options:
-            html += '<td class="tfi_route">' + route + "</td>"
-        html += '<td class="tfi_destination">' + destination + "</td>"
-        if CONF_SHOW_REALTIME in self._show_options:
-            html += (
-                '<td class="tfi_flags">' + ("&#x23F1;" if is_realtime else "") + "</td>"
-            )
-        if ATTR_SCHEDULED_AT in self._show_options:
-            html += (
-                '<td class="tfi_scheduled_at">'
-                + scheduled_at.strftime("%H:%M")
-                + "</td>"
+        return "\n".join([row.text for row in rows])
+
+    def _render_no_data_refresh(self):
+        if self._next_refresh < DEFAULT_LIMIT_TIME_HORIZON:
+            return f"in {self._next_refresh} mins"
+        refresh_time = dt_util.now() + timedelta(minutes=self._next_refresh)
+        return "at " + refresh_time.strftime("%H:%M")
+
+    def _render_departures_html(self, rows):
+        if not rows:
+            return (
+                '<div class="tfi_no_data">No departure data.<br>Next refresh '
+                + self._render_no_data_refresh()
+                + "</div>"
             )
-        if ATTR_DUE_AT in self._show_options:
-            html += '<td class="tfi_due_at">' + due_at.strftime("%H:%M") + "</td>"
-        html += (
-            '<td class="tfi_countdown">'
-            + ("%d min" % countdown if countdown > 0 else "Due")
-            + "</td></tr>\n"
+        return (
+            '<table class="tfi_table">\n'
+            + "".join([row.html for row in rows])
+            + "</table>"
         )
-        return html
-
-    def _render_departures_html(self):
-        if not self._departures:
-            html = '<div class="tfi_no_data">No departure data.<br>' + "Next refresh "
-            if self._next_refresh < DEFAULT_LIMIT_TIME_HORIZON:
-                html += f"in {self._next_refresh} mins"
-            else:
-                refresh_time = datetime.now() + timedelta(minutes=self._next_refresh)
-                html += "at " + refresh_time.strftime("%H:%M")
-            html += "</div>"
-            return html
-
-        html = '<table class="tfi_table">\n'
-        for dep in self._departures:
-            html += self._render_departure_html(dep)
-        html += "</table>"
-        return html
-
-    def _render_departure_md(self, dep):
-        route = dep[ATTR_ROUTE]
-        destination = dep[ATTR_DESTINATION]
-        is_realtime = dep[ATTR_IS_REALTIME]
-        scheduled_at = dep[ATTR_SCHEDULED_AT]
-        due_at = dep[ATTR_DUE_AT]
-        countdown = dep[ATTR_COUNTDOWN]
-
-        md = "|"
-        if CONF_SHOW_ROUTE in self._show_options:
-            md += " " + route + " |"
-        md += " " + destination + " |"
-        if CONF_SHOW_REALTIME in self._show_options:
-            md += " Y |" if is_realtime else " |"
-        if ATTR_SCHEDULED_AT in self._show_options:
-            md += " " + scheduled_at.strftime("%H:%M") + " |"
-        if ATTR_DUE_AT in self._show_options:
-            md += " " + due_at.strftime("%H:%M") + " |"
-        md += " %d min |" % countdown if countdown > 0 else " Due |"
-        md += "\n"
-        return md
-
-    def _render_departures_md(self):
-        if not self._departures:
-            md = "No departure data.\nNext refresh "
-            if self._next_refresh < DEFAULT_LIMIT_TIME_HORIZON:
-                md += f"in {self._next_refresh} mins"
-            else:
-                refresh_time = datetime.now() + timedelta(minutes=self._next_refresh)
-                md += "at " + refresh_time.strftime("%H:%M")
-            return md
 
-        md = "|"
-        md2 = "|"
-        if CONF_SHOW_ROUTE in self._show_options:
-            md += " # |"
-            md2 += " ---: |"
-        md += " Destination |"
-        md2 += " :--- |"
-        if CONF_SHOW_REALTIME in self._show_options:
-            md += " RT |"
-            md2 += " --- |"
-        if ATTR_SCHEDULED_AT in self._show_options:
-            md += " Sch |"
-            md2 += " ---: |"
-        if ATTR_DUE_AT in self._show_options:
-            md += " Due |"
-            md2 += " ---: |"
-        md += " In |\n"
-        md2 += " ---: |\n"
+    def _render_departures_md(self, rows):
+        if not rows:
+            return "No departure data.\nNext refresh " + self._render_no_data_refresh()
 
-        md += md2
-        for dep in self._departures:
-            md += self._render_departure_md(dep)
-        return md
-
-    def _render_departure_json(self, dep):
-        route = dep[ATTR_ROUTE]
-        destination = dep[ATTR_DESTINATION]
-        is_realtime = dep[ATTR_IS_REALTIME]
-        scheduled_at = dep[ATTR_SCHEDULED_AT]
-        due_at = dep[ATTR_DUE_AT]
-        countdown = dep[ATTR_COUNTDOWN]
-
-        json = "{ "
+        md = ["|"]
+        md2 = ["|"]
         if CONF_SHOW_ROUTE in self._show_options:
-            json += '"route": "' + route + '", '
-        json += '"destination": "' + destination + '"'
+            md.append(" # |")
+            md2.append(" ---: |")
+        md.append(" Destination |")
+        md2.append(" :--- |")
         if CONF_SHOW_REALTIME in self._show_options:
-            json += ', "is_realtime": '
-            json += "true" if is_realtime else "false"
+            md.append(" RT |")
+            md2.append(" --- |")
         if ATTR_SCHEDULED_AT in self._show_options:
-            json += ', "scheduled_at": "' + scheduled_at.strftime("%H:%M") + '"'
+            md.append(" Sch |")
+            md2.append(" ---: |")
         if ATTR_DUE_AT in self._show_options:
-            json += ', "due_at": "' + due_at.strftime("%H:%M") + '"'
-        json += ', "countdown": %d }' % countdown
-        return json
-
-    def _render_departures_json(self):
-        if not self._departures:
-            return "[]"
-
-        firstItem = True
-        json = "[ "
-        for dep in self._departures:
-            if not firstItem:
-                json += ", "
-            json += self._render_departure_json(dep)
-            firstItem = False
-        json += " ]"
-        return json
+            md.append(" Due |")
+            md2.append(" ---: |")
+        md.append(" In |\n")
+        md2.append(" ---: |\n")
+        return "".join(md + md2 + [row.md for row in rows])
+
+    def _render_departures_json(self, rows):
+        departures = [row.json for row in rows]
+        if self._departures_json_format == DEPARTURES_JSON_FORMAT_LIST:
+            return departures
+        return encode_json(departures)
 
     @property
     def name(self):
@@ -402,52 +2309,58 @@ class DublinPublicTransportSensor(Entity):
     @property
     def extra_state_attributes(self):
         """Return the state attributes."""
+        attrs_key = (self._departures_version, tuple(self._show_options))
+        if self._attrs is not None and self._attrs_key == attrs_key:
+            return self._attrs
+
         dev_attrs = {
             ATTR_ATTRIBUTION: CONF_ATTRIBUTION,
             ATTR_STOP_ID: self._stop_id,
             ATTR_DEPARTURES: self._departures,
             ATTR_SOURCE: self._current_source,
         }
+        rows = self._render_rows() if self._departures else []
         if self._departures:
-            dev_attrs[ATTR_DEPARTURES] = self._departures
+            dev_attrs[ATTR_DEPARTURES] = [dep.as_dict() for dep in self._departures]
 
             dep = self._departures[0]
-            dev_attrs[ATTR_DESTINATION] = dep[ATTR_DESTINATION]
-            dev_attrs[ATTR_DIRECTION] = dep[ATTR_DIRECTION]
-            dev_attrs[ATTR_DUE_AT] = dep[ATTR_DUE_AT]
-            dev_attrs[ATTR_COUNTDOWN] = dep[ATTR_COUNTDOWN]
+            dev_attrs[ATTR_DESTINATION] = dep.destination
+            dev_attrs[ATTR_DIRECTION] = dep.direction
+            dev_attrs[ATTR_DUE_AT] = dep.due_at
+            dev_attrs[ATTR_COUNTDOWN] = dep.countdown
 
-            if CONF_SHOW_ROUTE in self._show_options and ATTR_ROUTE in dep:
-                dev_attrs[ATTR_ROUTE] = dep[ATTR_ROUTE]
-            if CONF_SHOW_REALTIME in self._show_options and ATTR_IS_REALTIME in dep:
-                dev_attrs[ATTR_IS_REALTIME] = dep[ATTR_IS_REALTIME]
+            if CONF_SHOW_ROUTE in self._show_options:
+                dev_attrs[ATTR_ROUTE] = dep.route
+            if CONF_SHOW_REALTIME in self._show_options:
+                dev_attrs[ATTR_IS_REALTIME] = dep.is_realtime
 
-            if ATTR_SECOND_DEPARTURE in self._show_options:
-                try:
-                    dep = self._departures[1]
-                    dev_attrs[ATTR_SECOND_DEPARTURE] = self._render_departure_text(dep)
-                except Exception:
-                    pass
+            if ATTR_SECOND_DEPARTURE in self._show_options and len(rows) > 1:
+                dev_attrs[ATTR_SECOND_DEPARTURE] = rows[1].text
 
         if ATTR_DEPARTURES_TEXT in self._show_options:
-            text = self._render_departures_text()
+            text = self._render_departures_text(rows)
             if text:
                 dev_attrs[ATTR_DEPARTURES_TEXT] = text
         if ATTR_DEPARTURES_HTML in self._show_options:
-            html = self._render_departures_html()
+            html = self._render_departures_html(rows)
             if html:
                 dev_attrs[ATTR_DEPARTURES_HTML] = html
         if ATTR_DEPARTURES_MD in self._show_options:
-            md = self._render_departures_md()
+            md = self._render_departures_md(rows)
             if md:
                 dev_attrs[ATTR_DEPARTURES_MD] = md
         if ATTR_DEPARTURES_JSON in self._show_options:
-            json = self._render_departures_json()
-            if json:
-                dev_attrs[ATTR_DEPARTURES_JSON] = json
+            dev_attrs[ATTR_DEPARTURES_JSON] = self._render_departures_json(rows)
 
+        self._attrs = dev_attrs
+        self._attrs_key = attrs_key
         return dev_attrs
 
+    @property
+    def should_poll(self):
+        """Updates are scheduled by the sensor."""
+        return False
+
     @property
     def unit_of_measurement(self):
         """Return the unit this state is expressed in."""
@@ -458,18 +2371,245 @@ class DublinPublicTransportSensor(Entity):
         """Icon to use in the frontend, if any."""
         return ICON
 
-    def update(self):
+    async def async_update(self):
         """
         Get the latest data from each data source and update the states.
         """
-        if self._data.update():
-            self._departures = self._data.get_departures()
-            self._current_source = self._data.get_current_source()
-            self._next_refresh = self._data.get_next_refresh()
-            self._state = (
-                self._departures[0][ATTR_COUNTDOWN] if self._departures else None
-            )
-
+        await self._async_update_state()
+
+    async def _async_update_state(self):
+        """Update from the data, returning True if the visible state changed."""
+        if await self._data.async_update():
+            return self._update_from_data()
+        return False
+
+    def _update_from_data(self):
+        departures = self._data.get_departures()
+        current_source = self._data.get_current_source()
+        next_refresh = self._data.get_next_refresh()
+
+        ## Departures, source and the next refresh shown when there are no
+        ## departures determine everything that is rendered
+        fingerprint = (
+            current_source,
+            tuple(departures),
+            None if departures else next_refresh,
+        )
+        if fingerprint == self._fingerprint:
+            return False
+        self._fingerprint = fingerprint
+        self._departures = departures
+        self._current_source = current_source
+        self._next_refresh = next_refresh
+        self._state = departures[0].countdown if departures else None
+        self._departures_version += 1
+        return True
+
+    async def async_added_to_hass(self):
+        """Schedule the next update when added to hass."""
+        if self._data.get_departures():
+            ## Show departures restored from before restart
+            self._update_from_data()
+        self._scheduled = True
+        self._async_schedule_update()
+
+    async def async_will_remove_from_hass(self):
+        """Cancel the scheduled update and release the shared stops."""
+        self._scheduled = False
+        if self._unsub_update:
+            self._unsub_update()
+            self._unsub_update = None
+        self._data.release()
+
+    @callback
+    def _async_schedule_update(self):
+        """Arm a timer for the next time the stop needs to be updated."""
+        next_update = self._data.get_next_update()
+        delay = max((next_update - dt_util.utcnow()).total_seconds(), MIN_UPDATE_DELAY)
+        _LOGGER.debug(f"{self._stop_id}: next update in {delay:.0f}s")
+        self._unsub_update = async_call_later(
+            self.hass, delay, self._async_scheduled_update
+        )
+
+    async def _async_scheduled_update(self, _now):
+        """Update the sensor and schedule the next update."""
+        self._unsub_update = None
+        try:
+            if await self._async_update_state():
+                self.async_write_ha_state()
+        finally:
+            if self._scheduled:
+                self._async_schedule_update()
+
+
+class UnrecordedDublinPublicTransportSensor(DublinPublicTransportSensor):
+    """Dublin public transport sensor with departures excluded from the recorder."""
+
+    _unrecorded_attributes = frozenset(
+        {
+            ATTR_DEPARTURES,
+            ATTR_DEPARTURES_TEXT,
+            ATTR_DEPARTURES_HTML,
+            ATTR_DEPARTURES_MD,
+            ATTR_DEPARTURES_JSON,
+        }
+    )
+
+
+class RtpiDiagnosticsSensor(Entity):
+    """
+    Diagnostics sensor for the sources of a Dublin public transport sensor.
+
+    The state is the latency of the last request to the current source, and
+    the request metrics for each source are provided as attributes.
+    """
+
+    def __init__(self, name, data):
+        """Initialize the sensor."""
+        self._name = name
+        self._data = data
+        self._state = None
+        self._current_source = None
+        self._metrics = {}
+
+    @property
+    def name(self):
+        """Return the name of the sensor."""
+        return self._name
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        return self._state
+
+    @property
+    def extra_state_attributes(self):
+        """Return the state attributes."""
+        return {ATTR_SOURCE: self._current_source, **self._metrics}
+
+    @property
+    def unit_of_measurement(self):
+        """Return the unit this state is expressed in."""
+        return "ms"
+
+    @property
+    def icon(self):
+        """Icon to use in the frontend, if any."""
+        return "mdi:chart-line"
+
+    @property
+    def entity_category(self):
+        """Return the category of the entity."""
+        return EntityCategory.DIAGNOSTIC
+
+    async def async_update(self):
+        """Get the latest metrics for the sources of the sensor."""
+        self._metrics = self._data.get_source_metrics()
+        self._current_source = self._data.get_current_source()
+        latency = None
+        if self._current_source is not None:
+            latency = self._metrics[self._current_source]["latency_last"]
+        self._state = round(latency * 1000) if latency is not None else None
+
+
+class RenderedDeparture:
+    """
+    Rendered text, HTML, markdown and JSON rows for a departure.
+
+    The parts of each row that do not change as a departure ages are rendered
+    once, so only the countdown is re-rendered when it changes. The JSON row
+    is kept as a dict so that all rows can be encoded in a single pass.
+    """
+
+    __slots__ = (
+        "_text_static",
+        "_html_static",
+        "_md_static",
+        "_json_static",
+        "countdown",
+        "text",
+        "html",
+        "md",
+        "json",
+    )
+
+    def __init__(self, dep, show_options):
+        """Render the static parts of the departure rows."""
+        scheduled_at = dep.scheduled_at.strftime(TIME_STR_FORMAT)
+        due_at = dep.due_at.strftime(TIME_STR_FORMAT)
+
+        text = []
+        if CONF_SHOW_ROUTE in show_options:
+            text.append(dep.route + " ")
+        text.append(dep.destination)
+        if CONF_SHOW_REALTIME in show_options and dep.is_realtime:
+            text.append(" (R)")
+        if ATTR_SCHEDULED_AT in show_options:
+            text.append(" " + scheduled_at)
+        if ATTR_DUE_AT in show_options:
+            text.append(" " + due_at)
+        self._text_static = "".join(text)
+
+        html = ["<tr>"]
+        if CONF_SHOW_ROUTE in show_options:
+            html.append('<td class="tfi_route">' + dep.route + "</td>")
+        html.append('<td class="tfi_destination">' + dep.destination + "</td>")
+        if CONF_SHOW_REALTIME in show_options:
+            html.append(
+                '<td class="tfi_flags">'
+                + ("&#x23F1;" if dep.is_realtime else "")
+                + "</td>"
+            )
+        if ATTR_SCHEDULED_AT in show_options:
+            html.append('<td class="tfi_scheduled_at">' + scheduled_at + "</td>")
+        if ATTR_DUE_AT in show_options:
+            html.append('<td class="tfi_due_at">' + due_at + "</td>")
+        self._html_static = "".join(html)
+
+        md = ["|"]
+        if CONF_SHOW_ROUTE in show_options:
+            md.append(" " + dep.route + " |")
+        md.append(" " + dep.destination + " |")
+        if CONF_SHOW_REALTIME in show_options:
+            md.append(" Y |" if dep.is_realtime else " |")
+        if ATTR_SCHEDULED_AT in show_options:
+            md.append(" " + scheduled_at + " |")
+        if ATTR_DUE_AT in show_options:
+            md.append(" " + due_at + " |")
+        self._md_static = "".join(md)
+
+        departure_json = {}
+        if CONF_SHOW_ROUTE in show_options:
+            departure_json[ATTR_ROUTE] = dep.route
+        departure_json[ATTR_DESTINATION] = dep.destination
+        if CONF_SHOW_REALTIME in show_options:
+            departure_json[ATTR_IS_REALTIME] = dep.is_realtime
+        if ATTR_SCHEDULED_AT in show_options:
+            departure_json[ATTR_SCHEDULED_AT] = scheduled_at
+        if ATTR_DUE_AT in show_options:
+            departure_json[ATTR_DUE_AT] = due_at
+        self._json_static = departure_json
+
+        self.countdown = None
+
+    def set_countdown(self, countdown):
+        """Re-render the rows if the countdown has changed."""
+        if countdown == self.countdown:
+            return
+        self.countdown = countdown
+        if countdown > 0:
+            self.text = self._text_static + " %d min" % countdown
+            self.html = (
+                self._html_static
+                + '<td class="tfi_countdown">%d min</td></tr>\n' % countdown
+            )
+            self.md = self._md_static + " %d min |\n" % countdown
+        else:
+            self.text = self._text_static + " Due"
+            self.html = self._html_static + '<td class="tfi_countdown">Due</td></tr>\n'
+            self.md = self._md_static + " Due |\n"
+        self.json = {**self._json_static, ATTR_COUNTDOWN: countdown}
+
 
 class PublicTransportData:  # (metaclass=ABCMeta):
     """The Class for handling the data retrieval."""
@@ -483,6 +2623,11 @@ class PublicTransportData:  # (metaclass=ABCMeta):
         refresh_interval,
         no_data_refresh_interval,
         fast_refresh_threshold,
+        fetch_strategy,
+        hedge_delay,
+        source_order,
+        merge_sources,
+        coordinator,
     ):
         """Initialize the data object."""
         self._stop_id = stop_id
@@ -492,20 +2637,60 @@ class PublicTransportData:  # (metaclass=ABCMeta):
         self._refresh_interval = refresh_interval
         self._no_data_refresh_interval = no_data_refresh_interval
         self._fast_refresh_threshold = fast_refresh_threshold
+        self._fetch_strategy = fetch_strategy
+        self._hedge_delay = hedge_delay
+        self._source_order = source_order
+        self._merge_sources = merge_sources
+        self._coordinator = coordinator
+        self._filters = {
+            source: DepartureFilter(source_data, limit_time_horizon, limit_departures)
+            for source, source_data in rtpi_sources.items()
+        }
+        if merge_sources:
+            ## Sources are filtered before merging, and the merged departures
+            ## are limited afterwards
+            self._merge_filters = {
+                source: DepartureFilter(source_data, 0, 0)
+                for source, source_data in rtpi_sources.items()
+            }
+            self._merged_filter = DepartureFilter(
+                CONF_RTPI_SOURCE_SCHEMA({}), limit_time_horizon, limit_departures
+            )
+        self._index = None
 
-        self._next_refresh = 0
-        self._scan_count = 0
+        ## Spread initial refreshes of all stops across the fetch jitter
+        self._next_fetch_at = dt_util.utcnow() + coordinator.fetch_jitter()
+        self._last_fetch_at = None
         self._current_source = None
         self._all_departures = []
         self._departures = []
         self._next_departure = None
         self._no_data_count = 0
         self._source_warning = False
+        self._fast_refresh = False
 
         ## Initialise sources
         for source in self._rtpi_sources:
             source_data = self._rtpi_sources[source]
             source_data[ATTR_SOURCE_WARNING] = False
+            DEPARTURE_CACHE.acquire(source, self._cache_stop_id(source, source_data))
+            batch_stop_id = self._batch_stop_id(source, source_data)
+            if batch_stop_id:
+                BATCH_STOPS[(source, batch_stop_id)][source_data[CONF_STOP_ID]] += 1
+
+    def release(self):
+        """Release the shared stops and batches of the sources when removed."""
+        for source, source_data in self._rtpi_sources.items():
+            DEPARTURE_CACHE.release(source, self._cache_stop_id(source, source_data))
+            batch_stop_id = self._batch_stop_id(source, source_data)
+            if not batch_stop_id:
+                continue
+            batch_stops = BATCH_STOPS[(source, batch_stop_id)]
+            batch_stops[source_data[CONF_STOP_ID]] -= 1
+            if batch_stops[source_data[CONF_STOP_ID]] <= 0:
+                del batch_stops[source_data[CONF_STOP_ID]]
+            if not batch_stops:
+                del BATCH_STOPS[(source, batch_stop_id)]
 
     def get_departures(self):
         return self._departures
@@ -513,11 +2698,64 @@ class PublicTransportData:  # (metaclass=ABCMeta):
     def get_current_source(self):
         return self._current_source
 
+    def get_source_metrics(self):
+        """Return request metrics and health for each source, keyed by source."""
+        return {
+            source: {
+                **SOURCE_METRICS.get(source, source_data[CONF_STOP_ID]),
+                "health": self._source_health(source, source_data).as_dict(),
+            }
+            for source, source_data in self._rtpi_sources.items()
+        }
+
+    def restore_departures(self, saved_departures):
+        """
+        Restore departures saved before restart.
+
+        Saved departures for the configured source with the highest precedence
+        are aged and filtered immediately, without retrieving any sources.
+        Saved departures for all sources are merged if merging sources.
+        """
+        if self._merge_sources:
+            results = []
+            for source, source_data in self._rtpi_sources.items():
+                departures = saved_departures.get(
+                    (source, self._cache_stop_id(source, source_data))
+                )
+                if departures:
+                    departures = sorted(departures, key=lambda a: a.due_at)
+                    results.append((source, self.fast_update(departures)))
+            if results:
+                _LOGGER.info(
+                    f"{self._stop_id}: restored departures for sources "
+                    f"{', '.join(source for source, _ in results)}"
+                )
+                self._use_merged_sources(results)
+                self._filter_departures()
+            return bool(results)
+        for source in self._rtpi_sources:
+            source_data = self._rtpi_sources[source]
+            stop_id = source_data[CONF_STOP_ID]
+            departures = saved_departures.get(
+                (source, self._cache_stop_id(source, source_data))
+            )
+            if departures:
+                _LOGGER.info(f"{stop_id}: restored departures for source {source}")
+                self._current_source = source
+                departures = sorted(departures, key=lambda a: a.due_at)
+                self._all_departures = self.fast_update(departures)
+                self._index = None
+                self._filter_departures()
+                return True
+        return False
+
     def get_next_refresh(self):
-        scan_multipler = int(round(60 / SCAN_INTERVAL.total_seconds()))
-        if scan_multipler < 1:
-            scan_multipler = 1
-        return int(round(self._next_refresh / scan_multipler))
+        """Return the time until the next full refresh in minutes."""
+        if self._next_fetch_at is None:
+            return 0
+        return max(
+            int(round((self._next_fetch_at - dt_util.utcnow()).total_seconds() / 60)), 0
+        )
 
     # @abstractmethod
     # def update_source(self):
@@ -525,20 +2763,10 @@ class PublicTransportData:  # (metaclass=ABCMeta):
     #     raise Exception
     #     return False
 
-    def _convert_json_datetime(self, dt_json):
-        """Convert JSON timestamp to datetime object."""
-        return datetime(
-            year=int(dt_json["year"]),
-            month=int(dt_json["month"]),
-            day=int(dt_json["day"]),
-            hour=int(dt_json["hour"]),
-            minute=int(dt_json["minute"]),
-        )
-
-    def update_source_tfi_efa(self, stop_id, ssl_verify):
-        """Get the latest data from journeyplanner.transportforireland.ie"""
-        params = {
-            "outputFormat": "JSON",
+    def _tfi_efa_params(self, stop_id, output_format):
+        """Return TFI EFA departure monitor request parameters for a stop."""
+        return {
+            "outputFormat": output_format,
             "coordOutputFormat": "WGS84[dd.ddddd]",
             "language": "en",
             "std3_suggestMacro": "std3_suggest",
@@ -550,18 +2778,32 @@ class PublicTransportData:  # (metaclass=ABCMeta):
             "type_dm": "any",
         }
 
-        response = requests.get(
-            TFI_EFA_RESOURCE, params, verify=ssl_verify, timeout=RTPI_TIMEOUT
-        )
-        if response.status_code != 200:
-            raise Exception("HTTP status: " + str(response.status_code))
+    async def async_update_source_tfi_efa(
+        self, stop_id, ssl_verify, sample, by_stop=False
+    ):
+        """Get the latest data from journeyplanner.transportforireland.ie"""
+        params = self._tfi_efa_params(stop_id, "JSON")
+        async with self._coordinator.async_get(
+            TFI_EFA_RESOURCE, params, ssl_verify
+        ) as response:
+            if response.status != 200:
+                raise HttpStatusError(response.status)
+            content = await response.read()
+        sample.add_bytes(len(content))
+        with sample.parsing():
+            return self._parse_tfi_efa(json.loads(content), by_stop)
+
+    def _parse_tfi_efa(self, efa_data, by_stop=False):
+        """
+        Parse TFI EFA JSON departure data.
 
-        # Parse returned departure JSON data
+        If by_stop is set, departures are returned keyed by stop ID.
+        """
+        decoder = TimestampDecoder()
         departures = []
-        efa_data = response.json()
-
         for dep in efa_data["departureList"]:
             try:
+                stop_id = dep.get("stopID")
                 route = dep["servingLine"]["number"]
                 origin = (
                     dep["servingLine"]["directionFrom"]
@@ -569,173 +2811,126 @@ class PublicTransportData:  # (metaclass=ABCMeta):
                     else "unknown"
                 )
                 destination = dep["servingLine"]["direction"]
-                now = datetime.now().replace(second=0, microsecond=0)
                 direction = (
                     "Outbound"
                     if dep["servingLine"]["liErgRiProj"]["direction"] == "R"
                     else "Inbound"
                 )
-                scheduled_at = self._convert_json_datetime(dep["dateTime"])
+                scheduled_at = decoder.efa_json(dep["dateTime"])
                 countdown = int(dep["countdown"])
                 is_realtime = dep["servingLine"]["realtime"] == "1"
                 if is_realtime:
-                    due_at = now + timedelta(minutes=countdown)
+                    due_at = decoder.countdown(countdown)
                 else:
                     due_at = scheduled_at
             except:
                 _LOGGER.warning(f"Skipping malformed departure: {dep}")
             else:
                 departures.append(
-                    {
-                        ATTR_SOURCE: "tfi_efa",
-                        ATTR_ROUTE: route,
-                        ATTR_DESTINATION: destination,
-                        ATTR_ORIGIN: origin,
-                        ATTR_DIRECTION: direction,
-                        ATTR_SCHEDULED_AT: scheduled_at,
-                        ATTR_DUE_AT: due_at,
-                        ATTR_COUNTDOWN: countdown,
-                        ATTR_IS_REALTIME: is_realtime,
-                    }
+                    (
+                        stop_id,
+                        Departure.create(
+                            "tfi_efa",
+                            route,
+                            destination,
+                            origin,
+                            direction,
+                            scheduled_at,
+                            due_at,
+                            countdown,
+                            is_realtime,
+                        ),
+                    )
                 )
-        departures.sort(key=lambda a: int(a[ATTR_COUNTDOWN]))
-        return departures
+        if by_stop:
+            return Departure.group_by_stop(departures)
+        departures.sort(key=lambda a: a[1].due_at)
+        return [dep for _, dep in departures]
 
-    def _convert_xml_datetime(self, dt_xml):
-        """Convert timestamp to XML datetime object."""
-        date = dict(dt_xml.getElementsByTagName("itdDate")[0].attributes.items())
-        time = dict(dt_xml.getElementsByTagName("itdTime")[0].attributes.items())
-        return datetime(
-            year=int(date["year"]),
-            month=int(date["month"]),
-            day=int(date["day"]),
-            hour=int(time["hour"]),
-            minute=int(time["minute"]),
-        )
-
-    def update_source_tfi_efa_xml(self, stop_id, ssl_verify):
+    async def async_update_source_tfi_efa_xml(
+        self, stop_id, ssl_verify, sample, by_stop=False
+    ):
         """Get the latest data from journeyplanner.transportforireland.ie (XML)"""
-        params = {
-            "outputFormat": "XML",
-            "coordOutputFormat": "WGS84[dd.ddddd]",
-            "language": "en",
-            "std3_suggestMacro": "std3_suggest",
-            "std3_commonMacro": "dm",
-            "mergeDep": "1",
-            "mode": "direct",
-            "useAllStops": "1",
-            "name_dm": stop_id,
-            "type_dm": "any",
-        }
-
-        response = requests.get(
-            TFI_EFA_RESOURCE, params, verify=ssl_verify, timeout=RTPI_TIMEOUT
-        )
-        if response.status_code != 200:
-            raise Exception(f"HTTP status: {str(response.status_code)}")
-
-        # Parse returned departure XML data
-        departures = []
-        xml_data = minidom.parseString(response.content)
-
-        for dep in xml_data.getElementsByTagName("itdDeparture"):
-            itdServingLine = dep.getElementsByTagName("itdServingLine")[0]
-            motDivaParams = itdServingLine.getElementsByTagName("motDivaParams")[0]
-            itdDateTime = dep.getElementsByTagName("itdDateTime")[0]
-            dep_attrs = dict(dep.attributes.items())
-            line_attrs = dict(itdServingLine.attributes.items())
-            line_divaparams = dict(motDivaParams.attributes.items())
-            route = line_attrs["number"]
-            destination = line_attrs["direction"]
-            origin = line_attrs["directionFrom"]
-            countdown = int(dep_attrs["countdown"])
-            is_realtime = line_attrs["realtime"] == "1"
-            direction = line_divaparams["direction"]
-            scheduled_at = self._convert_xml_datetime(itdDateTime)
-            due_at = scheduled_at
-            if is_realtime:
-                itdRTDateTimes = dep.getElementsByTagName("itdRTDateTime")
-                # itRTDateTime does not always seem to be present for
-                # departures flagged realtime
-                if itdRTDateTimes:
-                    due_at = self._convert_xml_datetime(itdRTDateTimes[0])
-                else:
-                    is_realtime = False
-
-            departures.append(
-                {
-                    ATTR_SOURCE: "tfi_efa_xml",
-                    ATTR_ROUTE: route,
-                    ATTR_DESTINATION: destination,
-                    ATTR_ORIGIN: origin,
-                    ATTR_DIRECTION: direction,
-                    ATTR_SCHEDULED_AT: scheduled_at,
-                    ATTR_DUE_AT: due_at,
-                    ATTR_COUNTDOWN: countdown,
-                    ATTR_IS_REALTIME: is_realtime,
-                }
-            )
-            departures.sort(key=lambda a: int(a[ATTR_COUNTDOWN]))
-        return departures
-
-    def _convert_time(self, t):
-        """Convert time string to datetime object."""
-        now = datetime.now().replace(second=0, microsecond=0)
-        tobj = datetime.strptime(t, "%H:%M").time()
-        dt = datetime.combine(now.date(), tobj)
-        if dt < now - timedelta(hours=12):  # time refers to next day
-            dt = dt + timedelta(days=1)
-        elif dt > now + timedelta(hours=12):  # adjust for clock skew
-            dt = dt - timedelta(days=1)
-
-        return dt
-
-    def update_source_irish_rail(self, ir_api, stop_id, direction, ssl_verify):
+        params = self._tfi_efa_params(stop_id, "XML")
+        async with self._coordinator.async_get(
+            TFI_EFA_RESOURCE, params, ssl_verify
+        ) as response:
+            if response.status != 200:
+                raise HttpStatusError(response.status)
+            parser = EfaXmlDepartureParser(TimestampDecoder().efa_xml)
+            async for chunk in response.content.iter_chunked(RTPI_CHUNK_SIZE):
+                sample.add_bytes(len(chunk))
+                with sample.parsing():
+                    parser.feed(chunk)
+        with sample.parsing():
+            return parser.close(by_stop)
+
+    async def _async_update_irish_rail_stations(self, ssl_verify):
+        """Retrieve the list of Irish Rail stations."""
+        async with self._coordinator.async_get(
+            IRISH_RAIL_RESOURCE + "/getAllStationsXML", None, ssl_verify
+        ) as response:
+            if response.status != 200:
+                raise HttpStatusError(response.status)
+            content = await response.read()
+        IRISH_RAIL_STATIONS.update(content)
+
+    async def _async_irish_rail_station_code(self, stop_id, ssl_verify):
+        """Return the station code for a station name."""
+        if not IRISH_RAIL_STATIONS.is_fresh():
+            ## Concurrent requests share a single station list request
+            key = (RTPI_SOURCE_IRISH_RAIL, None, ssl_verify)
+            try:
+                await SOURCE_REQUESTS.async_do(
+                    key, self._async_update_irish_rail_stations, ssl_verify
+                )
+            except Exception as e:
+                ## Without a station list the station cannot be looked up
+                if not IRISH_RAIL_STATIONS.is_loaded():
+                    raise
+                _LOGGER.info(f"Unable to update Irish Rail stations: {str(e)}")
+        return IRISH_RAIL_STATIONS.get_code(stop_id)
+
+    async def async_update_source_irish_rail(
+        self, stop_id, direction, direction_inverse, ssl_verify, sample
+    ):
         """Get the latest data from http://api.irishrail.ie."""
-        # ssl_verify not supported
-        # 2020-06-20 direction stopped returning Northbound and Southbound
-        # for Dublin trains, so now filtering on list of directions
-        # train_data = ir_api.get_station_by_name(stop_id, direction=direction)
-        train_data = ir_api.get_station_by_name(stop_id)
-
-        departures = []
-        for train in train_data:
-            departures.append(
-                {
-                    ATTR_SOURCE: "irish_rail",
-                    ATTR_DESTINATION: train["destination"],
-                    ATTR_ORIGIN: train["origin"],
-                    ATTR_DIRECTION: train["direction"],
-                    ATTR_SCHEDULED_AT: (
-                        self._convert_time(train["scheduled_arrival_time"])
-                    ),
-                    ATTR_DUE_AT: self._convert_time(train["expected_arrival_time"]),
-                    ATTR_COUNTDOWN: int(train["due_in_mins"]),
-                    ATTR_ROUTE: train["type"],
-                    ATTR_IS_REALTIME: True,
-                }
+        station_code = await self._async_irish_rail_station_code(stop_id, ssl_verify)
+        async with self._coordinator.async_get(
+            IRISH_RAIL_RESOURCE + "/getStationDataByCodeXML",
+            {"StationCode": station_code},
+            ssl_verify,
+        ) as response:
+            if response.status != 200:
+                raise HttpStatusError(response.status)
+            parser = IrishRailStationDataParser(
+                TimestampDecoder().time, direction, direction_inverse
             )
-        _LOGGER.debug("IR departures: %s", departures)
-        return departures
-
-    def _convert_datestamp(self, datestamp):
-        return datetime.strptime(datestamp, "%d/%m/%Y %H:%M:%S")
-
-    def update_source_dublin_bus(self, stop_id, ssl_verify):
+            async for chunk in response.content.iter_chunked(RTPI_CHUNK_SIZE):
+                sample.add_bytes(len(chunk))
+                with sample.parsing():
+                    parser.feed(chunk)
+        with sample.parsing():
+            return parser.close()
+
+    async def async_update_source_dublin_bus(self, stop_id, ssl_verify, sample):
         """Get the latest data from http://data.dublinked.ie."""
-
         params = {"stopid": stop_id, "format": "json"}
-
-        response = requests.get(
-            DUBLIN_BUS_RESOURCE, params, verify=ssl_verify, timeout=RTPI_TIMEOUT
-        )
-        if response.status_code != 200:
-            raise Exception(f"HTTP status: {str(response.status_code)}")
-
+        async with self._coordinator.async_get(
+            DUBLIN_BUS_RESOURCE, params, ssl_verify
+        ) as response:
+            if response.status != 200:
+                raise HttpStatusError(response.status)
+            content = await response.read()
+        sample.add_bytes(len(content))
+        with sample.parsing():
+            return self._parse_dublin_bus(json.loads(content))
+
+    def _parse_dublin_bus(self, db_data):
+        """Parse Dublin Bus JSON departure data."""
         ## Parse returned departure JSON data
         departures = []
 
-        db_data = response.json()
         errorcode = str(db_data["errorcode"])
         if errorcode == "1":
             if db_data["numberofresults"] == 0:
@@ -744,247 +2939,762 @@ class PublicTransportData:  # (metaclass=ABCMeta):
         elif errorcode != "0":
             raise Exception("API returned error code " + errorcode)
 
+        decoder = TimestampDecoder()
         for dep in db_data["results"]:
             route = dep["route"]
             origin = dep["origin"]
             destination = dep["destination"]
-            # now = datetime.now().replace(second=0, microsecond=0)
             direction = dep["direction"]
-            scheduled_at = self._convert_datestamp(dep["scheduleddeparturedatetime"])
-            due_at = self._convert_datestamp(dep["departuredatetime"])
+            scheduled_at = decoder.datestamp(dep["scheduleddeparturedatetime"])
+            due_at = decoder.datestamp(dep["departuredatetime"])
             countdown = dep["departureduetime"]
 
             departures.append(
-                {
-                    ATTR_SOURCE: "dublin_bus",
-                    ATTR_ROUTE: route,
-                    ATTR_DESTINATION: destination,
-                    ATTR_ORIGIN: origin,
-                    ATTR_DIRECTION: direction,
-                    ATTR_SCHEDULED_AT: scheduled_at,
-                    ATTR_DUE_AT: due_at,
-                    ATTR_COUNTDOWN: int(countdown) if countdown != "Due" else 0,
-                    ATTR_IS_REALTIME: True,
-                }
+                Departure.create(
+                    "dublin_bus",
+                    route,
+                    destination,
+                    origin,
+                    direction,
+                    scheduled_at,
+                    due_at,
+                    int(countdown) if countdown != "Due" else 0,
+                    True,
+                )
             )
+        departures.sort(key=lambda a: a.due_at)
         return departures
 
-    def fast_update(self, current_departures):
-        """Perform fast update by aging cached departure data."""
-        now = datetime.now()
+    def _gtfs_rt_headers(self, api_key):
+        """Return GTFS-RT request headers, with the API key if configured."""
+        return {"x-api-key": api_key} if api_key else None
+
+    def _read_gtfs_rt_file(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    async def async_update_source_gtfs_rt(
+        self, url, api_key, gtfs_path, ssl_verify, sample, stop_ids
+    ):
+        """Get the latest TripUpdates feed from api.nationaltransport.ie
+
+        url may also be a local feed file, for testing. Routes and
+        destinations are looked up in the timetable at gtfs_path, if specified.
+        """
+        index = None
+        if gtfs_path:
+            index = await async_get_gtfs_static_index(gtfs_path)
+        path = gtfs_rt_feed_path(url)
+        if path is not None:
+            loop = asyncio.get_running_loop()
+            content = await loop.run_in_executor(None, self._read_gtfs_rt_file, path)
+        else:
+            async with self._coordinator.async_get(
+                url, None, ssl_verify, headers=self._gtfs_rt_headers(api_key)
+            ) as response:
+                if response.status != 200:
+                    raise HttpStatusError(response.status)
+                content = await response.read()
+        sample.add_bytes(len(content))
+        with sample.parsing():
+            return self._parse_gtfs_rt(content, stop_ids, index)
+
+    def _parse_gtfs_rt(self, content, stop_ids, index=None):
+        """
+        Parse a GTFS-RT TripUpdates feed into departures keyed by stop ID.
+
+        Only stop time updates for stops in stop_ids are decoded, so that the
+        departures kept for a national feed are limited to monitored stops.
+
+        If a static timetable index is provided, the route name, headsign and
+        scheduled calls of each trip are taken from the timetable, so that
+        departures match the scheduled departures of the gtfs_static source
+        when sources are merged. Delays are then applied to the scheduled
+        times, including delays carried forward from earlier stops. Route IDs
+        of trips not in the timetable are mapped to route names, and only stop
+        time updates with an estimated time are used for these trips.
+        """
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(content)
+        trip_canceled = gtfs_realtime_pb2.TripDescriptor.CANCELED
+        stop_scheduled = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SCHEDULED
+        decoder = TimestampDecoder()
+        now = time.time()
+        departed = now - DEPARTED_AGE.total_seconds()
+        local_now = dt_util.now()
+        service_days = {}
         departures = []
-        for dep in current_departures:
-            countdown = (dep[ATTR_DUE_AT] - now).total_seconds()
-            if countdown >= -60 and countdown < 60:
-                dep[ATTR_COUNTDOWN] = 0
-                departures.append(dep)
-                _LOGGER.debug(f"Departure @ {dep[ATTR_DUE_AT]} is due")
-            elif countdown >= 60:
-                dep[ATTR_COUNTDOWN] = int(round(countdown / 60))
-                departures.append(dep)
-                _LOGGER.debug(
-                    f"Departure @ {dep[ATTR_DUE_AT]} due in "
-                    f"{dep[ATTR_COUNTDOWN]} min"
+
+        def service_day(service_date):
+            day = service_days.get(service_date)
+            if day is None:
+                day = int(
+                    GtfsStaticIndex.service_day(
+                        service_date, local_now.tzinfo
+                    ).timestamp()
                 )
-            else:
-                _LOGGER.debug(f"Departure @ {dep[ATTR_DUE_AT]} aged out")
-        return departures
+                service_days[service_date] = day
+            return day
 
-    def update(self):
-        """Get the latest data from the data source."""
-        _LOGGER.info(f"Refreshing data for stop {self._stop_id}")
-        self._next_refresh -= 1
-        self._scan_count -= 1
-        if self._next_refresh > 0:
-            if self._departures:
-                stop_id = self._rtpi_sources[self._current_source][CONF_STOP_ID]
-                now = datetime.now()
-                countdown = int(
-                    round((self._departures[0][ATTR_DUE_AT] - now).total_seconds() / 60)
+        def add_departure(stop_id, scheduled, due):
+            seconds = due - now
+            departures.append(
+                (
+                    stop_id,
+                    Departure.create(
+                        "gtfs_rt",
+                        route,
+                        destination,
+                        "",
+                        direction,
+                        decoder.epoch(scheduled),
+                        decoder.epoch(due),
+                        int(round(seconds / 60)) if seconds >= 60 else 0,
+                        True,
+                    ),
                 )
-                if countdown > self._fast_refresh_threshold:
-                    _LOGGER.info(
-                        f"Next departure in {countdown} min " "(outside fast refresh)"
-                    )
-                    ## Force fast refresh, ignore scan count
-                    self._scan_count = self._next_refresh
+            )
+
+        for entity in feed.entity:
+            if not entity.HasField("trip_update"):
+                continue
+            trip_update = entity.trip_update
+            trip = trip_update.trip
+            if trip.schedule_relationship == trip_canceled:
+                continue
+            direction = str(trip.direction_id) if trip.HasField("direction_id") else ""
+            destination = ""
+            if trip_update.HasField("trip_properties"):
+                destination = trip_update.trip_properties.trip_headsign
+            route = trip.route_id
+            trip_number = None
+            if index is not None:
+                if trip.trip_id:
+                    trip_number = index.trip_number(trip.trip_id)
+                if trip_number is None:
+                    route = index.route_name(route)
                 else:
-                    _LOGGER.info(
-                        f"Next departure in {countdown} min " "(within fast refresh)"
-                    )
-                    ## Force full refresh, modulo scan count
-                    self._next_refresh = 0
+                    route, headsign = index.trip(trip_number)
+                    destination = headsign or destination
+            if trip_number is not None:
+                if trip.start_date:
+                    days = [
+                        service_day(datetime.strptime(trip.start_date, "%Y%m%d").date())
+                    ]
+                else:
+                    ## Trips of the previous service day may depart after midnight
+                    days = [
+                        service_day(local_now.date() - timedelta(days=offset))
+                        for offset in (1, 0)
+                    ]
+                for stop_id in stop_ids:
+                    for sequence, seconds in index.trip_calls(trip_number, stop_id):
+                        day = min(days, key=lambda day: abs(day + seconds - now))
+                        scheduled = day + seconds
+                        due = gtfs_rt_due_time(
+                            trip_update.stop_time_update, stop_id, sequence, scheduled
+                        )
+                        if due is not None and due >= departed:
+                            add_departure(stop_id, scheduled, due)
+                continue
+            for stop_time in trip_update.stop_time_update:
+                if stop_time.stop_id not in stop_ids:
+                    continue
+                if stop_time.schedule_relationship != stop_scheduled:
+                    continue
+                event = stop_time.departure
+                if not event.time:
+                    event = stop_time.arrival
+                if not event.time or event.time < departed:
+                    continue
+                add_departure(stop_time.stop_id, event.time - event.delay, event.time)
+        return Departure.group_by_stop(departures)
+
+    async def async_update_source_gtfs_static(self, gtfs_path, stop_id, sample):
+        """Get scheduled departures from a static GTFS timetable."""
+        index = await async_get_gtfs_static_index(gtfs_path)
+        with sample.parsing():
+            return index.departures(stop_id, dt_util.now(), GTFS_STATIC_LOOKAHEAD)
+
+    def _cache_max_age(self):
+        """Return the maximum age in seconds of shared cached departures."""
+        if self._fast_refresh:
+            return 60
+        return max(self._refresh_interval, 1) * 60
+
+    def _get_cached_departures(self, source, stop_id):
+        """Return departures for a stop from the shared cache, if fresh."""
+        departures = DEPARTURE_CACHE.get(source, stop_id, self._cache_max_age())
+        if departures is not None:
+            _LOGGER.debug(f"{stop_id}: using cached departures for source {source}")
+            return self.fast_update(departures)
+        return None
+
+    def _batch_stop_id(self, source, source_data):
+        """
+        Return the stop ID queried for a batch of stops, if batching.
+
+        A GTFS-RT feed covers all stops, so all stops using the same feed and
+        timetable are a single batch keyed by the feed URL and timetable path.
+        """
+        if source == RTPI_SOURCE_GTFS_RT:
+            if source_data[CONF_GTFS_PATH]:
+                return f"{source_data[CONF_URL]}|{source_data[CONF_GTFS_PATH]}"
+            return source_data[CONF_URL]
+        if source in RTPI_BATCH_SOURCES:
+            return source_data[CONF_BATCH_STOP_ID]
+        return ""
+
+    def _source_health(self, source, source_data):
+        """Return the health of the host queried for a source."""
+        if source == RTPI_SOURCE_GTFS_RT:
+            url = source_data[CONF_URL]
+        elif source in (RTPI_SOURCE_TFI_EFA, RTPI_SOURCE_TFI_EFA_XML):
+            url = TFI_EFA_RESOURCE
+        elif source == RTPI_SOURCE_DUBLIN_BUS:
+            url = DUBLIN_BUS_RESOURCE
+        elif source == RTPI_SOURCE_IRISH_RAIL:
+            url = IRISH_RAIL_RESOURCE
+        else:
+            url = ""
+        return get_source_health(source, urlsplit(url).netloc)
+
+    def _cache_stop_id(self, source, source_data, stop_id=None):
+        """
+        Return the stop ID that departures for a source are cached under.
+
+        Irish Rail departures are filtered by direction as they are parsed, so
+        are cached separately for each direction filter. GTFS-RT departures
+        are cached separately for each timetable their routes are mapped with.
+        stop_id is a stop in the batch of the source, if not the source stop.
+        """
+        if stop_id is None:
+            stop_id = source_data[CONF_STOP_ID]
+        direction = source_data[CONF_DIRECTION]
+        if source == RTPI_SOURCE_IRISH_RAIL and direction:
+            inverse = "!" if source_data[CONF_DIRECTION_INVERSE] else ""
+            return f"{stop_id}|{inverse}{','.join(sorted(direction))}"
+        if source == RTPI_SOURCE_GTFS_RT and source_data[CONF_GTFS_PATH]:
+            return f"{stop_id}|{source_data[CONF_GTFS_PATH]}"
+        return stop_id
+
+    def _cache_departures(self, source, source_data, departures, fetched_at):
+        """
+        Add departures to the shared cache.
+
+        Batched departures are keyed by the stops requested in the batch.
+        """
+        if departures is None:
+            return
+        if not self._batch_stop_id(source, source_data):
+            DEPARTURE_CACHE.set(
+                source,
+                self._cache_stop_id(source, source_data),
+                departures,
+                fetched_at,
+            )
+            return
+        for stop_id, stop_departures in departures.items():
+            DEPARTURE_CACHE.set(
+                source,
+                self._cache_stop_id(source, source_data, stop_id),
+                stop_departures,
+                fetched_at,
+            )
+
+    async def _async_fetch_source(self, source, source_data):
+        """Get unfiltered departures for a source, using the shared cache.
+
+        Concurrent requests for the same stop share a single fetch.
+        """
+        stop_id = source_data[CONF_STOP_ID]
+        cache_stop_id = self._cache_stop_id(source, source_data)
+        departures = self._get_cached_departures(source, cache_stop_id)
+        if departures is not None:
+            SOURCE_METRICS.record_cache_hit(source, stop_id)
+            return departures
+
+        health = self._source_health(source, source_data)
+
+        def admit():
+            ## Callers joining a request in flight, such as the probe of a half
+            ## open circuit, share its result instead of being refused
+            if not health.allow_request():
+                raise Exception("source unavailable (circuit open)")
+
+        batch_stop_id = self._batch_stop_id(source, source_data)
+        key = (source, batch_stop_id or cache_stop_id, source_data[CONF_SSL_VERIFY])
+        departures = await SOURCE_REQUESTS.async_do(
+            key, self._async_fetch_source_uncached, source, source_data, admit=admit
+        )
+        if batch_stop_id and departures is not None:
+            if stop_id not in departures:
+                ## The stop was added after the batch in flight was requested
+                departures = await SOURCE_REQUESTS.async_do(
+                    key,
+                    self._async_fetch_source_uncached,
+                    source,
+                    source_data,
+                    admit=admit,
+                )
+            departures = departures.get(stop_id, [])
+        return list(departures) if departures is not None else None
+
+    async def _async_fetch_source_uncached(self, source, source_data):
+        """
+        Get unfiltered departures for a source and cache them.
+
+        Batched requests return departures keyed by stop ID, for each stop in
+        the batch when the request is made.
+        """
+        stop_id = source_data[CONF_STOP_ID]
+        ssl_verify = source_data[CONF_SSL_VERIFY]
+        batch_stop_id = self._batch_stop_id(source, source_data)
+        batch_stops = (
+            set(BATCH_STOPS[(source, batch_stop_id)]) if batch_stop_id else None
+        )
+        fetched_at = time.monotonic()
+        sample = FetchSample()
+        try:
+            if source == RTPI_SOURCE_TFI_EFA_XML:
+                departures = await self.async_update_source_tfi_efa_xml(
+                    batch_stop_id or stop_id, ssl_verify, sample, bool(batch_stop_id)
+                )
+            elif source == RTPI_SOURCE_TFI_EFA:
+                departures = await self.async_update_source_tfi_efa(
+                    batch_stop_id or stop_id, ssl_verify, sample, bool(batch_stop_id)
+                )
+            elif source == RTPI_SOURCE_IRISH_RAIL:
+                departures = await self.async_update_source_irish_rail(
+                    stop_id,
+                    source_data[CONF_DIRECTION],
+                    source_data[CONF_DIRECTION_INVERSE],
+                    ssl_verify,
+                    sample,
+                )
+            elif source == RTPI_SOURCE_DUBLIN_BUS:
+                departures = await self.async_update_source_dublin_bus(
+                    stop_id, ssl_verify, sample
+                )
+            elif source == RTPI_SOURCE_GTFS_RT:
+                departures = await self.async_update_source_gtfs_rt(
+                    source_data[CONF_URL],
+                    source_data[CONF_API_KEY],
+                    source_data[CONF_GTFS_PATH],
+                    ssl_verify,
+                    sample,
+                    batch_stops,
+                )
+            elif source == RTPI_SOURCE_GTFS_STATIC:
+                departures = await self.async_update_source_gtfs_static(
+                    source_data[CONF_GTFS_PATH], stop_id, sample
+                )
             else:
-                ## No unfiltered departures, or no departures
-                _LOGGER.info(
-                    "No data, skipping refresh " f"(refresh in {self._next_refresh}"
+                raise Exception(f"{stop_id}: unimplemented source {source}")
+        except Exception as e:
+            latency = time.monotonic() - fetched_at
+            SOURCE_METRICS.record_request(source, stop_id, latency, sample, e=e)
+            if SourceHealth.is_failure(e):
+                self._source_health(source, source_data).record(False, latency)
+            raise
+        if batch_stops is not None:
+            departures = {
+                batch_stop: departures.get(batch_stop, []) for batch_stop in batch_stops
+            }
+        latency = time.monotonic() - fetched_at
+        SOURCE_METRICS.record_request(source, stop_id, latency, sample, departures)
+        self._source_health(source, source_data).record(True, latency)
+        self._cache_departures(source, source_data, departures, fetched_at)
+        return departures
+
+    def _log_retrieve_source(self, source, source_data):
+        _LOGGER.info(
+            f"Retrieving source {source} (stop_id={source_data[CONF_STOP_ID]}, "
+            f"skip_no_results={source_data[CONF_SKIP_NO_RESULTS]}, "
+            f"ssl_verify={source_data[CONF_SSL_VERIFY]})"
+        )
+
+    def _skip_empty_source(self, source, source_data, departures):
+        """Return whether to ignore a source that returned no departures."""
+        if departures != [] or not source_data[CONF_SKIP_NO_RESULTS]:
+            return False
+        if not source_data[ATTR_SOURCE_WARNING]:
+            _LOGGER.warning(
+                f"{source_data[CONF_STOP_ID]}: ignoring empty source {source}"
+            )
+            source_data[ATTR_SOURCE_WARNING] = True
+        return True
+
+    def _use_source(self, source, source_data, departures):
+        """Use departures retrieved from a source if available."""
+        stop_id = source_data[CONF_STOP_ID]
+        if self._skip_empty_source(source, source_data, departures):
+            pass
+        elif departures != None:
+            ## Departure data retrieved from current source
+            if self._current_source and self._current_source != source:
+                _LOGGER.warning(
+                    f"{stop_id}: switching source from "
+                    f"{self._current_source} to {source}"
                 )
-                return True
+            else:
+                _LOGGER.info(f"{stop_id}: using data from source {source}")
+            self._all_departures = departures
+            self._index = DEPARTURE_CACHE.get_index(
+                source, self._cache_stop_id(source, source_data)
+            )
+            self._current_source = source
+            source_data[ATTR_SOURCE_WARNING] = False
+            SOURCE_METRICS.record_chosen(source, stop_id)
+            return True
+        return False
 
-        ## Retrieve departures for sources, using first available source
-        if self._next_refresh <= 0 and self._scan_count <= 0:
-            for source in self._rtpi_sources:
-                source_data = self._rtpi_sources[source]
-                stop_id = source_data[CONF_STOP_ID]
-                skip_no_results = source_data[CONF_SKIP_NO_RESULTS]
-                ssl_verify = source_data[CONF_SSL_VERIFY]
-                _LOGGER.info(
-                    f"Retrieving source {source} (stop_id={stop_id}, "
-                    f"skip_no_results={skip_no_results}, "
-                    f"ssl_verify={ssl_verify})"
+    def _use_merged_sources(self, results):
+        """
+        Use departures merged from (source, departures) retrieved from sources.
+
+        Sources may be retrieved in order of health, but are always merged in
+        the order they are specified, so that the source specified first wins
+        for departures reported by several sources. Empty sources are ignored
+        if skip_no_results is set. The source with the highest precedence is
+        the current source.
+        """
+        precedence = list(self._rtpi_sources)
+        results = sorted(
+            (
+                (source, departures)
+                for source, departures in results
+                if not self._skip_empty_source(
+                    source, self._rtpi_sources[source], departures
                 )
+            ),
+            key=lambda result: precedence.index(result[0]),
+        )
+        if not results:
+            return None
+        now = dt_util.utcnow()
+        for source, departures in results:
+            source_data = self._rtpi_sources[source]
+            source_data[ATTR_SOURCE_WARNING] = False
+            SOURCE_METRICS.record_chosen(source, source_data[CONF_STOP_ID])
+        departures = Departure.merge(
+            self._merge_filters[source].apply(departures, now)
+            for source, departures in results
+        )
+        current_source = results[0][0]
+        if self._current_source and self._current_source != current_source:
+            _LOGGER.warning(
+                f"{self._stop_id}: switching source from "
+                f"{self._current_source} to {current_source}"
+            )
+        self._all_departures = departures
+        self._index = None
+        self._current_source = current_source
+        return departures
+
+    def _source_error(self, source, source_data, e):
+        """Warn once about a source that could not be retrieved."""
+        if not source_data[ATTR_SOURCE_WARNING]:
+            _LOGGER.warning(
+                f"{source_data[CONF_STOP_ID]}: error retrieving data for "
+                f"source {source}: {str(e)}"
+            )
+            source_data[ATTR_SOURCE_WARNING] = True
+
+    def _ordered_sources(self):
+        """Return sources in the order they should be tried."""
+        sources = list(self._rtpi_sources)
+        if self._source_order == SOURCE_ORDER_HEALTH:
+            ## Sorting is stable, so equally healthy sources keep precedence
+            sources.sort(
+                key=lambda source: self._source_health(
+                    source, self._rtpi_sources[source]
+                ).sort_key()
+            )
+        return sources
+
+    async def _async_fetch_merged_sources(self):
+        """
+        Retrieve departures for all sources, and merge them.
+
+        Sources are queried one at a time for the sequential fetch strategy,
+        and all at once otherwise.
+        """
+        sources = self._ordered_sources()
+        for source in sources:
+            self._log_retrieve_source(source, self._rtpi_sources[source])
+        if self._fetch_strategy == FETCH_STRATEGY_SEQUENTIAL:
+            outcomes = []
+            for source in sources:
                 try:
-                    if source == RTPI_SOURCE_TFI_EFA_XML:
-                        departures = self.update_source_tfi_efa_xml(stop_id, ssl_verify)
-                    elif source == RTPI_SOURCE_TFI_EFA:
-                        departures = self.update_source_tfi_efa(stop_id, ssl_verify)
-                    elif source == RTPI_SOURCE_IRISH_RAIL:
-                        ir_api = source_data[RTPI_SOURCE_IRISH_RAIL]
-                        direction = source_data[CONF_DIRECTION]
-                        departures = self.update_source_irish_rail(
-                            ir_api, stop_id, direction, ssl_verify
+                    outcomes.append(
+                        await self._async_fetch_source(
+                            source, self._rtpi_sources[source]
                         )
-                    elif source == RTPI_SOURCE_DUBLIN_BUS:
-                        departures = self.update_source_dublin_bus(stop_id, ssl_verify)
+                    )
+                except Exception as e:
+                    outcomes.append(e)
+        else:
+            outcomes = await asyncio.gather(
+                *[
+                    self._async_fetch_source(source, self._rtpi_sources[source])
+                    for source in sources
+                ],
+                return_exceptions=True,
+            )
+        results = []
+        for source, outcome in zip(sources, outcomes):
+            if isinstance(outcome, Exception):
+                self._source_error(source, self._rtpi_sources[source], outcome)
+            elif outcome is not None:
+                results.append((source, outcome))
+        return self._use_merged_sources(results)
+
+    async def _async_fetch_sources(self):
+        """
+        Retrieve departures for sources, using first available source.
+
+        Sources are started according to the fetch strategy, but their results
+        are always considered in the order of the sources.
+        """
+        if self._merge_sources:
+            return await self._async_fetch_merged_sources()
+        sources = self._ordered_sources()
+        if self._fetch_strategy == FETCH_STRATEGY_CONCURRENT:
+            hedge_delay = 0
+        elif self._fetch_strategy == FETCH_STRATEGY_HEDGED:
+            hedge_delay = self._hedge_delay
+        else:
+            hedge_delay = None
+        tasks = []
+
+        def start_next_source():
+            source = sources[len(tasks)]
+            source_data = self._rtpi_sources[source]
+            self._log_retrieve_source(source, source_data)
+            tasks.append(
+                asyncio.ensure_future(self._async_fetch_source(source, source_data))
+            )
+
+        departures = None
+        try:
+            if hedge_delay == 0:
+                while len(tasks) < len(sources):
+                    start_next_source()
+            for index, source in enumerate(sources):
+                source_data = self._rtpi_sources[source]
+                if len(tasks) <= index:
+                    start_next_source()
+                task = tasks[index]
+                while not task.done():
+                    if hedge_delay is not None and len(tasks) < len(sources):
+                        ## Start next source if no response within hedge delay
+                        await asyncio.wait([task], timeout=hedge_delay)
+                        if not task.done():
+                            start_next_source()
                     else:
-                        raise Exception(f"{stop_id}: unimplemented source {source}")
-                    if departures == [] and skip_no_results:
-                        if not source_data[ATTR_SOURCE_WARNING]:
-                            _LOGGER.warning(
-                                f"{stop_id}: ignoring empty source {source}"
-                            )
-                            source_data[ATTR_SOURCE_WARNING] = True
-                    elif departures != None:
-                        ## Departure data retrieved from current source
-                        if self._current_source and self._current_source != source:
-                            _LOGGER.warning(
-                                f"{stop_id}: switching source from "
-                                f"{self._current_source} to {source}"
-                            )
-                        else:
-                            _LOGGER.info(f"{stop_id}: using data from source {source}")
-                        self._all_departures = departures
-                        self._current_source = source
-                        source_data[ATTR_SOURCE_WARNING] = False
+                        await asyncio.wait([task])
+                try:
+                    departures = task.result()
+                    if self._use_source(source, source_data, departures):
                         break
                 except Exception as e:
                     departures = None
-                    if not source_data[ATTR_SOURCE_WARNING]:
-                        _LOGGER.warning(
-                            f"{stop_id}: error retrieving data for "
-                            f"source {source}: {str(e)}"
-                        )
-                        source_data[ATTR_SOURCE_WARNING] = True
-
-            if departures == None:
-                if self._all_departures:
-                    if not self._source_warning:
-                        _LOGGER.warning(
-                            f"{self._stop_id}: no available data "
-                            "sources, using cached data"
-                        )
-                        self._source_warning = True
-                    self._all_departures = self.fast_update(self._all_departures)
-                else:
-                    _LOGGER.error(f"{self._stop_id}: no data sources")
-                    return False
-            else:
-                self._source_warning = False
-        else:
-            ## Perform fast refresh
+                    self._source_error(source, source_data, e)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()  # retrieve unused task exceptions
+        return departures
+
+    def fast_update(self, current_departures, now=None):
+        """
+        Perform fast update by aging cached departure data.
+
+        Departures are sorted by due time, so departures that have aged out
+        are dropped from the head of the list found by binary search.
+        Countdowns are calculated from a single time when departures are
+        filtered, rather than for every departure.
+        """
+        if now is None:
+            now = dt_util.utcnow()
+        start = bisect.bisect_left(
+            current_departures, now - DEPARTED_AGE, key=lambda a: a.due_at
+        )
+        if start == 0:
+            return current_departures
+        _LOGGER.debug(f"{start} departures aged out")
+        return current_departures[start:]
+
+    def _begin_update(self):
+        """
+        Determine the type of update required.
+
+        Returns True for a full refresh, False for a fast refresh and None if
+        the update should be skipped.
+        """
+        _LOGGER.info(f"Refreshing data for stop {self._stop_id}")
+        now = dt_util.utcnow() + UPDATE_TOLERANCE
+        self._fast_refresh = False
+        if self._next_fetch_at is None or now >= self._next_fetch_at:
+            return True
+        if not self._departures:
+            ## No unfiltered departures, or no departures
             _LOGGER.info(
-                f"{self._stop_id}: Performing fast update "
-                f"(next_refresh={self._next_refresh}, "
-                f"scan_count={self._scan_count})"
+                "No data, skipping refresh " f"(refresh in {self.get_next_refresh()})"
             )
-            self._all_departures = self.fast_update(self._all_departures)
-
-        ## Regenerate filtered departure results
-        self._departures = []
-        self._next_departure = None
-        departure_count = 0
+            return None
 
-        source = self._current_source
-        source_data = self._rtpi_sources[source]
-        direction = source_data[CONF_DIRECTION]
-        direction_inverse = source_data[CONF_DIRECTION_INVERSE]
-        realtime_only = source_data[CONF_REALTIME_ONLY]
-        limit_time_horizon = self._limit_time_horizon
-        limit_departures = self._limit_departures
-        route = source_data[CONF_ROUTE]
-        route_list = source_data[CONF_ROUTE_LIST]
-        if route_list == [] and route != "":
-            route_list = [route]
+        countdown = int(round((self._departures[0].due_at - now).total_seconds() / 60))
+        if countdown > self._fast_refresh_threshold:
+            _LOGGER.info(f"Next departure in {countdown} min " "(outside fast refresh)")
+            return False
+        _LOGGER.info(f"Next departure in {countdown} min " "(within fast refresh)")
+        ## Departures restored after restart have not been fetched yet
+        if (
+            self._last_fetch_at is None
+            or now >= self._last_fetch_at + FAST_REFRESH_INTERVAL
+        ):
+            self._fast_refresh = True
+            return True
+        return False
+
+    def _process_fetched_departures(self, departures):
+        """Fall back to cached departures if no source was available."""
+        if departures == None:
+            if self._all_departures:
+                if not self._source_warning:
+                    _LOGGER.warning(
+                        f"{self._stop_id}: no available data "
+                        "sources, using cached data"
+                    )
+                    self._source_warning = True
+                self._all_departures = self.fast_update(self._all_departures)
+            else:
+                _LOGGER.error(f"{self._stop_id}: no data sources")
+                self._next_fetch_at = (
+                    dt_util.utcnow() + SCAN_INTERVAL + self._coordinator.fetch_jitter()
+                )
+                return False
+        else:
+            self._source_warning = False
+        return True
 
-        _LOGGER.debug(
-            f"Filter: realtime_only: {realtime_only}, "
-            f"route_list: {route_list}, direction: {direction} "
-            f"(inverse: {direction_inverse}), "
-            f"limit_time_horizon: {limit_time_horizon}, "
-            f"limit_departures: {limit_departures}"
+    def _fast_refresh_departures(self):
+        """Perform fast refresh."""
+        _LOGGER.info(
+            f"{self._stop_id}: Performing fast update "
+            f"(next refresh at {self._next_fetch_at})"
         )
-        for dep_entry in self._all_departures:
-            dep_route = dep_entry[ATTR_ROUTE]
-            dep_direction = dep_entry[ATTR_DIRECTION]
-            dep_due_at = dep_entry[ATTR_DUE_AT]
-            dep_countdown = dep_entry[ATTR_COUNTDOWN]
-            dep_is_realtime = dep_entry[ATTR_IS_REALTIME]
+        self._all_departures = self.fast_update(self._all_departures)
 
-            if (
-                (not realtime_only or dep_is_realtime)
-                and (not route_list or dep_route in route_list)
-                and (
-                    (not direction)
-                    or ((not direction_inverse) and dep_direction in direction)
-                    or (direction_inverse and not (dep_direction in direction))
-                )
-                and (dep_countdown >= 0)
-                and (limit_time_horizon == 0 or dep_countdown <= limit_time_horizon)
-                and (limit_departures == 0 or departure_count < limit_departures)
-            ):
-                _LOGGER.debug(
-                    "Added departure for "
-                    f"{dep_route}({dep_direction}) @ {dep_due_at} "
-                    f"({dep_countdown} min) (is_realtime={dep_is_realtime})"
+    async def async_update(self):
+        """Get the latest data from the data source."""
+        full_refresh = self._begin_update()
+        if full_refresh is None:
+            return True
+        if full_refresh:
+            departures = await self._async_fetch_sources()
+            if not self._process_fetched_departures(departures):
+                return False
+        else:
+            self._fast_refresh_departures()
+        self._filter_departures()
+        if full_refresh:
+            self._schedule_next_fetch()
+        return True
+
+    def _schedule_next_fetch(self):
+        """Determine when departures are next retrieved from the sources."""
+        now = dt_util.utcnow()
+        self._last_fetch_at = now
+        self._next_fetch_at = now + max(
+            timedelta(minutes=self._refresh_interval), SCAN_INTERVAL
+        )
+        if self._departures:
+            ## Upcoming unfiltered departures, use normal refresh period
+            self._no_data_count = 0
+        elif self._next_departure:
+            ## No unfiltered departures but received filtered departures
+            countdown = self._next_departure.countdown_at(now) or 0
+            if countdown > self._limit_time_horizon:
+                self._next_fetch_at = now + timedelta(
+                    minutes=countdown - self._limit_time_horizon
                 )
-                self._departures.append(dep_entry)
-                departure_count += 1
             else:
-                _LOGGER.debug(
-                    "Filtered departure for "
-                    f"{dep_route}({dep_direction}) @ {dep_due_at} "
-                    f"({dep_countdown} min) (is_realtime={dep_is_realtime})"
-                )
+                ## Next departure within time horizon, use normal refresh period
                 pass
-            if not self._next_departure:
-                self._next_departure = dep_entry
-
-        ## Determine next refresh cycle
-        if self._next_refresh <= 0 and self._scan_count <= 0:
-            scan_multipler = int(round(60 / SCAN_INTERVAL.total_seconds()))
-            if scan_multipler < 1:
-                scan_multipler = 1
-            self._next_refresh = self._refresh_interval * scan_multipler
-            self._scan_count = scan_multipler
-            if self._departures:
-                ## Upcoming unfiltered departures, use normal refresh period
-                self._no_data_count = 0
-            elif self._next_departure:
-                ## No unfiltered departures but received filtered departures
-                if self._next_departure[ATTR_COUNTDOWN] > limit_time_horizon:
-                    self._next_refresh = (
-                        self._next_departure[ATTR_COUNTDOWN] - limit_time_horizon
-                    ) * scan_multipler
-                else:
-                    ## Next departure within time horizon, use normal refresh period
-                    pass
+        else:
+            ## No unfiltered or filtered departures
+            self._no_data_count += 1
+            if self._no_data_count > 2:
+                self._next_fetch_at = now + timedelta(
+                    minutes=self._no_data_refresh_interval
+                )
             else:
-                ## No unfiltered or filtered departures
-                self._no_data_count += 1
-                if self._no_data_count > 2:
-                    self._next_refresh = self._no_data_refresh_interval * scan_multipler
-                else:
-                    ## No data received less than twice, use normal refresh period
-                    pass
+                ## No data received less than twice, use normal refresh period
+                pass
+        self._next_fetch_at += self._coordinator.fetch_jitter()
+
+    def _next_countdown_change(self, dep, now):
+        """Return when the rendered countdown of a departure next changes."""
+        seconds = (dep.due_at - now).total_seconds()
+        if seconds < 60:
+            ## Departure is due, and ages out after a minute
+            change_at = dep.due_at + timedelta(seconds=60)
+        else:
+            ## Countdown is rounded to the nearest minute, and is due from
+            ## one minute before departure
+            boundary = max(math.ceil(seconds / 60 - 0.5) - 0.5, 1)
+            change_at = dep.due_at - timedelta(minutes=boundary)
+        return change_at + UPDATE_TOLERANCE
 
-        return True
+    def get_next_update(self):
+        """
+        Return when this stop next needs to be updated.
+
+        This is the earliest of the next full refresh, the next fast refresh
+        of a departure due within fast_refresh_threshold, and the next change
+        of a rendered countdown.
+        """
+        now = dt_util.utcnow()
+        if self._next_fetch_at is None:
+            return now
+        next_update = self._next_fetch_at
+        if self._departures:
+            first = self._departures[0]
+            fast_refresh_at = first.due_at - timedelta(
+                minutes=self._fast_refresh_threshold + 0.5
+            )
+            if self._last_fetch_at is not None:
+                fast_refresh_at = max(
+                    fast_refresh_at, self._last_fetch_at + FAST_REFRESH_INTERVAL
+                )
+            next_update = min(next_update, fast_refresh_at)
+            for dep in self._departures:
+                next_update = min(next_update, self._next_countdown_change(dep, now))
+        return next_update
+
+    def _filter_departures(self):
+        """Regenerate filtered departure results."""
+        if self._merge_sources:
+            departure_filter = self._merged_filter
+        else:
+            departure_filter = self._filters[self._current_source]
+        departures = None
+        if self._index is not None:
+            departures = departure_filter.select(self._index)
+        if departures is None:
+            departures = self._all_departures
+        self._departures = departure_filter.apply(departures, dt_util.utcnow())
+        self._next_departure = self._all_departures[0] if self._all_departures else None
+        ## Lazy arguments, as the filter is only formatted if logged
+        _LOGGER.debug(
+            "%s: %d of %d departures after filter (%s)",
+            self._stop_id,
+            len(self._departures),
+            len(self._all_departures),
+            departure_filter,
+        )
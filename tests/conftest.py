@@ -0,0 +1,115 @@
+"""Fixtures for the sensor platform tests."""
+import csv
+import os
+import sys
+from datetime import timedelta
+
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "benchmarks")
+)
+
+from common import load_sensor_module  # noqa: E402
+
+
+@pytest.fixture
+def sensor():
+    """Return the sensor platform module, with empty shared state."""
+    module = load_sensor_module()
+    module.DEPARTURE_CACHE = module.DepartureCache()
+    module.IRISH_RAIL_STATIONS = module.IrishRailStations()
+    module.SOURCE_HEALTH.clear()
+    module.BATCH_STOPS.clear()
+    module.GTFS_STATIC_INDEXES.clear()
+    return module
+
+
+@pytest.fixture
+def dublin_time_zone(sensor):
+    """Use the Europe/Dublin time zone as the Home Assistant time zone."""
+    time_zone = sensor.dt_util.DEFAULT_TIME_ZONE
+    sensor.dt_util.set_default_time_zone(sensor.dt_util.get_time_zone("Europe/Dublin"))
+    yield
+    sensor.dt_util.set_default_time_zone(time_zone)
+
+
+def write_gtfs_table(path, name, rows):
+    """Write a table of a GTFS timetable, with its header as the first row."""
+    with open(os.path.join(path, name), "w", newline="") as f:
+        csv.writer(f).writerows(rows)
+
+
+@pytest.fixture
+def gtfs_path(sensor, tmp_path):
+    """
+    Return the path of a GTFS timetable with a single trip t1, departing stop
+    767 in 5 minutes and then stop 768 in 10 minutes, for Phoenix Park on
+    route 46A (route ID r46A).
+    """
+    now = sensor.dt_util.now()
+    departs_at = now.replace(second=0, microsecond=0) + timedelta(minutes=10)
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def gtfs_time(t):
+        seconds = int((t - midnight).total_seconds())
+        return f"{seconds // 3600}:{seconds // 60 % 60:02}:00"
+
+    write_gtfs_table(
+        tmp_path, "routes.txt", [["route_id", "route_short_name"], ["r46A", "46A"]]
+    )
+    write_gtfs_table(
+        tmp_path,
+        "calendar.txt",
+        [
+            ["service_id", "monday", "tuesday", "wednesday", "thursday", "friday"]
+            + ["saturday", "sunday", "start_date", "end_date"],
+            ["daily"] + ["1"] * 7 + ["20000101", "20991231"],
+        ],
+    )
+    write_gtfs_table(
+        tmp_path,
+        "trips.txt",
+        [
+            ["route_id", "service_id", "trip_id", "trip_headsign", "direction_id"],
+            ["r46A", "daily", "t1", "Phoenix Park", "0"],
+        ],
+    )
+    write_gtfs_table(
+        tmp_path,
+        "stop_times.txt",
+        [
+            ["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"],
+            ["t1"] + [gtfs_time(departs_at - timedelta(minutes=5))] * 2 + ["767", "1"],
+            ["t1"] + [gtfs_time(departs_at)] * 2 + ["768", "2"],
+        ],
+    )
+    return str(tmp_path)
+
+
+@pytest.fixture
+def make_data(sensor):
+    """Return a factory for data objects for a stop, without network access."""
+
+    def make_data(sources, fast_refresh_threshold=0, merge_sources=False):
+        rtpi_sources = sensor.CONF_RTPI_SCHEMA(sources)
+        for source_data in rtpi_sources.values():
+            if source_data[sensor.CONF_STOP_ID] == "":
+                source_data[sensor.CONF_STOP_ID] = "768"
+        coordinator = sensor.RtpiCoordinator(sensor.RtpiSessionPool(), fetch_jitter=0)
+        return sensor.PublicTransportData(
+            "768",
+            rtpi_sources,
+            sensor.DEFAULT_LIMIT_TIME_HORIZON,
+            0,
+            sensor.DEFAULT_REFRESH_INTERVAL,
+            sensor.DEFAULT_NO_DATA_REFRESH_INTERVAL,
+            fast_refresh_threshold,
+            sensor.FETCH_STRATEGY_SEQUENTIAL,
+            sensor.DEFAULT_HEDGE_DELAY,
+            sensor.SOURCE_ORDER_PRECEDENCE,
+            merge_sources,
+            coordinator,
+        )
+
+    return make_data
@@ -0,0 +1,599 @@
+"""Tests for the sensor platform."""
+import asyncio
+import collections
+import contextlib
+import json
+import os
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import aiohttp
+import pytest
+
+
+def make_departure(sensor, minutes, route="46A", source="tfi_efa"):
+    """Return a real-time departure due in minutes."""
+    due_at = sensor.dt_util.now().replace(microsecond=0) + timedelta(minutes=minutes)
+    return sensor.Departure.create(
+        source,
+        route,
+        "Dun Laoghaire",
+        "Phoenix Park",
+        "Outbound",
+        due_at,
+        due_at,
+        minutes,
+        True,
+    )
+
+
+@pytest.mark.parametrize("fast_refresh_threshold", [0, 5])
+def test_restore_then_schedule(sensor, make_data, fast_refresh_threshold):
+    """Restored departures can be scheduled before the first fetch."""
+    data = make_data({"tfi_efa": {}}, fast_refresh_threshold)
+    saved = {("tfi_efa", "768"): [make_departure(sensor, 3)]}
+    assert data.restore_departures(saved)
+    assert len(data.get_departures()) == 1
+
+    next_update = data.get_next_update()
+    assert next_update <= sensor.dt_util.utcnow() + timedelta(minutes=3)
+    ## The first update refreshes the departures, whether due to the pending
+    ## full refresh or a fast refresh of the restored departure
+    data._next_fetch_at = sensor.dt_util.utcnow() + timedelta(minutes=10)
+    assert data._begin_update() is (fast_refresh_threshold > 0)
+
+
+@pytest.mark.parametrize(
+    "error,failure",
+    [
+        (asyncio.TimeoutError(), True),
+        (aiohttp.ClientConnectionError(), True),
+        (500, True),
+        (503, True),
+        (404, False),
+        (429, False),
+        ## Messages that only look like HTTP errors are not HTTP errors
+        (Exception("HTTP status: 503"), False),
+        (Exception("API returned error code 2"), False),
+        (Exception("unknown Irish Rail station Tara"), False),
+    ],
+)
+def test_health_failures(sensor, error, failure):
+    """Only service errors count as source failures."""
+    if isinstance(error, int):
+        error = sensor.HttpStatusError(error)
+        assert sensor.SourceMetrics.error_type(error) == "http"
+    assert sensor.SourceHealth.is_failure(error) is failure
+
+
+@pytest.mark.parametrize(
+    "error,circuit_open",
+    [(503, True), (404, False), ("API returned error code 2", False)],
+)
+def test_stop_errors_do_not_open_circuit(sensor, make_data, error, circuit_open):
+    """Errors for a stop do not open the circuit for other stops."""
+
+    async def fail(*args):
+        if isinstance(error, int):
+            raise sensor.HttpStatusError(error)
+        raise Exception(error)
+
+    data = make_data({"dublin_bus": {}})
+    data.async_update_source_dublin_bus = fail
+    source_data = data._rtpi_sources["dublin_bus"]
+    for _ in range(sensor.CIRCUIT_FAILURE_THRESHOLD):
+        with pytest.raises(Exception):
+            asyncio.run(data._async_fetch_source("dublin_bus", source_data))
+    health = data._source_health("dublin_bus", source_data)
+    assert health.allow_request() is not circuit_open
+    ## Health is kept per source and host
+    assert sensor.get_source_health("dublin_bus", "example.com").allow_request()
+
+
+def test_index_select(sensor):
+    """Index selections keep due time order and are consumed lazily."""
+    departures = [
+        make_departure(sensor, minutes, route)
+        for minutes, route in enumerate(["46A", "145", "46A", "39A", "145", "46A"])
+    ]
+    index = sensor.DepartureIndex(departures)
+    selection = index.select(frozenset(["46A", "145"]), None)
+    assert next(selection) is departures[0]
+    assert list(selection) == [departures[i] for i in (1, 2, 4, 5)]
+    assert list(index.select(frozenset(["39A"]), frozenset(["Outbound"]))) == [
+        departures[3]
+    ]
+    assert list(index.select(frozenset(["39A"]), frozenset(["Inbound"]))) == []
+
+
+def departs_at(sensor, minutes=10):
+    """Return the time in minutes, truncated to the minute."""
+    now = sensor.dt_util.now().replace(second=0, microsecond=0)
+    return now + timedelta(minutes=minutes)
+
+
+def gtfs_rt_feed(sensor, stop_time_updates=None, route_id="r46A", trip_id="t1"):
+    """
+    Return a GTFS-RT feed with stop time updates for a trip, by default
+    departing stop 768 in 10 minutes.
+    """
+    if stop_time_updates is None:
+        departure = {"time": int(departs_at(sensor).timestamp())}
+        stop_time_updates = [{"stop_id": "768", "departure": departure}]
+    feed = sensor.gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    trip_update = feed.entity.add(id=trip_id).trip_update
+    trip_update.trip.trip_id = trip_id
+    trip_update.trip.route_id = route_id
+    for fields in stop_time_updates:
+        trip_update.stop_time_update.add(**fields)
+    return feed.SerializeToString()
+
+
+def test_gtfs_rt_route_names(sensor, make_data, gtfs_path, tmp_path):
+    """GTFS-RT route IDs are mapped to route names with the timetable."""
+    feed_path = tmp_path / "TripUpdates.pb"
+    feed_path.write_bytes(gtfs_rt_feed(sensor))
+    unmapped = make_data({"gtfs_rt": {"url": str(feed_path)}})
+    mapped = make_data({"gtfs_rt": {"url": str(feed_path), "gtfs_path": gtfs_path}})
+    for data, route in ((unmapped, "r46A"), (mapped, "46A")):
+        source_data = data._rtpi_sources["gtfs_rt"]
+        departures = asyncio.run(data._async_fetch_source("gtfs_rt", source_data))
+        assert [dep.route for dep in departures] == [route]
+
+
+def test_merge_gtfs_rt_with_timetable(sensor, make_data, gtfs_path, tmp_path):
+    """GTFS-RT departures overlay the scheduled departures of their trips."""
+    feed_path = tmp_path / "TripUpdates.pb"
+    feed_path.write_bytes(gtfs_rt_feed(sensor))
+    data = make_data(
+        {
+            "gtfs_static": {"gtfs_path": gtfs_path},
+            "gtfs_rt": {"url": str(feed_path), "gtfs_path": gtfs_path},
+        },
+        merge_sources=True,
+    )
+    assert asyncio.run(data.async_update())
+    departures = data.get_departures()
+    assert [(dep.route, dep.destination) for dep in departures] == [
+        ("46A", "Phoenix Park")
+    ]
+    assert departures[0].is_realtime
+
+
+@pytest.mark.parametrize(
+    "stop_time_updates,delay",
+    [
+        ## Delay only, for the stop itself
+        ([{"stop_id": "768", "departure": {"delay": 120}}], 2),
+        ([{"stop_sequence": 2, "arrival": {"delay": 60}}], 1),
+        ## Delay carried forward from an earlier stop
+        ([{"stop_sequence": 1, "stop_id": "767", "departure": {"delay": 180}}], 3),
+        (
+            [
+                {"stop_sequence": 1, "departure": {"delay": 180}},
+                {"stop_sequence": 2, "departure": {"delay": 240}},
+            ],
+            4,
+        ),
+        ## Updates for later stops do not apply
+        ([{"stop_sequence": 3, "departure": {"delay": 180}}], None),
+        ## Skipped stops have no departure
+        ([{"stop_sequence": 2, "schedule_relationship": "SKIPPED"}], None),
+    ],
+)
+def test_gtfs_rt_delays(sensor, make_data, gtfs_path, stop_time_updates, delay):
+    """Delays are applied to the scheduled times from the timetable."""
+    data = make_data({"gtfs_rt": {"gtfs_path": gtfs_path}})
+    index = sensor.get_gtfs_static_index(gtfs_path)
+    content = gtfs_rt_feed(sensor, stop_time_updates)
+    departures = data._parse_gtfs_rt(content, {"768"}, index).get("768", [])
+    if delay is None:
+        assert departures == []
+        return
+    assert [dep.scheduled_at for dep in departures] == [departs_at(sensor)]
+    assert departures[0].due_at == departs_at(sensor, 10 + delay)
+    assert departures[0].route == "46A"
+
+
+def test_gtfs_static_compile_runs(sensor, gtfs_path, monkeypatch):
+    """Timetables compiled in several sorted runs give the same index."""
+    monkeypatch.setattr(sensor, "GTFS_STATIC_COMPILE_CHUNK", 1)
+    index = sensor.get_gtfs_static_index(gtfs_path)
+    departures = index.departures(
+        "768", sensor.dt_util.now(), sensor.GTFS_STATIC_LOOKAHEAD
+    )
+    assert [(dep.route, dep.destination) for dep in departures] == [
+        ("46A", "Phoenix Park")
+    ]
+    assert departures[0].due_at == departs_at(sensor)
+    trip_number = index.trip_number("t1")
+    assert [sequence for sequence, _ in index.trip_calls(trip_number, "767")] == [1]
+    assert [sequence for sequence, _ in index.trip_calls(trip_number, "768")] == [2]
+
+
+def test_gtfs_static_updated(sensor, gtfs_path):
+    """Indexes are compiled again when their timetable is replaced."""
+    index = sensor.get_gtfs_static_index(gtfs_path)
+    assert sensor.get_gtfs_static_index(gtfs_path) is index
+    trips_path = os.path.join(gtfs_path, "trips.txt")
+    with open(trips_path) as f:
+        trips = f.read()
+    with open(trips_path, "w") as f:
+        f.write(trips.replace("Phoenix Park", "Heuston Station"))
+    ## Replaced timetables may keep an earlier modification time
+    mtime = os.path.getmtime(trips_path) - 3600
+    for name in os.listdir(gtfs_path):
+        if name.endswith(".txt"):
+            os.utime(os.path.join(gtfs_path, name), (mtime, mtime))
+
+    updated = sensor.get_gtfs_static_index(gtfs_path)
+    assert updated is not index
+    departures = updated.departures(
+        "768", sensor.dt_util.now(), sensor.GTFS_STATIC_LOOKAHEAD
+    )
+    assert [dep.destination for dep in departures] == ["Heuston Station"]
+
+
+def test_gtfs_static_checked_periodically(sensor, gtfs_path, monkeypatch):
+    """The event loop uses the loaded index until it is due to be checked."""
+    index = sensor.get_gtfs_static_index(gtfs_path)
+    monkeypatch.setattr(sensor, "get_gtfs_static_index", None)
+    assert asyncio.run(sensor.async_get_gtfs_static_index(gtfs_path)) is index
+
+
+def fetch_merged(data, fetched):
+    """Retrieve and merge departures from sources returning fetched[source]."""
+
+    async def async_fetch_source(source, source_data):
+        return fetched[source]
+
+    data._async_fetch_source = async_fetch_source
+    return asyncio.run(data._async_fetch_merged_sources())
+
+
+def test_merge_precedence_with_health_order(sensor, make_data):
+    """Sources retrieved in order of health are merged in configured order."""
+    data = make_data({"tfi_efa": {}, "dublin_bus": {}}, merge_sources=True)
+    assert list(data._rtpi_sources) == ["tfi_efa", "dublin_bus"]
+    data._ordered_sources = lambda: ["dublin_bus", "tfi_efa"]
+    departures = fetch_merged(
+        data,
+        {
+            "tfi_efa": [make_departure(sensor, 5, source="tfi_efa")],
+            "dublin_bus": [make_departure(sensor, 5, source="dublin_bus")],
+        },
+    )
+    assert [dep.source for dep in departures] == ["tfi_efa"]
+    assert data.get_current_source() == "tfi_efa"
+
+
+@pytest.mark.parametrize(
+    "skip_no_results,current_source", [(False, "tfi_efa"), (True, "dublin_bus")]
+)
+def test_merge_skip_no_results(sensor, make_data, skip_no_results, current_source):
+    """Empty sources are ignored when merging if skip_no_results is set."""
+    data = make_data(
+        {"tfi_efa": {"skip_no_results": skip_no_results}, "dublin_bus": {}},
+        merge_sources=True,
+    )
+    departures = fetch_merged(
+        data,
+        {"tfi_efa": [], "dublin_bus": [make_departure(sensor, 5, source="dublin_bus")]},
+    )
+    assert len(departures) == 1
+    assert data.get_current_source() == current_source
+
+
+class FakeBus:
+    """Event bus recording listeners, for objects that need Home Assistant."""
+
+    def __init__(self):
+        self.listeners = {}
+
+    def async_listen_once(self, event_type, listener):
+        self.listeners[event_type] = listener
+
+
+def test_session_pool_connector(sensor):
+    """Sessions within Home Assistant have a connector of their own."""
+    hass = SimpleNamespace(bus=FakeBus())
+    pool = sensor.RtpiSessionPool(3, hass)
+
+    async def async_test():
+        session = pool.async_get_session(True)
+        assert session.connector.limit_per_host == 3
+        assert pool.async_get_session(False).connector is not session.connector
+        await hass.bus.listeners[sensor.EVENT_HOMEASSISTANT_CLOSE](None)
+        assert session.closed
+
+    asyncio.run(async_test())
+
+
+class FakeSessionPool:
+    """Session pool whose requests to a host wait until the host is released."""
+
+    def __init__(self):
+        self.released = collections.defaultdict(asyncio.Event)
+
+    @contextlib.asynccontextmanager
+    async def async_get(self, url, params, ssl_verify, headers=None):
+        await self.released[url].wait()
+        yield url
+
+
+def test_coordinator_concurrency_per_host(sensor):
+    """Requests in flight to a slow host do not hold up other hosts."""
+    pool = FakeSessionPool()
+    coordinator = sensor.RtpiCoordinator(pool, max_concurrent_requests=1)
+
+    async def async_get(url):
+        async with coordinator.async_get(url, None, True) as response:
+            return response
+
+    async def async_test():
+        slow = asyncio.create_task(async_get("http://slow.example/"))
+        await asyncio.sleep(0)
+        pool.released["http://fast.example/"].set()
+        fast = await asyncio.wait_for(async_get("http://fast.example/"), 1)
+        assert fast == "http://fast.example/"
+        assert not slow.done()
+        pool.released["http://slow.example/"].set()
+        assert await slow == "http://slow.example/"
+
+    asyncio.run(async_test())
+
+
+def test_half_open_probe_shared(sensor, make_data):
+    """Callers joining the probe of a half open circuit share its result."""
+    data = make_data({"dublin_bus": {}})
+    source_data = data._rtpi_sources["dublin_bus"]
+    health = data._source_health("dublin_bus", source_data)
+    for _ in range(sensor.CIRCUIT_FAILURE_THRESHOLD):
+        health.record(False, 0)
+    health._open_until = 0
+    calls = []
+
+    async def probe(*args):
+        calls.append(args)
+        await asyncio.sleep(0.01)
+        return [make_departure(sensor, 5, source="dublin_bus")]
+
+    data.async_update_source_dublin_bus = probe
+
+    async def async_test():
+        return await asyncio.gather(
+            *[data._async_fetch_source("dublin_bus", source_data) for _ in range(3)]
+        )
+
+    results = asyncio.run(async_test())
+    assert len(calls) == 1
+    assert [len(departures) for departures in results] == [1, 1, 1]
+    assert health.as_dict()["circuit"] == sensor.CIRCUIT_CLOSED
+
+
+def test_batch_stop_added_during_fetch(sensor, make_data):
+    """A stop added to a batch in flight is fetched, not cached as empty."""
+    sources = {"tfi_efa": {"batch_stop_id": "8220DB000769"}}
+    data = make_data(sources)
+    started = asyncio.Event()
+    requested = []
+
+    async def fetch_batch(stop_id, ssl_verify, sample, batch):
+        requested.append(set(sensor.BATCH_STOPS[("tfi_efa", "8220DB000769")]))
+        started.set()
+        await asyncio.sleep(0.01)
+        return {
+            stop: [make_departure(sensor, 5)]
+            for stop in sensor.BATCH_STOPS[("tfi_efa", "8220DB000769")]
+        }
+
+    async def async_test():
+        data.async_update_source_tfi_efa = fetch_batch
+        first = asyncio.create_task(
+            data._async_fetch_source("tfi_efa", data._rtpi_sources["tfi_efa"])
+        )
+        await started.wait()
+        sources["tfi_efa"]["stop_id"] = "770"
+        added = make_data(sources)
+        added.async_update_source_tfi_efa = fetch_batch
+        departures = await added._async_fetch_source(
+            "tfi_efa", added._rtpi_sources["tfi_efa"]
+        )
+        return await first, departures, added
+
+    first, departures, added = asyncio.run(async_test())
+    assert requested == [{"768"}, {"768", "770"}]
+    assert len(first) == 1 and len(departures) == 1
+    assert len(sensor.DEPARTURE_CACHE.get("tfi_efa", "770", 60)) == 1
+
+    added.release()
+    assert sensor.BATCH_STOPS[("tfi_efa", "8220DB000769")] == {"768": 1}
+    assert sensor.DEPARTURE_CACHE.get("tfi_efa", "770", 60) is None
+    assert len(sensor.DEPARTURE_CACHE.get("tfi_efa", "768", 60)) == 1
+    data.release()
+    assert not sensor.BATCH_STOPS
+    assert not sensor.DEPARTURE_CACHE.items()
+
+
+STATIONS_XML = (
+    b"<ArrayOfObjStation><objStation><StationDesc>Connolly</StationDesc>"
+    b"<StationCode>CNLLY</StationCode></objStation></ArrayOfObjStation>"
+)
+
+
+@pytest.mark.parametrize("loaded", [False, True])
+def test_irish_rail_stations_unavailable(sensor, make_data, loaded):
+    """A failed station list request is a connection error, not a bad stop."""
+    data = make_data({"irish_rail": {"stop_id": "Connolly"}})
+    if loaded:
+        sensor.IRISH_RAIL_STATIONS.update(STATIONS_XML)
+        sensor.IRISH_RAIL_STATIONS._fetched_at -= sensor.IRISH_RAIL_STATIONS_TTL
+
+    async def unavailable(ssl_verify):
+        raise aiohttp.ClientConnectionError("unavailable")
+
+    data._async_update_irish_rail_stations = unavailable
+    get_code = data._async_irish_rail_station_code
+    if loaded:
+        ## The stations retrieved earlier are used
+        assert asyncio.run(get_code("Connolly", True)) == "CNLLY"
+        with pytest.raises(Exception, match="unknown Irish Rail station"):
+            asyncio.run(get_code("Heuston", True))
+    else:
+        with pytest.raises(aiohttp.ClientConnectionError):
+            asyncio.run(get_code("Connolly", True))
+
+
+def utc(sensor, *args):
+    """Return a UTC time."""
+    return datetime(*args, tzinfo=sensor.dt_util.UTC)
+
+
+@pytest.mark.parametrize(
+    "now,local_time,due_at",
+    [
+        ## Clocks go forward at 01:00 GMT, 01:30 does not exist locally
+        ((2026, 3, 29, 0, 30), "01:30", (2026, 3, 29, 1, 30)),
+        ((2026, 3, 29, 0, 30), "03:00", (2026, 3, 29, 2, 0)),
+        ## Clocks go back at 02:00 IST, repeating 01:00 to 02:00
+        ((2026, 10, 24, 23, 50), "01:30", (2026, 10, 25, 0, 30)),
+        ((2026, 10, 24, 23, 50), "02:30", (2026, 10, 25, 2, 30)),
+        ## Times either side of midnight
+        ((2026, 1, 15, 23, 55), "00:05", (2026, 1, 16, 0, 5)),
+        ((2026, 1, 16, 0, 5), "23:55", (2026, 1, 15, 23, 55)),
+        ((2026, 7, 15, 22, 55), "00:05", (2026, 7, 15, 23, 5)),
+    ],
+)
+def test_timestamp_decoder_time(sensor, dublin_time_zone, now, local_time, due_at):
+    """Local times are decoded to the nearest time, across DST and midnight."""
+    decoder = sensor.TimestampDecoder(utc(sensor, *now))
+    ## Compared in UTC, as ambiguous local times never compare equal
+    assert sensor.dt_util.as_utc(decoder.time(local_time)) == utc(sensor, *due_at)
+
+
+def test_timestamp_decoder_dst(sensor, dublin_time_zone):
+    """Local timestamps are decoded in the time zone in effect at the time."""
+    decoder = sensor.TimestampDecoder(utc(sensor, 2026, 10, 24, 23, 50))
+    assert decoder.datestamp("24/10/2026 23:30:00") == utc(sensor, 2026, 10, 24, 22, 30)
+    assert decoder.datestamp("25/10/2026 03:00:00") == utc(sensor, 2026, 10, 25, 3)
+    dt_json = {"year": "2026", "month": "3", "day": "29", "hour": "3", "minute": "0"}
+    assert decoder.efa_json(dt_json) == utc(sensor, 2026, 3, 29, 2)
+
+
+def test_token_bucket(sensor, monkeypatch):
+    """Requests beyond the burst are spaced out at the rate limit."""
+    now = [100.0]
+    monkeypatch.setattr(sensor.time, "monotonic", lambda: now[0])
+    bucket = sensor.TokenBucket(2, 3)
+    assert [bucket.reserve() for _ in range(5)] == [0, 0, 0, 0.5, 1.0]
+    ## Tokens are replenished at the rate limit
+    now[0] += 2.5
+    assert bucket.reserve() == 0
+
+
+def test_fetch_jitter(sensor, make_data, monkeypatch):
+    """Full refreshes are delayed by a random jitter of up to fetch_jitter."""
+    data = make_data({"tfi_efa": {}})
+    data._coordinator = sensor.RtpiCoordinator(None, fetch_jitter=30)
+    jitters = [data._coordinator.fetch_jitter() for _ in range(100)]
+    assert all(timedelta(0) <= jitter <= timedelta(seconds=30) for jitter in jitters)
+
+    monkeypatch.setattr(sensor.random, "uniform", lambda a, b: b)
+    data._departures = [make_departure(sensor, 5)]
+    data._schedule_next_fetch()
+    assert data._next_fetch_at - data._last_fetch_at == timedelta(
+        minutes=data._refresh_interval, seconds=30
+    )
+
+
+def test_hedged_fetch_cancels_slower_sources(sensor, make_data):
+    """Sources still running when a result is used are cancelled."""
+    data = make_data({"tfi_efa": {}, "dublin_bus": {}})
+    data._fetch_strategy = sensor.FETCH_STRATEGY_HEDGED
+    data._hedge_delay = 0.01
+    cancelled = []
+
+    async def async_fetch_source(source, source_data):
+        try:
+            if source == "tfi_efa":
+                await asyncio.sleep(0.05)
+                return [make_departure(sensor, 5)]
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(source)
+            raise
+        return [make_departure(sensor, 5, source="dublin_bus")]
+
+    async def async_test():
+        data._async_fetch_source = async_fetch_source
+        departures = await data._async_fetch_sources()
+        await asyncio.sleep(0)
+        return departures
+
+    departures = asyncio.run(async_test())
+    assert [dep.source for dep in departures] == ["tfi_efa"]
+    assert cancelled == ["dublin_bus"]
+
+
+def test_fast_update_ages_departures(sensor, make_data):
+    """Departures older than DEPARTED_AGE are dropped from the head."""
+    data = make_data({"tfi_efa": {}})
+    now = sensor.dt_util.utcnow()
+    departures = [make_departure(sensor, minutes) for minutes in (-3, -2, 0, 1, 5)]
+    assert data.fast_update(departures, now - timedelta(minutes=5)) is departures
+    assert data.fast_update(departures, now) == departures[2:]
+    assert data.fast_update(departures, now + timedelta(minutes=10)) == []
+
+
+@pytest.fixture
+def saved(sensor, monkeypatch):
+    """Return the data saved by departure stores, kept in memory."""
+    saved = {}
+
+    class FakeStore:
+        """Store keeping saved data in memory."""
+
+        def __init__(self, hass, version, key):
+            pass
+
+        def async_delay_save(self, data_func, delay):
+            saved["data"] = json.loads(json.dumps(data_func()))
+
+        async def async_load(self):
+            return saved.get("data")
+
+    monkeypatch.setattr(sensor, "Store", FakeStore)
+    return saved
+
+
+def departure_store(sensor):
+    """Return a departure store saving immediately."""
+    hass = SimpleNamespace(loop=SimpleNamespace(call_soon_threadsafe=lambda f: f()))
+    return sensor.DepartureStore(hass)
+
+
+def test_departure_store_round_trip(sensor, saved):
+    """Cached departures are restored after a restart."""
+    departures = [make_departure(sensor, 5), make_departure(sensor, 10, "145")]
+    departures[1] = departures[1]._replace(is_realtime=False, countdown=None)
+    departure_store(sensor)
+    sensor.DEPARTURE_CACHE.acquire("tfi_efa", "768")
+    sensor.DEPARTURE_CACHE.set("tfi_efa", "768", departures, 0)
+
+    restored = asyncio.run(departure_store(sensor).async_load())
+    assert restored == {("tfi_efa", "768"): departures}
+
+
+def test_departure_store_pruned(sensor, saved):
+    """Departures for removed stops or that have all departed are not saved."""
+    store = departure_store(sensor)
+    for stop_id in ("767", "768", "769"):
+        sensor.DEPARTURE_CACHE.acquire("tfi_efa", stop_id)
+    sensor.DEPARTURE_CACHE.set("tfi_efa", "767", [make_departure(sensor, 5)], 0)
+    sensor.DEPARTURE_CACHE.set("tfi_efa", "768", [make_departure(sensor, 5)], 0)
+    sensor.DEPARTURE_CACHE.set("tfi_efa", "769", [make_departure(sensor, -2)], 0)
+    store._saved = {("tfi_efa", "770"): [make_departure(sensor, 5)]}
+    sensor.DEPARTURE_CACHE.release("tfi_efa", "767")
+    store.schedule_save()
+    assert [stop["stop_id"] for stop in saved["data"]["stops"]] == ["768"]